@@ -0,0 +1,52 @@
+"""Works out who is asking and what they may open, for the main server and the API alike."""
+
+from typing import Annotated
+
+from fastapi import Cookie, Header, HTTPException
+
+from . import auth, file_handler
+from .config import CONFIG
+
+
+async def get_session(session_id: Annotated[str | None, Cookie()] = None) -> auth.Session | None:
+    if session_id and (session := await auth.check_session(session_id)):
+        return session
+    return None
+
+
+async def get_api_session(
+    session_id: Annotated[str | None, Cookie()] = None,
+    authorization: Annotated[str | None, Header()] = None,
+) -> auth.Session | None:
+    """Scripts can send the session ID as a bearer token instead of a cookie."""
+    if authorization and authorization.lower().startswith("bearer "):
+        session_id = authorization[7:].strip()
+    return await get_session(session_id)
+
+
+def check_public_access(session: auth.Session | None) -> None:
+    """Raises the matching HTTP error unless whoever is asking may see the public folder."""
+    if not CONFIG.get("public_directory"):
+        raise HTTPException(status_code=404, detail="Public directory not enabled.")
+    if session is None:
+        if CONFIG.get("public_access_requires_login", True):
+            raise HTTPException(status_code=401, detail="Not logged in.")
+    elif session.access_level < CONFIG.get("public_access_level", -1):
+        raise HTTPException(status_code=403, detail="User level insufficient.")
+
+
+async def resolve_share(session: auth.Session | None, share_id: str) -> file_handler.ShareRecord:
+    """Finds a share and checks whoever is asking may open it, raising the matching HTTP error otherwise."""
+    try:
+        bytes.fromhex(share_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid share ID.") from None
+    share = await file_handler.get_share_record(share_id)
+    if not share or share.expired:
+        raise HTTPException(status_code=404, detail="Share ID not found.")
+    if share.allowed_users:
+        if not (session and session.user_id in share.allowed_users):
+            raise HTTPException(status_code=403, detail="Not on share list.")
+    elif not (share.anonymous_access or session):
+        raise HTTPException(status_code=401, detail="Share not publicly accessible.")
+    return share
@@ -1,7 +1,303 @@
-from fastapi import FastAPI
+"""A JSON API, so scripts and the web client can list and change files without rendering or scraping pages.
+Requests are authenticated with the session cookie, or with the session ID as a bearer token.
+"""
+
+from dataclasses import dataclass
+from hashlib import blake2b
+from json import dumps
+from typing import Annotated, Any, Literal
+
+from fastapi import Body, Depends, FastAPI, HTTPException, Query, Request, Security
+from fastapi.responses import JSONResponse, Response
+
+from . import auth, file_handler
+from .access import check_public_access, get_api_session, resolve_share
+from .config import CONFIG
+from .file_handler import BatchOperation
+from .responses import etag_matches
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LISTING_FIELDS: tuple[str, ...] = ("name", "path", "view_path", "type", "protected", "size_bytes", "size", "modified")
+LISTING_PAGE_LIMIT: int = 1000
+
+
+def dump_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class APIResponse(JSONResponse):
+    """Serialized with orjson when it is installed, which is several times faster on big listings."""
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
+
+
+api_v0 = FastAPI(openapi_url=None, default_response_class=APIResponse)
+
+
+@dataclass(slots=True)
+class Location:
+    """Where the paths of a request are relative to, and what whoever is asking may do there."""
+
+    base: str
+    access_level: int
+    # Whom the background jobs started here are reported to. None where nothing may be changed.
+    owner: str | None = None
+
+
+@dataclass(slots=True)
+class ListingQuery:
+    sort: str
+    descending: bool
+    cursor: str | None
+    limit: int
+    fields: list[str] | None
+
+
+async def home_location(session: Annotated[auth.Session | None, Security(get_api_session)]) -> Location:
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    return Location(base=session.user_id, access_level=session.access_level, owner=session.user_id)
+
+
+async def public_location(session: Annotated[auth.Session | None, Security(get_api_session)]) -> Location:
+    check_public_access(session)
+    if session is None:
+        return Location(base=str(CONFIG.get("public_directory")), access_level=-1)
+    return Location(base=str(CONFIG.get("public_directory")), access_level=session.access_level, owner=session.user_id)
+
+
+async def share_location(
+    share_id: str, session: Annotated[auth.Session | None, Security(get_api_session)]
+) -> Location:
+    share = await resolve_share(session, share_id)
+    return Location(
+        base=str(share.path),
+        access_level=session.access_level if session else -1,
+        owner=share_id if share.collaborative else None,
+    )
+
+
+async def listing_query(
+    sort: Literal["name", "type", "size", "mtime"] = "name",
+    descending: bool = False,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=LISTING_PAGE_LIMIT)] = file_handler.LISTING_PAGE_SIZE,
+    fields: str | None = None,
+) -> ListingQuery:
+    """fields is a comma separated list of the LISTING_FIELDS to send, so clients only get what they use."""
+    selected = fields.split(",") if fields else None
+    if selected and (unknown := set(selected).difference(LISTING_FIELDS)):
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return ListingQuery(sort=sort, descending=descending, cursor=cursor, limit=limit, fields=selected)
+
+
+def check_share_id(share_id: str) -> None:
+    try:
+        bytes.fromhex(share_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid share ID.") from None
 
-api_v0 = FastAPI()
 
 @api_v0.get("/")
 async def root() -> dict:
-	return {"detail": "aha!!"}
+    return {"version": 0}
+
+
+async def get_listing(
+    request: Request, location: Location, file_path: str | None, listing: ListingQuery
+) -> Response:
+    """Answers with one page of a folder and the cursor for the next one. The ETag is a hash of the page, so
+    a client that already has it gets a 304 instead of the same page again.
+    """
+    try:
+        listed = await file_handler.list_files(
+            base=location.base,
+            subfolder=file_path,
+            access_level=location.access_level,
+            sort=listing.sort,
+            descending=listing.descending,
+            cursor=listing.cursor,
+            limit=listing.limit,
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+    if listed is None:
+        raise HTTPException(status_code=404, detail="Not a folder.")
+    files, next_cursor = listed
+    if listing.fields:
+        files = [{field: file[field] for field in listing.fields if field in file} for file in files]
+    body = dump_json({"files": files, "next_cursor": next_cursor})
+    etag = f'"{blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if (if_none_match := request.headers.get("if-none-match")) is not None and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@api_v0.get("/files")
+@api_v0.get("/files/{file_path:path}")
+async def list_files(
+    request: Request,
+    location: Annotated[Location, Depends(home_location)],
+    listing: Annotated[ListingQuery, Depends(listing_query)],
+    file_path: str | None = None,
+):
+    return await get_listing(request, location, file_path, listing)
+
+
+@api_v0.get("/public/files")
+@api_v0.get("/public/files/{file_path:path}")
+async def list_public_files(
+    request: Request,
+    location: Annotated[Location, Depends(public_location)],
+    listing: Annotated[ListingQuery, Depends(listing_query)],
+    file_path: str | None = None,
+):
+    return await get_listing(request, location, file_path, listing)
+
+
+@api_v0.get("/shares/{share_id}/files")
+@api_v0.get("/shares/{share_id}/files/{file_path:path}")
+async def list_share_files(
+    request: Request,
+    location: Annotated[Location, Depends(share_location)],
+    listing: Annotated[ListingQuery, Depends(listing_query)],
+    file_path: str | None = None,
+):
+    return await get_listing(request, location, file_path, listing)
+
+
+async def get_file_info(location: Location, file_path: str | None) -> dict:
+    if (info := await file_handler.get_file_info(location.base, file_path or ".")) is None:
+        raise HTTPException(status_code=404, detail="File not found.")
+    return info
+
+
+@api_v0.get("/stat")
+@api_v0.get("/stat/{file_path:path}")
+async def stat_file(location: Annotated[Location, Depends(home_location)], file_path: str | None = None):
+    return await get_file_info(location, file_path)
+
+
+@api_v0.get("/public/stat")
+@api_v0.get("/public/stat/{file_path:path}")
+async def stat_public_file(location: Annotated[Location, Depends(public_location)], file_path: str | None = None):
+    return await get_file_info(location, file_path)
+
+
+@api_v0.get("/shares/{share_id}/stat")
+@api_v0.get("/shares/{share_id}/stat/{file_path:path}")
+async def stat_share_file(location: Annotated[Location, Depends(share_location)], file_path: str | None = None):
+    return await get_file_info(location, file_path)
+
+
+async def run_batch(location: Location, operations: list[BatchOperation]) -> dict:
+    """Moves, renames and deletes, answering with the outcome of each in the order they were given."""
+    if location.owner is None:
+        raise HTTPException(status_code=403, detail="Read only.")
+    try:
+        results = await file_handler.run_batch(location.base, operations, owner=location.owner)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+    return {"results": [{"success": success, "detail": detail} for success, detail in results]}
+
+
+@api_v0.post("/batch")
+async def batch(
+    location: Annotated[Location, Depends(home_location)],
+    operations: Annotated[list[BatchOperation], Body(embed=True)],
+):
+    return await run_batch(location, operations)
+
+
+@api_v0.post("/public/batch")
+async def public_batch(
+    location: Annotated[Location, Depends(public_location)],
+    operations: Annotated[list[BatchOperation], Body(embed=True)],
+):
+    return await run_batch(location, operations)
+
+
+@api_v0.post("/shares/{share_id}/batch")
+async def share_batch(
+    location: Annotated[Location, Depends(share_location)],
+    operations: Annotated[list[BatchOperation], Body(embed=True)],
+):
+    return await run_batch(location, operations)
+
+
+@api_v0.get("/jobs")
+async def list_jobs(location: Annotated[Location, Depends(home_location)]):
+    return file_handler.get_tree_jobs(str(location.owner))
+
+
+@api_v0.get("/shares")
+async def list_shares(session: Annotated[auth.Session | None, Security(get_api_session)]):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    return await file_handler.list_shares(session.user_id)
+
+
+@api_v0.post("/shares", status_code=201)
+async def create_share(
+    session: Annotated[auth.Session | None, Security(get_api_session)],
+    path: Annotated[str, Body()],
+    anonymous_access: Annotated[bool, Body()] = False,
+    collaborative: Annotated[bool, Body()] = False,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    success, share_id = await file_handler.create_share(
+        user_id=session.user_id, file_path=path, anonymous_access=anonymous_access, collaborative=collaborative
+    )
+    if not success:
+        raise HTTPException(status_code=400, detail=share_id)
+    return {"id": share_id}
+
+
+@api_v0.get("/shares/{share_id}")
+async def get_share(share_id: str, session: Annotated[auth.Session | None, Security(get_api_session)]):
+    share = await resolve_share(session, share_id)
+    return {
+        "id": share.share_id,
+        "name": share.path.name,
+        "anonymous_access": share.anonymous_access,
+        "collaborative": share.collaborative,
+        "expires": share.expires.isoformat() if share.expires else None,
+    }
+
+
+@api_v0.patch("/shares/{share_id}")
+async def update_share(
+    share_id: str,
+    session: Annotated[auth.Session | None, Security(get_api_session)],
+    anonymous_access: Annotated[bool | None, Body()] = None,
+    collaborative: Annotated[bool | None, Body()] = None,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    check_share_id(share_id)
+    success, detail = await file_handler.update_share(
+        share_id, session.user_id, anonymous_access=anonymous_access, collaborative=collaborative
+    )
+    if not success:
+        raise HTTPException(status_code=404, detail=detail)
+    return {"detail": detail}
+
+
+@api_v0.delete("/shares/{share_id}")
+async def delete_share(share_id: str, session: Annotated[auth.Session | None, Security(get_api_session)]):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    check_share_id(share_id)
+    success, detail = await file_handler.delete_share(share_id, session.user_id)
+    if not success:
+        raise HTTPException(status_code=404, detail=detail)
+    return {"detail": detail}
@@ -0,0 +1,89 @@
+"""Builds ZIP archives while they are being sent, so a folder of any size downloads in constant memory
+without ever writing a temporary file.
+"""
+
+import lzma
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from datetime import datetime
+from io import RawIOBase
+from pathlib import Path
+from typing import BinaryIO
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+ZIP_CHUNK_SIZE: int = 1024 * 1024
+# ZIP timestamps cannot go back any further
+ZIP_EARLIEST_TIME: tuple[int, ...] = (1980, 1, 1, 0, 0, 0)
+
+
+@dataclass(frozen=True, slots=True)
+class ZipMember:
+    name: str
+    modified: float
+    # None for a folder
+    path: Path | None = None
+    size: int = 0
+    # A compressed upload, decompressed on the way into the archive
+    decompress: bool = False
+    # Already compressed media, which deflating again would only slow down
+    store: bool = False
+
+
+class ZipStreamBuffer(RawIOBase):
+    """Collects what ZipFile writes until it is sent. It cannot seek, so ZipFile writes a data
+    descriptor after each member instead of going back to fill in its header.
+    """
+
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def get_zip_time(modified: float) -> tuple[int, ...]:
+    return max(datetime.fromtimestamp(modified).timetuple()[:6], ZIP_EARLIEST_TIME)
+
+
+def open_member(path: Path, decompress: bool) -> BinaryIO:
+    return lzma.open(path) if decompress else open(path, "rb")
+
+
+def iter_zip(members: Iterable[ZipMember]) -> Iterator[bytes]:
+    """Yields a ZIP archive of members piece by piece. It is a plain generator on purpose:
+    StreamingResponse runs each step in a worker thread, so reading files never blocks the event loop.
+    Files that disappear before their turn are left out.
+    """
+    buffer = ZipStreamBuffer()
+    with ZipFile(buffer, "w") as archive:
+        for member in members:
+            info = ZipInfo(member.name, date_time=get_zip_time(member.modified))
+            if member.path is None:
+                info.CRC = info.compress_size = info.file_size = 0
+                info.external_attr = (0o40755 << 16) | 0x10
+                archive.mkdir(info)
+            else:
+                try:
+                    source = open_member(member.path, member.decompress)
+                except OSError:
+                    continue
+                info.compress_type = ZIP_STORED if member.store else ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                info.file_size = member.size
+                with source, archive.open(info, "w", force_zip64=member.size >= ZIP64_LIMIT) as destination:
+                    while chunk := source.read(ZIP_CHUNK_SIZE):
+                        destination.write(chunk)
+                        if data := buffer.take():
+                            yield data
+            if data := buffer.take():
+                yield data
+    yield buffer.take()
@@ -1,21 +1,24 @@
 """Handles authentication and updating users in the DB."""
 
-from dataclasses import dataclass
+from asyncio import get_running_loop, sleep, wrap_future
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from hashlib import scrypt
-from os import environ
+from os import cpu_count, environ
 from re import compile as regex_compile
-from sched import scheduler
 from secrets import token_bytes
-from threading import Lock, Thread
-from typing import Optional
-from uuid import uuid1
+from typing import TypeVar
 
-from sqlalchemy import select
+from sqlalchemy import delete, select
+from sqlalchemy.orm import selectinload
 
+from .config import CONFIG
 from .database import SessionMaker
-from .file_handler import create_home_folder, mark_home_folder_as_deleted
-from .objects import PublicKey, User
+from .file_handler import create_home_folder, forget_share_records, mark_home_folder_as_deleted
+from .objects import PublicKey, ShareAllowedUser, User
+from .session_backends import Session, SessionBackend, create_session_backend
 
 # REVIEW - Now that we're using uuids as folder names, this should be fine to remove?
 INVALID_USERNAME_CHARACTERS = regex_compile(r'<|>|:|"|\?|\/|\\|\||\*')
@@ -25,24 +28,51 @@ COST_PARAMETER: int = 2**12
 BLOCK_SIZE: int = 8
 PARALLELIZATION: int = 4
 HASH_LENGTH: int = 32
+# scrypt releases the GIL, so these threads hash in parallel while the event loop keeps serving
+PASSWORD_WORKERS: int = CONFIG.get("password_workers") or min(cpu_count() or 1, 4)
+PASSWORD_QUEUE_LIMIT: int = CONFIG.get("password_queue_limit", 16)
+PASSWORD_RETRY_AFTER: int = 5
 
-SECRET_KEY = environ.get("VAPOROUS_SECRET_KEY") or token_bytes(32).hex()
+SECRET_KEY: str | None = environ.get("VAPOROUS_SECRET_KEY")
 SESSION_EXPIRY: timedelta = timedelta(days=3)
+SESSION_SWEEP_INTERVAL: int = 60
 
-invalidator = scheduler()
+sessions: SessionBackend = create_session_backend(
+    CONFIG.get("session_backend") or "memory",
+    secret_key=SECRET_KEY,
+    lifetime=SESSION_EXPIRY,
+    cache_seconds=CONFIG.get("session_cache_seconds", 5),
+)
 
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+password_jobs: int = 0
+
+T = TypeVar("T")
+
+
+class PasswordHashingBusy(Exception):
+    """Every password worker is busy and the queue is full, so the request is turned away instead of waiting."""
 
-@dataclass(slots=True)
-class Session:
-    username: str
-    user_id: str
-    access_level: int
-    expires: datetime
-    session_id: str
+
+async def run_password_job(function: Callable[..., T], *args, **kwargs) -> T:
+    """Runs anything that checks or hashes a password in the password pool.
+    Only PASSWORD_WORKERS jobs run at once and at most PASSWORD_QUEUE_LIMIT more may wait for a worker;
+    beyond that PasswordHashingBusy is raised straight away.
+    """
+    global password_jobs
+    if password_jobs >= PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT:
+        raise PasswordHashingBusy()
+    loop = get_running_loop()
+    future = password_pool.submit(partial(function, *args, **kwargs))
+    password_jobs += 1
+    # A request that goes away leaves its hash running, so the job is only over once its thread is done with it
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(finish_password_job))
+    return await wrap_future(future)
 
 
-sessions_lock = Lock()
-sessions: dict[str, Session] = {}
+def finish_password_job() -> None:
+    global password_jobs
+    password_jobs -= 1
 
 
 def passkey_challenge() -> bytes:
@@ -98,26 +128,25 @@ def hashpw(password: str) -> str:
     return f"{salt.hex()}${COST_PARAMETER}${BLOCK_SIZE}${PARALLELIZATION}${password_hash.hex()}"
 
 
-def login_with_password(username: str, password: str) -> bool:
+async def login_with_password(username: str, password: str) -> bool:
     """Used for password authentication."""
     username = username[:USERNAME_LENGTH]
     stored_hash: str | None = None
-    with SessionMaker() as engine:
-        user: User | None = engine.execute(select(User).filter_by(username=username)).scalar_one_or_none()
+    async with SessionMaker() as engine:
+        user: User | None = await engine.scalar(select(User).filter_by(username=username))
         if user:
             stored_hash = user.password
-    if user and checkpw(password, stored_hash):
+    if user and await run_password_job(checkpw, password, stored_hash):
         return True
     return False
 
 
-def add_user(
-    username: str, *, password: Optional[str] = None, passkey_token=None, user_level: Optional[int] = None
+async def add_user(
+    username: str, *, password: str | None = None, passkey_token=None, user_level: int | None = None
 ) -> tuple[bool, str | set[str]]:
     username = username.strip()
-    with SessionMaker() as engine:
-        result = engine.execute(select(User).where(User.username == username))
-        for _ in result:
+    async with SessionMaker() as engine:
+        if await engine.scalar(select(User).where(User.username == username)):
             return (False, "Username already exists!")
 
     if not passkey_token and not password:
@@ -132,7 +161,7 @@ def add_user(
     stored_hash = None
     passkeys: list[PublicKey] = []
     if password:
-        stored_hash = hashpw(password)
+        stored_hash = await run_password_job(hashpw, password)
         authentication_methods.add("password")
     new_user = User(username=username, password=stored_hash)
     if user_level:
@@ -142,38 +171,34 @@ def add_user(
         passkeys.append(PublicKey(owner=new_user.user_id, key=passkey_token, name="Initial Passkey"))
     create_home_folder(new_user.user_id.hex())
     # TODO - if passkey add and associate passkey
-    with SessionMaker() as engine:
+    async with SessionMaker() as engine:
         engine.add(new_user)
         for key in passkeys:
             engine.add(key)
-        engine.commit()
+        await engine.commit()
     return (True, authentication_methods)
 
 
-def remove_user(username: str) -> tuple[bool, str]:
+async def remove_user(username: str) -> tuple[bool, str]:
     user_id: str
-    with SessionMaker() as engine:
-        user: User | None = engine.execute(select(User).filter_by(username=username)).scalar_one_or_none()
+    async with SessionMaker() as engine:
+        user: User | None = await engine.scalar(select(User).filter_by(username=username))
         if not user:
             return (False, "User does not exist to be deleted!")
-        engine.delete(user)
-        engine.commit()
+        await engine.execute(delete(ShareAllowedUser).where(ShareAllowedUser.user_id == user.user_id))
+        await engine.delete(user)
+        await engine.commit()
         user_id = user.user_id.hex()
-    with sessions_lock:
-        sessions_to_delete: list = []
-        for session_id, session in sessions.items():
-            if session.username == username:
-                sessions_to_delete.append(session_id)
-        for session_id in sessions_to_delete:
-            del sessions[session_id]
+    await sessions.remove_user(user_id)
+    forget_share_records()
     mark_home_folder_as_deleted(user_id)
     return (True, "User has been deleted")
 
 
-def list_users() -> dict[str, dict]:
+async def list_users() -> dict[str, dict]:
     users = {}
-    with SessionMaker() as engine:
-        result = engine.execute(select(User)).scalars()
+    async with SessionMaker() as engine:
+        result = await engine.scalars(select(User).options(selectinload(User.public_keys), selectinload(User.shares)))
         for user in result:
             users[user.username] = {
                 "Access level": user.user_level,
@@ -183,128 +208,91 @@ def list_users() -> dict[str, dict]:
     return users
 
 
-def new_session(username: str, *, invalidate_previous_sessions: bool = True):
+async def new_session(username: str, *, invalidate_previous_sessions: bool = True):
+    async with SessionMaker() as engine:
+        user = (await engine.execute(select(User).where(User.username == username))).scalar_one()
+    user_id = user.user_id.hex()
     if invalidate_previous_sessions:
-        with sessions_lock:
-            sessions_to_delete: list = []
-            for session_id, session in sessions.items():
-                if session.username == username:
-                    sessions_to_delete.append(session_id)
-            for session_id in sessions_to_delete:
-                del sessions[session_id]
-    with SessionMaker() as engine:
-        user = engine.execute(select(User).where(User.username == username)).scalar_one()
-        session_id = uuid1().hex
-        with sessions_lock:
-            sessions[session_id] = Session(
-                username=username,
-                user_id=user.user_id.hex(),
-                access_level=user.user_level,
-                expires=datetime.now() + SESSION_EXPIRY,
-                session_id=session_id,
-            )
-    return session_id
-
-
-def check_session(session_id) -> Session | None:
-    with sessions_lock:
-        if session := sessions.get(session_id):
-            if datetime.now() > session.expires:
-                del sessions[session_id]
-            else:
-                return session
-    return None
-
-
-def invalidate_session(session_id) -> None:
-    with sessions_lock:
-        try:
-            del sessions[session_id]
-        except:
-            pass
-
-
-def invalidate_sessions() -> None:
-    sessions_to_delete = []
-    with sessions_lock:
-        for session_id, session in sessions.items():
-            if datetime.now() > session.expires:
-                sessions_to_delete.append(session_id)
-        for session_id in sessions_to_delete:
-            del sessions[session_id]
-    invalidator.enter(36000, 1, invalidate_sessions)
-    invalidator.run()
-
-
-def remove_password(username: str) -> tuple[bool, str]:
-    with SessionMaker() as engine:
-        user: User | None = engine.execute(select(User).filter_by(username=username)).scalar_one_or_none()
+        await sessions.remove_user(user_id)
+    session = await sessions.create(username, user_id, user.user_level, datetime.now() + SESSION_EXPIRY)
+    return session.session_id
+
+
+async def check_session(session_id) -> Session | None:
+    return await sessions.get(session_id)
+
+
+async def invalidate_session(session_id) -> None:
+    await sessions.remove(session_id)
+
+
+async def invalidate_sessions() -> None:
+    while True:
+        await sessions.expire()
+        await sleep(SESSION_SWEEP_INTERVAL)
+
+
+async def remove_password(username: str) -> tuple[bool, str]:
+    async with SessionMaker() as engine:
+        user: User | None = await engine.scalar(
+            select(User).filter_by(username=username).options(selectinload(User.public_keys))
+        )
         if user is None:
             return (False, "User does not exist")
         if not user.public_keys:
             return (False, "You do not have any alternative method to log in!")
         user.password = ""
-        engine.commit()
+        await engine.commit()
     return (True, "Password removed!")
 
 
-def check_user_has_password(username: str) -> bool:
-    with SessionMaker() as engine:
-        user: User | None = engine.execute(select(User).filter_by(username=username)).scalar_one_or_none()
+async def check_user_has_password(username: str) -> bool:
+    async with SessionMaker() as engine:
+        user: User | None = await engine.scalar(select(User).filter_by(username=username))
         if user is None:
             return False
         return bool(user.password)
 
 
-def change_password(username: str, *, new_password: str, old_password: Optional[str] = None) -> tuple[bool, str]:
-    with SessionMaker() as engine:
-        user: User | None = engine.execute(select(User).filter_by(username=username)).scalar_one_or_none()
+async def change_password(username: str, *, new_password: str, old_password: str | None = None) -> tuple[bool, str]:
+    async with SessionMaker() as engine:
+        user: User | None = await engine.scalar(select(User).filter_by(username=username))
         if user is not None:
-            if (old_password is not None) and (not checkpw(old_password, user.password)):
+            if (old_password is not None) and (not await run_password_job(checkpw, old_password, user.password)):
                 return (False, "Existing password is incorrect!")
         else:
             return (False, "User does not exist!")
-        user.password = hashpw(new_password)
-        engine.commit()
+        user.password = await run_password_job(hashpw, new_password)
+        await engine.commit()
     return (True, "Password changed")
     # TODO - invalidate other sessions?
 
 
-def change_username(old_username: str, new_username: str) -> tuple[bool, str]:
-    with SessionMaker() as engine:
-        user_already_exists: User | None = engine.execute(
-            select(User).filter_by(username=new_username)
-        ).scalar_one_or_none()
+async def change_username(old_username: str, new_username: str) -> tuple[bool, str]:
+    async with SessionMaker() as engine:
+        user_already_exists: User | None = await engine.scalar(select(User).filter_by(username=new_username))
         if user_already_exists:
             return (False, "New username is already in use!")
             engine.expunge(user_already_exists)
-        user: User | None = engine.execute(select(User).filter_by(username=old_username)).scalar_one_or_none()
+        user: User | None = await engine.scalar(select(User).filter_by(username=old_username))
         if not user:
             return (False, "User does not exist!")
         user.username = new_username
-        engine.commit()
-    with sessions_lock:
-        for session in sessions.values():
-            if session.username == old_username:
-                session.username = new_username
+        await engine.commit()
+        await sessions.update_user(user.user_id.hex(), username=new_username)
     return (True, "Username changed")
 
 
-def change_access_level(username: str, access_level: int) -> tuple[bool, str]:
+async def change_access_level(username: str, access_level: int) -> tuple[bool, str]:
     try:
         access_level = int(access_level)
     except ValueError:
         return (False, "Invalid access level - must be an integer")
-    with SessionMaker() as engine:
-        user: User | None = engine.execute(select(User).filter_by(username=username)).scalar_one_or_none()
+    async with SessionMaker() as engine:
+        user: User | None = await engine.scalar(select(User).filter_by(username=username))
         if not user:
             return (False, "User does not exist!")
         user.user_level = max(access_level, 0)
-        engine.commit()
-    with sessions_lock:
-        for session in sessions.values():
-            if session.username == username:
-                session.access_level = access_level
+        await engine.commit()
+        await sessions.update_user(user.user_id.hex(), access_level=user.user_level)
     return (True, "User access level has changed")
-
-Thread(target=invalidate_sessions, daemon=True).start()
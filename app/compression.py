@@ -0,0 +1,159 @@
+"""Compresses uploads in worker processes so the event loop never waits on LZMA."""
+
+import lzma
+from asyncio import get_running_loop
+from bisect import bisect_right
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from os import cpu_count
+from pathlib import Path
+
+from .config import CONFIG
+
+COMPRESSION_CHUNK_SIZE: int = 1024 * 1024
+# How much uncompressed data goes into each independent xz stream, i.e. how far a seek may have to decompress
+SEEKABLE_BLOCK_SIZE: int = 16 * 1024 * 1024
+DECOMPRESSION_CHUNK_SIZE: int = 256 * 1024
+
+XZ_HEADER_MAGIC: bytes = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC: bytes = b"YZ"
+XZ_HEADER_SIZE: int = 12
+XZ_FOOTER_SIZE: int = 12
+
+compression_pool: ProcessPoolExecutor | None = None
+
+
+def get_compression_pool() -> ProcessPoolExecutor:
+    global compression_pool
+    if compression_pool is None:
+        compression_pool = ProcessPoolExecutor(max_workers=CONFIG.get("compression_workers") or cpu_count())
+    return compression_pool
+
+
+@dataclass(frozen=True, slots=True)
+class XZStream:
+    compressed_offset: int
+    uncompressed_offset: int
+    uncompressed_size: int
+
+
+def compress_file(source: Path, destination: Path, preset: int) -> None:
+    """Runs inside a worker process.
+    Feeds source through the compressor one chunk at a time, so workers use the same amount
+    of memory no matter how large the file is.
+    A new xz stream is started every SEEKABLE_BLOCK_SIZE bytes. Concatenated streams are still one
+    valid .xz file, but they let read_xz_index find a starting point close to any offset.
+    """
+    compressor: lzma.LZMACompressor | None = None
+    stream_size = 0
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        while chunk := source_file.read(COMPRESSION_CHUNK_SIZE):
+            if compressor is None:
+                compressor = lzma.LZMACompressor(preset=preset)
+                stream_size = 0
+            destination_file.write(compressor.compress(chunk))
+            stream_size += len(chunk)
+            if stream_size >= SEEKABLE_BLOCK_SIZE:
+                destination_file.write(compressor.flush())
+                compressor = None
+        if compressor is not None or not destination_file.tell():
+            destination_file.write((compressor or lzma.LZMACompressor(preset=preset)).flush())
+
+
+async def compress(source: Path, destination: Path, preset: int) -> None:
+    await get_running_loop().run_in_executor(get_compression_pool(), compress_file, source, destination, preset)
+
+
+def read_multibyte_integer(buffer: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    for shift in range(0, 63, 7):
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (value, position)
+    raise ValueError("Multibyte integer is too long")
+
+
+@lru_cache(maxsize=256)
+def read_xz_index(path: Path, modified: int, size: int) -> tuple[XZStream, ...]:
+    """Finds where every stream of an .xz file starts by walking the stream footers and indexes
+    backwards from the end of the file, without decompressing anything.
+    modified and size are only there so a changed file is never served from a stale cache entry.
+    """
+    streams: list[tuple[int, int]] = []
+    with open(path, "rb") as xz_file:
+        position = size
+        while position > 0:
+            xz_file.seek(position - 4)
+            if xz_file.read(4) == b"\x00\x00\x00\x00":
+                position -= 4  # Stream padding
+                continue
+            if position < XZ_HEADER_SIZE + XZ_FOOTER_SIZE:
+                raise ValueError("Truncated xz stream")
+            xz_file.seek(position - XZ_FOOTER_SIZE)
+            footer = xz_file.read(XZ_FOOTER_SIZE)
+            if footer[10:] != XZ_FOOTER_MAGIC:
+                raise ValueError("Missing xz stream footer")
+            index_size = (int.from_bytes(footer[4:8], "little") + 1) * 4
+            index_start = position - XZ_FOOTER_SIZE - index_size
+            if index_start < XZ_HEADER_SIZE:
+                raise ValueError("Invalid xz index size")
+            xz_file.seek(index_start)
+            index = xz_file.read(index_size)
+            if index[0] != 0:
+                raise ValueError("Missing xz index")
+            record_count, offset = read_multibyte_integer(index, 1)
+            blocks_size = 0
+            uncompressed_size = 0
+            for _ in range(record_count):
+                unpadded_size, offset = read_multibyte_integer(index, offset)
+                block_uncompressed_size, offset = read_multibyte_integer(index, offset)
+                blocks_size += (unpadded_size + 3) & ~3
+                uncompressed_size += block_uncompressed_size
+            position = index_start - blocks_size - XZ_HEADER_SIZE
+            if position < 0:
+                raise ValueError("Invalid xz index")
+            xz_file.seek(position)
+            if xz_file.read(len(XZ_HEADER_MAGIC)) != XZ_HEADER_MAGIC:
+                raise ValueError("Missing xz stream header")
+            streams.append((position, uncompressed_size))
+    uncompressed_offset = 0
+    index_entries: list[XZStream] = []
+    for compressed_offset, uncompressed_size in reversed(streams):
+        index_entries.append(XZStream(compressed_offset, uncompressed_offset, uncompressed_size))
+        uncompressed_offset += uncompressed_size
+    return tuple(index_entries)
+
+
+def iter_decompressed_range(path: Path, streams: tuple[XZStream, ...], start: int, end: int) -> Iterator[bytes]:
+    """Yields the decompressed bytes from start to end (inclusive), only decompressing from the
+    beginning of the stream that contains start.
+    """
+    stream = streams[bisect_right([stream.uncompressed_offset for stream in streams], start) - 1]
+    position = stream.uncompressed_offset
+    with open(path, "rb") as xz_file:
+        xz_file.seek(stream.compressed_offset)
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        stream_started = True
+        while position <= end:
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+                stream_started = False
+            elif decompressor.needs_input:
+                if not (data := xz_file.read(DECOMPRESSION_CHUNK_SIZE)):
+                    break
+            else:
+                data = b""
+            if not stream_started:
+                if not (data := data.lstrip(b"\x00")):
+                    continue
+                stream_started = True
+            output = decompressor.decompress(data, max_length=DECOMPRESSION_CHUNK_SIZE)
+            output_start = position
+            position += len(output)
+            if position > start:
+                yield output[max(start - output_start, 0) : end + 1 - output_start]
@@ -0,0 +1,146 @@
+"""Stores each distinct upload once. Uploaded files are hard links to a content-addressed copy in the store,
+so identical uploads in different folders share their blocks on disk, and renaming, moving or deleting any of
+them works exactly as it does for any other file. Content nobody links to any more is swept away.
+"""
+
+from hashlib import sha256
+from os import link, scandir
+from os.path import samestat
+from pathlib import Path
+from re import compile as regex_compile
+from threading import Lock
+
+from .compression import iter_decompressed_range, read_xz_index
+from .config import CONFIG
+
+CONTENT_HASH_CHUNK_SIZE: int = 1024 * 1024
+DIGEST_REGEX = regex_compile(r"[0-9a-f]{64}")
+
+sweep_lock = Lock()
+
+
+def is_deduplication_enabled() -> bool:
+    return bool(CONFIG.get("deduplicate_uploads", False))
+
+
+def get_content_directory() -> Path:
+    """Has to be on the same filesystem as the uploads, since hard links cannot cross filesystems."""
+    if content_directory := CONFIG.get("content_directory"):
+        return Path(content_directory)
+    return Path(CONFIG["upload_directory"]) / ".content"
+
+
+def get_content_key(digest: str, compression: int | None = None) -> str:
+    """Compressing the same bytes at the same level gives the same file, so compressed uploads are stored by
+    the hash of what was uploaded and their compression level, and a duplicate never has to be compressed again.
+    """
+    return f"{digest}.xz{compression}" if compression else digest
+
+
+def get_content_path(key: str) -> Path:
+    return get_content_directory() / key[:2] / key
+
+
+def hash_file(path: Path) -> str:
+    content_hash = sha256()
+    with open(path, "rb") as file_:
+        while chunk := file_.read(CONTENT_HASH_CHUNK_SIZE):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def has_content(key: str, size: int | None = None) -> bool:
+    """Whether content is stored under key (of the given size, when one is given)."""
+    try:
+        stored_size = get_content_path(key).stat().st_size
+    except OSError:
+        return False
+    return size is None or stored_size == size
+
+
+def read_content(key: str, start: int, end: int) -> bytes | None:
+    """The bytes from start up to end of the content stored under key, as it was uploaded even if it is stored
+    compressed, or None if there is no such content.
+    """
+    content_path = get_content_path(key)
+    try:
+        if "." not in key:
+            with open(content_path, "rb") as file_:
+                file_.seek(start)
+                return file_.read(end - start)
+        stat_result = content_path.stat()
+        streams = read_xz_index(content_path, stat_result.st_mtime_ns, stat_result.st_size)
+        return b"".join(iter_decompressed_range(content_path, streams, start, end - 1))
+    except (OSError, ValueError):
+        return None
+
+
+def matches_content(key: str, path: Path, start: int, end: int) -> bool:
+    """Whether path holds the same bytes from start up to end as the content stored under key.
+    Knowing the hash of some content is not the same as having it, so a client that declares a hash has to send
+    a range the server picks first, which only someone with the contents can.
+    """
+    try:
+        with open(path, "rb") as file_:
+            file_.seek(start)
+            data = file_.read(end - start)
+    except OSError:
+        return False
+    return len(data) == end - start and data == read_content(key, start, end)
+
+
+def link_content(key: str, destination: Path) -> bool:
+    """Makes destination (replacing whatever is there) another name of the content stored under key,
+    if there is any. Returns whether it did.
+    """
+    content_path = get_content_path(key)
+    linked_path = destination.with_name(f"{destination.name}.content")
+    try:
+        content_stat = content_path.stat()
+        # Renaming one name of a file over another of the same file does nothing, which would leave linked_path
+        if destination.exists() and samestat(content_stat, destination.stat()):
+            return True
+        link(content_path, linked_path)
+        linked_path.replace(destination)
+    except OSError:
+        linked_path.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def add_content(path: Path, key: str) -> None:
+    """Adds a finished upload to the store. If the same content is stored already, path is swapped for
+    another name of it instead, freeing the duplicate's blocks. Stored content is made read-only, since a
+    change through any of its names would show up under all of them.
+    Where no link can be made (another filesystem, or too many links), path is simply left as it is.
+    """
+    content_path = get_content_path(key)
+    try:
+        content_path.parent.mkdir(parents=True, exist_ok=True)
+        link(path, content_path)
+    except FileExistsError:
+        if not link_content(key, path):
+            return
+    except OSError:
+        return
+    content_path.chmod(content_path.stat().st_mode & 0o555)
+
+
+def sweep_content() -> int:
+    """Removes stored content that is not linked to from anywhere else any more, returning how many were."""
+    removed = 0
+    with sweep_lock:
+        try:
+            prefixes = [entry.path for entry in scandir(get_content_directory()) if entry.is_dir()]
+        except OSError:
+            return 0
+        for prefix in prefixes:
+            try:
+                with scandir(prefix) as entries:
+                    for entry in entries:
+                        if entry.stat(follow_symlinks=False).st_nlink == 1:
+                            Path(entry.path).unlink(missing_ok=True)
+                            removed += 1
+            except OSError:
+                continue
+    return removed
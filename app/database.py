@@ -1,15 +1,100 @@
 """A separate module for the database to be accessed from other modules as needed."""
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, event, make_url, select
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, selectinload
 
 from .config import CONFIG
-from .objects import Base
+from .objects import Base, Share, ShareAllowedUser
+
+# Drivers used when database_uri names a synchronous one, so existing configs keep working
+ASYNC_DRIVERS: dict[str, str] = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+SYNC_DRIVERS: dict[str, str] = {"sqlite": "pysqlite", "postgresql": "psycopg2", "mysql": "pymysql"}
+SQLITE_PRAGMAS: dict[str, str] = {
+    "synchronous": "NORMAL",
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+    "cache_size": "-16000",
+}
 
 if not (database_uri := CONFIG.get("database_uri")):
     raise KeyError("database_uri not found in config")
 
-engine = create_engine(database_uri) #connect_args={"check_same_thread": False}
-factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-SessionMaker = scoped_session(factory)
-Base.metadata.create_all(bind=engine)
+
+def with_driver(url: URL, drivers: dict[str, str]) -> URL:
+    backend = url.get_backend_name()
+    return url.set(drivername=f"{backend}+{drivers.get(backend, url.get_driver_name())}")
+
+
+def is_in_memory(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+url = make_url(database_uri)
+in_memory = is_in_memory(url)
+pool_options: dict = {}
+if in_memory:
+    # Every connection would otherwise get its own empty database
+    url = url.set(database="file:vaporous?mode=memory&cache=shared", query={"uri": "true"})
+else:
+    pool_options = {
+        "pool_size": CONFIG.get("database_pool_size", 5),
+        "max_overflow": CONFIG.get("database_pool_overflow", 10),
+        "pool_recycle": 3600,
+    }
+engine = create_async_engine(with_driver(url, ASYNC_DRIVERS), **pool_options)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    if url.get_backend_name() != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    if not in_memory:
+        # Readers no longer wait for writers, and commits only fsync at checkpoints
+        cursor.execute("PRAGMA journal_mode=WAL")
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+SessionMaker = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+
+def migrate_share_whitelists(session: Session) -> None:
+    """Moves allow lists still stored in the old "$"-joined Share.user_whitelist column into ShareWhitelist."""
+    shares = session.execute(
+        select(Share).where(Share.user_whitelist.is_not(None)).options(selectinload(Share.allowed_users))
+    ).scalars()
+    for share in shares:
+        allowed = {user_id for user_id in share.user_whitelist.split("$") if user_id}
+        share.allowed_users.extend(
+            ShareAllowedUser(share_id=share.share_id, user_id=bytes.fromhex(user_id)) for user_id in allowed
+        )
+        share.user_whitelist = None
+    session.commit()
+
+
+def set_up_database() -> None:
+    """Creates and migrates the schema once at import, through a short-lived synchronous engine,
+    since this also has to work when there is no event loop yet (e.g. the control panel).
+    """
+    global memory_keepalive
+    setup_engine = create_engine(with_driver(url, SYNC_DRIVERS))
+    if in_memory:
+        # A shared in-memory database only lives as long as some connection to it is open
+        memory_keepalive = setup_engine.connect()
+    Base.metadata.create_all(bind=setup_engine)
+    # create_all skips tables that already exist, so indexes added to existing tables are created here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=setup_engine, checkfirst=True)
+    with Session(setup_engine) as session:
+        migrate_share_whitelists(session)
+    if not in_memory:
+        setup_engine.dispose()
+
+
+memory_keepalive = None
+set_up_database()
@@ -0,0 +1,34 @@
+"""Remembers work that failed recently, so it is not tried again on every request that needs it."""
+
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass, field
+from time import monotonic
+
+
+@dataclass(slots=True)
+class FailureCache:
+    """Failures by key, with when they happened. A failure is tried again after retry_seconds, since whatever
+    caused it may be gone by then, and only the most recent limit failures are kept, the oldest being forgotten.
+    """
+
+    retry_seconds: float
+    limit: int
+    failures: OrderedDict[Hashable, float] = field(default_factory=OrderedDict)
+
+    def __len__(self) -> int:
+        return len(self.failures)
+
+    def has_failed(self, key: Hashable) -> bool:
+        if (failed := self.failures.get(key)) is None:
+            return False
+        if monotonic() - failed < self.retry_seconds:
+            return True
+        del self.failures[key]
+        return False
+
+    def remember(self, key: Hashable) -> None:
+        self.failures[key] = monotonic()
+        self.failures.move_to_end(key)
+        while len(self.failures) > self.limit:
+            self.failures.popitem(last=False)
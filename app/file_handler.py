@@ -1,25 +1,185 @@
 """Module to handle file manipulation, usable from the main server as well as APIs."""
 
-import lzma
-from datetime import datetime
-from os import PathLike
+from asyncio import Semaphore, Task, create_task, gather, get_running_loop
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from errno import EXDEV
+from functools import lru_cache
+from hashlib import sha256
+from heapq import nlargest, nsmallest
+from json import dumps, loads
+from logging import getLogger
+from mimetypes import guess_type
+from os import DirEntry, PathLike, scandir, sep, stat_result as StatResult, umask
+from os.path import splitext
 from pathlib import Path
 from re import compile as regex_compile
-from typing import Optional
+from secrets import token_hex
+from stat import S_ISDIR, S_ISREG
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import monotonic
+from typing import Any, BinaryIO, Literal
 
 from fastapi import UploadFile
-from fastapi.responses import FileResponse
-from functools import lru_cache
-from sqlalchemy import select
-from typing import Literal
+from sqlalchemy import ColumnElement, and_, delete, func, literal, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
 
+from .archives import ZipMember, iter_zip
+from .compression import compress, read_xz_index
 from .config import CONFIG
+from .content_store import (
+    DIGEST_REGEX,
+    add_content,
+    get_content_key,
+    has_content,
+    hash_file,
+    is_deduplication_enabled,
+    link_content,
+    matches_content,
+    sweep_content,
+)
 from .database import SessionMaker
-from .objects import Share, User
-
+from .inotify import IN_ATTRIB, IN_DELETE, IN_ISDIR, IN_MOVED_FROM, IN_Q_OVERFLOW, SELF_EVENTS, DirectoryWatcher
+from .objects import Share, ShareAllowedUser, StoredUpload, UploadRange, User
+from .responses import DecompressedFileResponse, RangedFileResponse
+from .search import SEARCH_RESULT_LIMIT, SearchIndex, get_search_database
+from .streaming import HLS_MEDIA_TYPES, get_stream_file, prepare_stream, split_stream_path
+from .thumbnails import THUMBNAIL_TYPES, get_thumbnail
+from .tree_operations import (
+    TreeJob,
+    copy_tree,
+    get_trashed_paths,
+    get_tree_jobs,  # noqa: F401 - main and api reach it through this module
+    get_tree_size,
+    move_to_trash,
+    new_tree_job,
+    remove_tree,
+)
 
+logger = getLogger(__name__)
 safe_path_regex = regex_compile(r"\.\.+")
 
+UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+# How much of a file whose hash is declared up front has to be sent anyway, to show the client has the contents
+UPLOAD_CHALLENGE_SIZE: int = 64 * 1024
+UPLOAD_SESSION_EXPIRY: timedelta = timedelta(days=1)
+TEMPORARY_UPLOAD_PREFIX: str = ".vaporous-upload-"
+LISTING_SORT_KEYS: tuple[str, ...] = ("name", "type", "size", "mtime")
+# What get_listing_sort_key returns for each sort, so a tampered cursor can never be compared with real entries
+LISTING_CURSOR_TYPES: dict[str, tuple[type | tuple[type, ...], ...]] = {
+    "name": (str,),
+    "type": (str, str),
+    "size": (int, str),
+    "mtime": ((int, float), str),
+}
+LISTING_PAGE_SIZE: int = 200
+LISTING_CACHE_SIZE: int = CONFIG.get("listing_cache_size", 256)
+SHARE_CACHE_SIZE: int = 1024
+# Changes made by other workers can take this long to reach this one's cache, like with sessions
+SHARE_CACHE_TTL: timedelta = timedelta(seconds=CONFIG.get("share_cache_seconds", 5))
+BATCH_CONCURRENCY: int = CONFIG.get("batch_concurrency", 8)
+
+# Temporary files are created private, so finished uploads get the permissions a plain write would give them
+current_umask = umask(0o022)
+umask(current_umask)
+UPLOADED_FILE_MODE: int = 0o666 & ~current_umask
+
+# Sizes of folders, kept only while a watcher can tell when anything in them changes, including changes made
+# by other workers or outside the app. Every indexed folder is watched, and so are all the folders below it.
+directory_sizes_lock = Lock()
+directory_sizes: dict[Path, int] = {}
+# Bumped by every change to the index, so a walk that ran while something changed is not kept
+directory_sizes_generation: int = 0
+size_watcher: DirectoryWatcher | None = None
+# Paths the app just changed and already pushed the size delta up for, each until the watcher sees one event for
+# it or the time runs out, so its own inotify events do not throw the sizes above them away
+own_size_changes: OrderedDict[Path, float] = OrderedDict()
+OWN_SIZE_CHANGE_SECONDS: float = 2.0
+
+# Scans of recently listed directories, oldest first, each of which is watched while it is cached
+listing_cache_lock = Lock()
+listing_cache: OrderedDict[str, list[tuple[dict, DirEntry]]] = OrderedDict()
+listing_cache_stats: dict[str, int] = {"hits": 0, "misses": 0, "invalidations": 0}
+# Bumped by every invalidation, so a scan that ran while something changed is not cached
+listing_cache_generation: int = 0
+listing_watcher: DirectoryWatcher | None = None
+search_index: SearchIndex | None = None
+
+# Destinations that are still being compressed or copied, so nothing else can claim their names in the meantime
+pending_uploads: set[Path] = set()
+background_tasks: set[Task] = set()
+
+
+@dataclass(slots=True)
+class UploadSession:
+    """A resumable upload whose chunks may arrive in any order, possibly in parallel and at different workers.
+    Read from the Uploads and UploadRanges tables, which are what every worker goes by.
+    """
+
+    upload_id: str
+    owner: str
+    uploaded_file: Path
+    temporary_file: Path
+    size: int
+    compression: int | None
+    expires: datetime
+    received: list[tuple[int, int]] = field(default_factory=list)
+    # Set when the declared hash matched stored content, which the upload becomes a link to once the client
+    # has sent the challenge range and it matched
+    digest: str | None = None
+
+    @property
+    def offset(self) -> int:
+        """How many bytes from the start of the file have been received without gaps."""
+        if self.received and self.received[0][0] == 0:
+            return self.received[0][1]
+        return 0
+
+    @property
+    def challenge(self) -> tuple[int, int] | None:
+        """The range a client that declared the hash of stored contents has to send to get them, taken from the
+        random upload ID so the client cannot know it before the upload exists.
+        """
+        if self.digest is None:
+            return None
+        length = min(self.size, UPLOAD_CHALLENGE_SIZE)
+        start = int(self.upload_id, 16) % (self.size - length + 1)
+        return (start, start + length)
+
+    def has_range(self, start: int, end: int) -> bool:
+        return any(range_start <= start and end <= range_end for range_start, range_end in self.received)
+
+    def add_range(self, start: int, end: int) -> None:
+        ranges = sorted([*self.received, (start, end)])
+        merged = [ranges[0]]
+        for range_start, range_end in ranges[1:]:
+            if range_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+            else:
+                merged.append((range_start, range_end))
+        self.received = merged
+
+
+# A share path change left to the end of a batch: the old path and the new one, or None where it was deleted
+ShareChange = tuple[Path, Path | None]
+
+
+@dataclass
+class BatchOperation:
+    action: Literal["move", "rename", "delete"]
+    path: str
+    # The folder to move into, for a move
+    to: str | None = None
+    # The new name, for a rename
+    name: str | None = None
+
 
 def get_upload_directory() -> Path:
     if not (UPLOAD_DIRECTORY := CONFIG.get("upload_directory")):  # type: ignore
@@ -36,6 +196,52 @@ def safe_join(base: PathLike[str] | str, subfolder: PathLike[str] | str) -> Path
     return base / subfolder
 
 
+def share_subtree(share_path: PathLike[str] | str) -> ColumnElement[bool]:
+    """Matches the share on share_path and every share below it.
+    Written as a range instead of a LIKE / startswith so it is answered from the index on Share.path,
+    and so sibling names that merely start the same way are left alone.
+    """
+    share_path = str(share_path)
+    return or_(
+        Share.path == share_path,
+        and_(Share.path >= share_path + sep, Share.path < share_path + chr(ord(sep) + 1)),
+    )
+
+
+async def move_shares(engine: AsyncSession, old_path: PathLike[str] | str, new_path: PathLike[str] | str) -> None:
+    """Points every share in the old_path subtree at the same place under new_path, in a single UPDATE."""
+    await engine.execute(
+        update(Share)
+        .where(share_subtree(old_path))
+        .values(path=literal(str(new_path)) + func.substr(Share.path, len(str(old_path)) + 1))
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def delete_shares(engine: AsyncSession, share_path: PathLike[str] | str) -> None:
+    removed_shares = select(Share.share_id).where(share_subtree(share_path))
+    await engine.execute(
+        delete(ShareAllowedUser)
+        .where(ShareAllowedUser.share_id.in_(removed_shares))
+        .execution_options(synchronize_session=False)
+    )
+    await engine.execute(delete(Share).where(share_subtree(share_path)).execution_options(synchronize_session=False))
+
+
+async def apply_share_changes(changes: list[ShareChange]) -> None:
+    """Moves and deletes the shares below each changed path, in the order the paths changed, in one transaction."""
+    if not changes:
+        return
+    async with SessionMaker() as engine:
+        for old_path, new_path in changes:
+            if new_path is None:
+                await delete_shares(engine, old_path)
+            else:
+                await move_shares(engine, old_path, new_path)
+        await engine.commit()
+    forget_share_records(paths=[old_path for old_path, _ in changes])
+
+
 def get_file_type(extension: str):
     match extension:
         case ".txt" | ".pdf" | ".md" | ".rtf" | ".rst" | ".odt" | ".doc" | ".docx" | ".xls" | ".xlsx":
@@ -60,6 +266,8 @@ def create_home_folder(uuid: str) -> None:
             return
         raise FileExistsError("Collision?? Home folder already exists and is not a directory!")
     new_folder.mkdir()
+    forget_changed_path(new_folder)
+    index_path(new_folder)
 
 
 def mark_home_folder_as_deleted(uuid: str) -> None:
@@ -69,13 +277,169 @@ def mark_home_folder_as_deleted(uuid: str) -> None:
     if new_folder.exists():
         raise FileExistsError("Collision?? Deleted!!! home folder already exists!")
     home_folder.rename(new_folder)
+    forget_directory_sizes(home_folder)
+    forget_changed_path(home_folder)
+    move_indexed_path(home_folder, new_folder)
 
-@lru_cache
-def get_file_size(file_path: Path) -> str:
-    if file_path.is_dir():
-        size_bytes = sum(f.stat().st_size for f in file_path.glob("**/*") if f.is_file())
+
+def get_directory_size(directory: Path) -> int:
+    """Gets the total size in bytes of everything under a directory.
+    Each directory is only walked once, after which its size is kept up to date by the file operations in
+    this module pushing deltas up with update_directory_sizes, and forgotten when the watcher sees a change
+    anyone else made. Without a watcher nothing is kept, and every call walks the directory.
+    """
+    return walk_directory_size(directory)[0]
+
+
+def walk_directory_size(directory: Path) -> tuple[int, bool]:
+    """Returns the size of a directory, and whether it is in the index. A directory is only indexed once it
+    is watched, if nothing changed while it was walked, and if everything below it is indexed too,
+    since otherwise a change inside would go unnoticed.
+    """
+    with directory_sizes_lock:
+        if (size := directory_sizes.get(directory)) is not None:
+            return (size, True)
+        generation = directory_sizes_generation
+    watched = (watcher := size_watcher) is not None and watcher.watch(str(directory))
+    size = 0
+    with scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(TEMPORARY_UPLOAD_PREFIX):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectory_size, subdirectory_indexed = walk_directory_size(directory / entry.name)
+                size += subdirectory_size
+                watched = watched and subdirectory_indexed
+            elif entry.is_file():
+                size += entry.stat().st_size
+    with directory_sizes_lock:
+        if not watched or generation != directory_sizes_generation:
+            return (size, False)
+        return (directory_sizes.setdefault(directory, size), True)
+
+
+def start_size_watcher() -> None:
+    """Turns the folder size index on. It is only used while a watcher can catch changes made outside the app."""
+    global size_watcher
+    if size_watcher is not None:
+        return
+    if (size_watcher := DirectoryWatcher.create(on_size_event)) is not None:
+        size_watcher.start(get_running_loop())
+
+
+def stop_size_watcher() -> None:
+    global size_watcher, directory_sizes_generation
+    if size_watcher is None:
+        return
+    watcher, size_watcher = size_watcher, None
+    with directory_sizes_lock:
+        directory_sizes.clear()
+        directory_sizes_generation += 1
+    watcher.close()
+
+
+def on_size_event(directory: str, name: str, mask: int) -> None:
+    global directory_sizes_generation
+    if mask & IN_Q_OVERFLOW:
+        # Events were lost, so any size may be wrong
+        with directory_sizes_lock:
+            directory_sizes.clear()
+            directory_sizes_generation += 1
+        if (watcher := size_watcher) is not None:
+            watcher.unwatch_tree()
+    elif mask & SELF_EVENTS:
+        forget_directory_sizes(Path(directory))
+        forget_directory_sizes_above(Path(directory))
+    elif name.startswith(TEMPORARY_UPLOAD_PREFIX) or mask & IN_ATTRIB:
+        return
+    elif not is_own_size_change(Path(directory) / name):
+        if mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+            forget_directory_sizes(Path(directory) / name)
+        forget_directory_sizes_above(Path(directory) / name)
+
+
+def expect_own_size_changes(*changed_paths: Path) -> None:
+    """Notes that the app itself changed these paths and has already accounted for the change in the index."""
+    now = monotonic()
+    with directory_sizes_lock:
+        while own_size_changes and next(iter(own_size_changes.values())) <= now:
+            own_size_changes.popitem(last=False)
+        for changed_path in changed_paths:
+            own_size_changes[changed_path] = now + OWN_SIZE_CHANGE_SECONDS
+            own_size_changes.move_to_end(changed_path)
+
+
+def is_own_size_change(changed_path: Path) -> bool:
+    """Whether an event is for a change the app made itself, each of which only excuses one event."""
+    with directory_sizes_lock:
+        deadline = own_size_changes.pop(changed_path, None)
+    return deadline is not None and deadline > monotonic()
+
+
+def update_directory_sizes(changed_path: Path, delta: int) -> None:
+    """Adds delta to the indexed size of every directory above changed_path."""
+    global directory_sizes_generation
+    if not delta:
+        return
+    upload_directory = get_upload_directory()
+    with directory_sizes_lock:
+        directory_sizes_generation += 1
+        for parent in changed_path.parents:
+            if parent in directory_sizes:
+                directory_sizes[parent] += delta
+            if parent == upload_directory:
+                break
+
+
+def forget_directory_sizes(directory: Path) -> None:
+    """Drops a directory and all of its subdirectories from the size index, for when they are removed or moved,
+    and stops watching them so whatever takes their place is watched afresh.
+    """
+    global directory_sizes_generation
+    with directory_sizes_lock:
+        directory_sizes_generation += 1
+        for indexed_path in [path for path in directory_sizes if path.is_relative_to(directory)]:
+            del directory_sizes[indexed_path]
+    if (watcher := size_watcher) is not None:
+        watcher.unwatch_tree(str(directory))
+
+
+def forget_directory_sizes_above(changed_path: Path) -> None:
+    """Drops the indexed size of every directory above changed_path, for changes whose size is not known."""
+    global directory_sizes_generation
+    upload_directory = get_upload_directory()
+    with directory_sizes_lock:
+        directory_sizes_generation += 1
+        for parent in changed_path.parents:
+            directory_sizes.pop(parent, None)
+            if parent == upload_directory:
+                break
+
+
+def get_indexed_size(file_path: Path) -> int | None:
+    """The size of a file, or of a folder only if it is in the size index, so nothing is ever walked for it.
+    None means the folders above have to forget their sizes instead of adjusting them.
+    """
+    if not file_path.is_dir(follow_symlinks=False):
+        return file_path.lstat().st_size
+    with directory_sizes_lock:
+        return directory_sizes.get(file_path)
+
+
+def apply_size_change(changed_path: Path, delta: int | None) -> None:
+    if delta is None:
+        forget_directory_sizes_above(changed_path)
     else:
-        size_bytes = file_path.stat().st_size
+        update_directory_sizes(changed_path, delta)
+
+
+def get_size_bytes(file_path: Path) -> int:
+    if file_path.is_dir():
+        return get_directory_size(file_path)
+    return file_path.stat().st_size
+
+
+def format_size(size_bytes: int) -> str:
     if size_bytes < 1_000:
         return f"{size_bytes}B"
     if size_bytes < 1_000_000:
@@ -87,12 +451,265 @@ def get_file_size(file_path: Path) -> str:
     return "TB+"
 
 
+def get_file_size(file_path: Path) -> str:
+    return format_size(get_size_bytes(file_path))
+
+
+def get_listing_group(file: dict) -> int:
+    """Public directory link first, then folders, then files, whatever the sort key."""
+    match file["type"]:
+        case "public_directory":
+            return 0
+        case "dir":
+            return 1
+    return 2
+
+
+def get_listing_sort_key(file: dict, sort: str) -> tuple:
+    match sort:
+        case "type":
+            return (file["type"], file["name"])
+        case "size":
+            return (file["size_bytes"], file["name"])
+        case "mtime":
+            return (file["modified"], file["name"])
+    return (file["name"],)
+
+
+def encode_listing_cursor(file: dict, sort: str, descending: bool) -> str:
+    """Cursors carry the sort key of the last entry sent, so the next page starts right after it
+    even if entries were added or removed in the meantime.
+    """
+    cursor = [sort, descending, get_listing_group(file), *get_listing_sort_key(file, sort)]
+    return urlsafe_b64encode(dumps(cursor, separators=(",", ":")).encode()).decode()
+
+
+def decode_listing_cursor(cursor: str, sort: str, descending: bool) -> tuple[int, tuple]:
+    try:
+        cursor_sort, cursor_descending, group, *key = loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor") from None
+    if cursor_sort != sort or cursor_descending != descending:
+        raise ValueError("Cursor belongs to a different sort order")
+    key_types = LISTING_CURSOR_TYPES.get(sort, ())
+    if (
+        not isinstance(group, int)
+        or len(key) != len(key_types)
+        or not all(isinstance(value, value_type) for value, value_type in zip(key, key_types, strict=True))
+    ):
+        raise ValueError("Invalid cursor")
+    return (group, tuple(key))
+
+
+def get_file_stats(file: dict, entry: DirEntry) -> dict:
+    stat_result = entry.stat()
+    size_bytes = get_directory_size(Path(entry.path)) if file["type"] == "dir" else stat_result.st_size
+    return {"size_bytes": size_bytes, "size": format_size(size_bytes), "modified": stat_result.st_mtime}
+
+
+@lru_cache
+def get_protected_roots(public_directory: Path | None) -> frozenset[str]:
+    """Built once per public directory, so checking an entry is one set lookup on its path string."""
+    if public_directory is None:
+        return frozenset()
+    return frozenset(
+        str(public_directory / protected_path) for protected_path in CONFIG.get("protected_public_directories", [])
+    )
+
+
+def scan_directory(directory: Path, public_directory: Path | None) -> list[tuple[dict, DirEntry]] | None:
+    """Reads a directory in one scandir pass, or returns None if it is not one.
+    Types come from the DirEntry without a stat call; sizes and times are read through the DirEntry's
+    cached stat once they are needed. Nothing here depends on where the listing is viewed from,
+    so the same scan can be cached for the owner, public viewers and shares alike.
+    """
+    protected_roots = get_protected_roots(public_directory)
+    # A child can only be under a protected root if the directory already is, or if it is that root itself
+    directory_protected = any(directory.is_relative_to(root) for root in protected_roots)
+    files: list[tuple[dict, DirEntry]] = []
+    try:
+        entries = scandir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    with entries:
+        for entry in entries:
+            if entry.name.startswith(TEMPORARY_UPLOAD_PREFIX):
+                continue
+            view_name = None
+            if entry.is_dir():
+                type_ = "dir"
+            elif original := get_compressed_original(entry.name):
+                type_ = get_file_type(original.suffix)
+                view_name = original.name
+            else:
+                type_ = get_file_type(splitext(entry.name)[1])
+            file = {
+                "name": entry.name,
+                "view_name": view_name,
+                "type": type_,
+                "protected": directory_protected or entry.path in protected_roots,
+            }
+            files.append((file, entry))
+    return files
+
+
+def start_listing_watcher() -> None:
+    """Turns the listing cache on. It is only used while a watcher can catch changes made outside the app."""
+    global listing_watcher
+    if LISTING_CACHE_SIZE <= 0 or listing_watcher is not None:
+        return
+    if (listing_watcher := DirectoryWatcher.create(on_listing_event)) is not None:
+        listing_watcher.start(get_running_loop())
+
+
+def stop_listing_watcher() -> None:
+    global listing_watcher
+    if listing_watcher is None:
+        return
+    watcher, listing_watcher = listing_watcher, None
+    with listing_cache_lock:
+        listing_cache.clear()
+    watcher.close()
+
+
+def on_listing_event(directory: str, name: str, mask: int) -> None:
+    if mask & IN_Q_OVERFLOW:
+        forget_listings()
+    elif mask & SELF_EVENTS:
+        forget_listings(directory, subtree=True)
+    elif name.startswith(TEMPORARY_UPLOAD_PREFIX):
+        return
+    else:
+        forget_listings(directory)
+        if mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+            forget_listings(f"{directory}{sep}{name}", subtree=True)
+
+
+def forget_listings(directory: PathLike[str] | str | None = None, *, subtree: bool = False) -> None:
+    """Drops the cached listing of a directory, and with subtree those of everything under it too.
+    Without a directory the whole cache is dropped.
+    """
+    global listing_cache_generation
+    with listing_cache_lock:
+        listing_cache_generation += 1
+        if directory is None:
+            forgotten = list(listing_cache)
+        else:
+            key = str(directory)
+            forgotten = [
+                cached for cached in listing_cache if cached == key or (subtree and cached.startswith(key + sep))
+            ]
+        for cached in forgotten:
+            del listing_cache[cached]
+        listing_cache_stats["invalidations"] += len(forgotten)
+    if (watcher := listing_watcher) is not None:
+        for cached in forgotten:
+            watcher.unwatch(cached)
+
+
+def forget_changed_path(changed_path: Path) -> None:
+    """Drops the listings a file or folder being created, removed or renamed shows up in.
+    The watcher would catch these too, but only after the response that made the change may have been followed.
+    """
+    forget_listings(changed_path.parent)
+    forget_listings(changed_path, subtree=True)
+
+
+def get_directory_listing(directory: Path, public_directory: Path | None) -> list[tuple[dict, DirEntry]] | None:
+    """Gets a scan of a directory from the listing cache, scanning and caching it on a miss.
+    The directory is watched before it is scanned, and a scan is only kept if nothing was invalidated
+    while it ran, so a change can never be missed between the two.
+    """
+    if (watcher := listing_watcher) is None:
+        return scan_directory(directory, public_directory)
+    key = str(directory)
+    with listing_cache_lock:
+        if (cached := listing_cache.get(key)) is not None:
+            listing_cache.move_to_end(key)
+            listing_cache_stats["hits"] += 1
+            return cached
+        listing_cache_stats["misses"] += 1
+        generation = listing_cache_generation
+    if not watcher.watch(key):
+        return scan_directory(directory, public_directory)
+    scanned = scan_directory(directory, public_directory)
+    evicted: list[str] = []
+    with listing_cache_lock:
+        if scanned is not None and generation == listing_cache_generation:
+            listing_cache[key] = scanned
+            while len(listing_cache) > LISTING_CACHE_SIZE:
+                evicted.append(listing_cache.popitem(last=False)[0])
+        elif key not in listing_cache:
+            evicted.append(key)
+    for evicted_key in evicted:
+        watcher.unwatch(evicted_key)
+    return scanned
+
+
+def get_listing_cache_stats() -> dict[str, int]:
+    with listing_cache_lock:
+        return listing_cache_stats | {"size": len(listing_cache), "watching": listing_watcher is not None}
+
+
+def is_after_cursor(group: int, key: tuple, after: tuple[int, tuple], descending: bool) -> bool:
+    after_group, after_key = after
+    if group != after_group:
+        return group > after_group
+    return key < after_key if descending else key > after_key
+
+
+def select_listing_page(
+    files: list[tuple[dict, DirEntry]],
+    sort: str,
+    descending: bool,
+    after: tuple[int, tuple] | None,
+    limit: int | None,
+) -> list[tuple[dict, DirEntry]]:
+    """Picks the next page in the order (group, sort key) with one sort per group, and only a bounded heap
+    when a limit is given, so a page from a huge folder never sorts the whole folder.
+    """
+    groups: dict[int, list[tuple[tuple, tuple[dict, DirEntry]]]] = {}
+    for file, entry in files:
+        group = get_listing_group(file)
+        key = get_listing_sort_key(file, sort)
+        if after is not None and not is_after_cursor(group, key, after, descending):
+            continue
+        groups.setdefault(group, []).append((key, (file, entry)))
+    page: list[tuple[dict, DirEntry]] = []
+    for group in sorted(groups):
+        remaining = None if limit is None else limit - len(page)
+        if remaining == 0:
+            break
+        candidates = groups[group]
+        if remaining is None:
+            ordered = sorted(candidates, key=lambda candidate: candidate[0], reverse=descending)
+        elif descending:
+            ordered = nlargest(remaining, candidates, key=lambda candidate: candidate[0])
+        else:
+            ordered = nsmallest(remaining, candidates, key=lambda candidate: candidate[0])
+        page.extend(file for _, file in ordered)
+    return page
+
+
 async def list_files(
-    base: PathLike[str] | str, subfolder: Optional[PathLike[str] | str] = None, access_level: int = 0
-) -> list[dict] | None:
+    base: PathLike[str] | str,
+    subfolder: PathLike[str] | str | None = None,
+    access_level: int = 0,
+    *,
+    sort: str = "name",
+    descending: bool = False,
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> tuple[list[dict], str | None] | None:
+    """Lists a directory one page at a time, returning the page and a cursor for the next one (None on the last).
+    Raises ValueError for a cursor that does not match the sort.
+    """
     UPLOAD_DIRECTORY = get_upload_directory()
     base = UPLOAD_DIRECTORY / base
     PUBLIC_DIRECTORY: Path | None = CONFIG.get("public_directory")
+    if sort not in LISTING_SORT_KEYS:
+        raise ValueError("Unknown sort key")
+    after = decode_listing_cursor(cursor, sort, descending) if cursor else None
 
     if PUBLIC_DIRECTORY:
         PUBLIC_DIRECTORY = UPLOAD_DIRECTORY / safe_path_regex.sub(
@@ -103,7 +720,7 @@ async def list_files(
     directory_to_list = base
     if subfolder:
         directory_to_list = safe_join(base, subfolder)
-    else:
+    elif after is None:
         if (
             (directory_to_list != UPLOAD_DIRECTORY)
             and PUBLIC_DIRECTORY
@@ -120,43 +737,426 @@ async def list_files(
                     "type": "public_directory",
                 }
             )
-    if not directory_to_list.exists() or not directory_to_list.is_dir():
+    listed = await run_in_threadpool(
+        read_listing_page, directory_to_list, base, PUBLIC_DIRECTORY, sort, descending, after, limit
+    )
+    if listed is None:
         return None
-    for child in directory_to_list.iterdir():
-        is_protected = False
-        if child.is_dir():
+    page, next_cursor = listed
+    return (files + page, next_cursor)
+
+
+def read_listing_page(
+    directory: Path,
+    base: Path,
+    public_directory: Path | None,
+    sort: str,
+    descending: bool,
+    after: tuple[int, tuple] | None,
+    limit: int | None,
+) -> tuple[list[dict], str | None] | None:
+    """Runs in a worker thread, since a miss scans the directory and folder sizes may have to be walked.
+    Cached scans are never modified; every page gets its own copies of the entries it returns.
+    """
+    if (scanned := get_directory_listing(directory, public_directory)) is None:
+        return None
+    if sort in ("size", "mtime"):
+        scanned = [(file | get_file_stats(file, entry), entry) for file, entry in scanned]
+    page = select_listing_page(scanned, sort, descending, after, None if limit is None else limit + 1)
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_listing_cursor(page[-1][0], sort, descending)
+    relative_directory = directory.relative_to(base)
+    prefix = "" if relative_directory == Path(".") else f"{relative_directory}{sep}"
+    files: list[dict] = []
+    for file, entry in page:
+        files.append(
+            {
+                "name": file["name"],
+                "path": prefix + file["name"],
+                "view_path": prefix + file["view_name"] if file["view_name"] else None,
+                "type": file["type"],
+                "protected": file["protected"],
+            }
+            | (
+                {"size_bytes": file["size_bytes"], "size": file["size"], "modified": file["modified"]}
+                if "size_bytes" in file
+                else get_file_stats(file, entry)
+            )
+        )
+    return (files, next_cursor)
+
+
+def read_file_info(path: Path, relative_path: Path) -> dict | None:
+    try:
+        stat_result = path.stat()
+    except OSError:
+        return None
+    view_name = None
+    if S_ISDIR(stat_result.st_mode):
+        type_ = "dir"
+        size_bytes = get_directory_size(path)
+    else:
+        size_bytes = stat_result.st_size
+        if original := get_compressed_original(path.name):
+            type_ = get_file_type(original.suffix)
+            view_name = original.name
+        else:
+            type_ = get_file_type(path.suffix)
+    return {
+        "name": path.name,
+        "path": relative_path.as_posix(),
+        "view_path": relative_path.with_name(view_name).as_posix() if view_name else None,
+        "type": type_,
+        "size_bytes": size_bytes,
+        "size": format_size(size_bytes),
+        "modified": stat_result.st_mtime,
+        "mime_type": None if type_ == "dir" else guess_type(view_name or path.name)[0],
+    }
+
+
+async def get_file_info(base: PathLike[str] | str, file_path: PathLike[str] | str) -> dict | None:
+    """Describes one file or folder the way a listing describes its entries, plus its media type."""
+    share_path = safe_join(base, file_path)
+    relative_path = share_path.relative_to(safe_path_regex.sub(".", str(base)))
+    return await run_in_threadpool(read_file_info, get_upload_directory() / share_path, relative_path)
+
+
+def start_search_index() -> None:
+    """Opens the search index and starts keeping it up to date, unless search is turned off or SQLite lacks FTS5."""
+    global search_index
+    if search_index is not None or not CONFIG.get("search", True):
+        return
+    search_index = SearchIndex.create(get_search_database(), get_upload_directory(), TEMPORARY_UPLOAD_PREFIX)
+    if search_index is not None:
+        search_index.start()
+
+
+def stop_search_index() -> None:
+    global search_index
+    if search_index is None:
+        return
+    index, search_index = search_index, None
+    index.close()
+
+
+def index_path(path: Path) -> None:
+    if search_index is not None:
+        search_index.add(path)
+
+
+def unindex_path(path: Path) -> None:
+    if search_index is not None:
+        search_index.remove(path)
+
+
+def move_indexed_path(path: Path, new_path: Path) -> None:
+    if search_index is not None:
+        search_index.move(path, new_path)
+
+
+async def search_files(
+    base: PathLike[str] | str,
+    query: str,
+    subfolder: PathLike[str] | str | None = None,
+    *,
+    limit: int = SEARCH_RESULT_LIMIT,
+) -> list[dict] | None:
+    """Finds files and folders below base (or below subfolder of it) by name, and by their contents when those
+    are indexed. Paths are relative to base, as in a listing. Returns None when there is no search index.
+    """
+    if (index := search_index) is None:
+        return None
+    base = get_upload_directory() / safe_path_regex.sub(".", str(base))
+    directory = safe_join(base, subfolder) if subfolder else base
+    hits = await run_in_threadpool(index.search, directory, query, limit)
+    base_key = index.get_key(base)
+    files: list[dict] = []
+    for key, is_dir, size_bytes, modified, in_contents in hits:
+        path = key[len(base_key) + 1 :]
+        folder, _, name = path.rpartition(sep)
+        view_name = None
+        if is_dir:
             type_ = "dir"
+        elif original := get_compressed_original(name):
+            type_ = get_file_type(original.suffix)
+            view_name = original.name
         else:
-            type_ = get_file_type(child.suffix)
-        for protected_path in CONFIG.get("protected_public_directories", []):
-            if child.is_relative_to(PUBLIC_DIRECTORY / protected_path):
-                is_protected = True
-                break
+            type_ = get_file_type(splitext(name)[1])
+        prefix = f"{folder}{sep}" if folder else ""
         files.append(
             {
-                "name": child.name,
-                "path": str(child.relative_to(base)),
+                "name": name,
+                "path": path,
+                "view_path": prefix + view_name if view_name else None,
+                "folder": folder,
                 "type": type_,
-                "protected": is_protected,
-                "size": get_file_size(child),
+                "size_bytes": size_bytes,
+                "size": "" if is_dir else format_size(size_bytes),
+                "modified": modified,
+                "in_contents": in_contents,
             }
         )
-    files.sort(key=lambda f: f.get("name", ""))
-    files.sort(key=lambda f: f.get("type") == "dir", reverse=True)
-    files.sort(key=lambda f: f.get("type") == "public_directory", reverse=True)
+    # Matching names first, and shallower ones before deeper ones
+    files.sort(key=lambda file: (file["in_contents"], file["path"].count(sep), file["path"]))
     return files
 
 
 async def get_file(
-    base: PathLike[str] | str, file_path: PathLike[str] | str, direct: bool = False
-) -> FileResponse | Literal["||video||"] | None:
+    base: PathLike[str] | str,
+    file_path: PathLike[str] | str,
+    direct: bool = False,
+    request_headers: Headers | None = None,
+) -> RangedFileResponse | Literal["||video||"] | None:
+    """Gets a file to serve. If the file only exists as a compressed upload (<name>.xz),
+    its original contents are served instead, decompressed on the fly.
+    """
     file_path = get_upload_directory() / safe_join(base, file_path)
-    if not file_path.exists() or not file_path.is_file():
+    compressed_file: Path | None = None
+    try:
+        stat_result = file_path.stat()
+    except OSError:
+        compressed_file = file_path.with_name(f"{file_path.name}.xz")
+        try:
+            stat_result = compressed_file.stat()
+        except OSError:
+            return None
+    if not S_ISREG(stat_result.st_mode):
         return None
     if not direct:
         if get_file_type(file_path.suffix) == "video":
             return "||video||"
-    return FileResponse(file_path)
+    if compressed_file:
+        try:
+            streams = read_xz_index(compressed_file, stat_result.st_mtime_ns, stat_result.st_size)
+        except (OSError, ValueError, IndexError):
+            return None
+        return DecompressedFileResponse(
+            compressed_file,
+            request_headers or Headers(),
+            streams=streams,
+            stat_result=stat_result,
+            media_type=guess_type(file_path.name)[0],
+        )
+    return RangedFileResponse(file_path, request_headers or Headers(), stat_result=stat_result)
+
+
+async def get_file_thumbnail(
+    base: PathLike[str] | str, file_path: PathLike[str] | str, request_headers: Headers | None = None
+) -> RangedFileResponse | None:
+    """Gets a thumbnail of an image, or a poster frame of a video, to serve, making it first if there is none yet.
+    Like get_file, a compressed upload is found under its original name.
+    """
+    file_path = get_upload_directory() / safe_join(base, file_path)
+    if (kind := get_file_type(file_path.suffix)) not in THUMBNAIL_TYPES:
+        return None
+    source = file_path
+    try:
+        stat_result = source.stat()
+    except OSError:
+        source = file_path.with_name(f"{file_path.name}.xz")
+        try:
+            stat_result = source.stat()
+        except OSError:
+            return None
+    if not S_ISREG(stat_result.st_mode):
+        return None
+    if (thumbnail := await get_thumbnail(source, stat_result, kind, compressed=source != file_path)) is None:
+        return None
+    return RangedFileResponse(thumbnail, request_headers or Headers(), media_type="image/jpeg")
+
+
+def prepare_video_stream(base: PathLike[str] | str, file_path: PathLike[str] | str) -> bool:
+    """Whether a video can be streamed in HLS renditions, starting to transcode it if it cannot yet."""
+    file_path = get_upload_directory() / safe_join(base, file_path)
+    try:
+        stat_result = file_path.stat()
+    except OSError:
+        return False
+    return S_ISREG(stat_result.st_mode) and prepare_stream(file_path, stat_result)
+
+
+def get_video_stream_file(
+    base: PathLike[str] | str, stream_path: str, request_headers: Headers | None = None
+) -> RangedFileResponse | None:
+    """Gets a playlist or segment of a video's HLS stream to serve, from <video path>/<stream file>."""
+    if (split := split_stream_path(stream_path)) is None:
+        return None
+    video_path, stream_file = split
+    file_path = get_upload_directory() / safe_join(base, video_path)
+    try:
+        stat_result = file_path.stat()
+    except OSError:
+        return None
+    if (stream_file_path := get_stream_file(file_path, stat_result, stream_file)) is None:
+        return None
+    try:
+        return RangedFileResponse(
+            stream_file_path, request_headers or Headers(), media_type=HLS_MEDIA_TYPES[stream_file_path.suffix]
+        )
+    except FileNotFoundError:
+        return None
+
+
+def queue_thumbnail(uploaded_file: Path) -> None:
+    """Starts making the thumbnail of a finished upload in the background, so it is ready when first listed."""
+    original = get_compressed_original(uploaded_file.name) or uploaded_file
+    if (kind := get_file_type(original.suffix)) not in THUMBNAIL_TYPES:
+        return
+    compressed = original is not uploaded_file
+    task = create_task(get_thumbnail(uploaded_file, uploaded_file.stat(), kind, compressed))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def get_zip_member(path: Path, name: str, stat_result: StatResult) -> ZipMember | None:
+    """Describes a file for a ZIP download. Compressed uploads go in under their original name and contents."""
+    if not S_ISREG(stat_result.st_mode):
+        return None
+    if original := get_compressed_original(path.name):
+        try:
+            streams = read_xz_index(path, stat_result.st_mtime_ns, stat_result.st_size)
+        except (OSError, ValueError, IndexError):
+            return None
+        size = streams[-1].uncompressed_offset + streams[-1].uncompressed_size if streams else 0
+        name = str(Path(name).with_name(original.name))
+        file_type = get_file_type(original.suffix)
+    else:
+        size = stat_result.st_size
+        file_type = get_file_type(path.suffix)
+    return ZipMember(
+        name=name,
+        modified=stat_result.st_mtime,
+        path=path,
+        size=size,
+        decompress=original is not None,
+        store=file_type in ("image", "video", "audio", "archive"),
+    )
+
+
+def iter_zip_members(directory: Path, selected: list[str] | None = None) -> Iterator[ZipMember]:
+    """Walks a folder, or only the selected names inside it, for a ZIP download one directory at a time,
+    so the first bytes go out before a large tree has been read. Symlinked folders are not followed.
+    """
+    pending: list[tuple[Path, str]] = []
+    if selected is None:
+        pending.append((directory, ""))
+    for name in dict.fromkeys(selected or ()):
+        path = directory / name
+        try:
+            stat_result = path.lstat()
+        except OSError:
+            continue
+        if S_ISDIR(stat_result.st_mode):
+            yield ZipMember(name=f"{name}/", modified=stat_result.st_mtime)
+            pending.append((path, f"{name}/"))
+        elif member := get_zip_member(path, name, stat_result):
+            yield member
+    while pending:
+        folder, prefix = pending.pop()
+        try:
+            with scandir(folder) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith(TEMPORARY_UPLOAD_PREFIX):
+                continue
+            try:
+                stat_result = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if S_ISDIR(stat_result.st_mode):
+                yield ZipMember(name=f"{prefix}{entry.name}/", modified=stat_result.st_mtime)
+                pending.append((Path(entry.path), f"{prefix}{entry.name}/"))
+            elif member := get_zip_member(Path(entry.path), prefix + entry.name, stat_result):
+                yield member
+
+
+def get_zip(
+    base: PathLike[str] | str,
+    file_path: PathLike[str] | str | None,
+    selected: list[str] | None = None,
+    root_name: str = "files",
+) -> tuple[Iterator[bytes], str] | None:
+    """Gets a ZIP archive of a folder, of some names inside it, or of a single file, as a stream of bytes and
+    a name to download it as. Nothing is read until the stream is iterated.
+    """
+    path = get_upload_directory() / safe_join(base, file_path or ".")
+    name = path.name if file_path else root_name
+    if path.is_dir():
+        if selected is not None:
+            # Only names of things directly inside the folder
+            selected = [item for item in selected if Path(item).name == item and item not in ("", ".", "..")]
+        return (iter_zip(iter_zip_members(path, selected)), f"{name}.zip")
+    if selected is not None:
+        return None
+    try:
+        stat_result = path.stat()
+    except OSError:
+        return None
+    if (member := get_zip_member(path, path.name, stat_result)) is None:
+        return None
+    return (iter_zip([member]), f"{Path(member.name).stem}.zip")
+
+
+def get_compressed_original(filename: str) -> Path | None:
+    """Gets the original name of a compressed upload, if it was a file that can be viewed."""
+    original = Path(filename.removesuffix(".xz"))
+    if filename.endswith(".xz") and original.suffix and get_file_type(original.suffix) not in ("archive", "file"):
+        return original
+    return None
+
+
+@dataclass(slots=True)
+class BackgroundSweep:
+    """Background work that goes over everything each time, like sweeping a directory for leftovers.
+    Scheduling it while it is running makes it run once more afterwards, since the running pass may have
+    gone past whatever asked for it already.
+    """
+
+    work: Callable[[], Awaitable[None]]
+    task: Task | None = None
+    requested: bool = False
+
+    def schedule(self) -> None:
+        self.requested = True
+        if self.task is None or self.task.done():
+            self.task = create_task(self.run())
+
+    async def run(self) -> None:
+        while self.requested:
+            self.requested = False
+            await self.work()
+
+
+async def sweep_unlinked_content() -> None:
+    await run_in_threadpool(sweep_content)
+
+
+async def reap_trash() -> None:
+    for trashed_path in await run_in_threadpool(get_trashed_paths):
+        try:
+            await run_in_threadpool(remove_tree, trashed_path)
+        except OSError:
+            continue
+    schedule_content_sweep()
+
+
+content_sweep = BackgroundSweep(sweep_unlinked_content)
+trash_reaper = BackgroundSweep(reap_trash)
+
+
+def schedule_content_sweep() -> None:
+    """Sweeps content nothing links to any more out of the content store."""
+    if is_deduplication_enabled():
+        content_sweep.schedule()
+
+
+def schedule_trash_reaping() -> None:
+    """Removes whatever deletes have moved into the trash."""
+    trash_reaper.schedule()
 
 
 async def upload_files(
@@ -164,47 +1164,401 @@ async def upload_files(
     file_path: PathLike[str] | str,
     files: list[UploadFile],
     *,
-    compression: Optional[int] = None,
+    compression: int | None = None,
+    owner: str | None = None,
 ) -> list[tuple[bool, str]]:
+    """owner is whom get_tree_jobs reports the compression of the uploads to, if they are compressed."""
     results = []
     file_path = get_upload_directory() / safe_join(base, file_path)
     for file_object in files:
-        filename = file_object.filename
-        if not filename:
-            results.append((False, "No filename??"))
+        success, destination = check_upload_destination(file_path, file_object.filename, compression)
+        if not success:
+            results.append((False, str(destination)))
             continue
-        filename = safe_path_regex.sub(".", filename)
-        if (file_path / filename).exists():
-            results.append((False, "Already exists!"))
-            continue
-        if compression:
-            with lzma.open(file_path / f"{filename}.xz", "wb", preset=compression) as compressed_file:
-                compressed_file.write(await file_object.read())
-        else:
-            (file_path / filename).write_bytes(await file_object.read())
-        results.append((True, "Success!"))
+        uploaded_file = Path(destination)
+        temporary_file, digest = await stream_to_temporary_file(file_object, file_path)
+        results.append(store_upload(temporary_file, uploaded_file, compression, digest, owner or str(base)))
     return results
 
 
-async def delete_file(base: PathLike[str] | str, file_path: PathLike[str] | str) -> tuple[bool, str]:
+def check_upload_destination(
+    directory: Path, filename: str | None, compression: int | None = None
+) -> tuple[bool, Path | str]:
+    if not filename:
+        return (False, "No filename??")
+    filename = safe_path_regex.sub(".", filename)
+    uploaded_file = directory / (f"{filename}.xz" if compression else filename)
+    if uploaded_file.parent != directory:
+        return (False, "Invalid filename!")
+    if (directory / filename).exists() or uploaded_file.exists() or uploaded_file in pending_uploads:
+        return (False, "Already exists!")
+    return (True, uploaded_file)
+
+
+def store_upload(
+    temporary_file: Path,
+    uploaded_file: Path,
+    compression: int | None = None,
+    digest: str | None = None,
+    owner: str = "",
+) -> tuple[bool, str]:
+    """digest is the SHA-256 of what was uploaded, when uploads are deduplicated. A compressed upload is
+    finished in the background, as a job whose outcome get_tree_jobs(owner) reports.
+    """
+    if not compression:
+        return place_upload(temporary_file, uploaded_file, digest)
+    pending_uploads.add(uploaded_file)
+    job = new_tree_job(owner, temporary_file, uploaded_file, temporary_file.stat().st_size, "compress")
+    task = create_task(compress_upload(job, compression, digest))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return (True, f"Uploaded! Compressing in the background as job {job.job_id}...")
+
+
+def new_temporary_file(directory: Path):
+    return NamedTemporaryFile(dir=directory, prefix=TEMPORARY_UPLOAD_PREFIX, delete=False)
+
+
+def write_upload_data(file_object: BinaryIO, data: bytes, content_hash: Any) -> None:
+    file_object.write(data)
+    if content_hash is not None:
+        content_hash.update(data)
+
+
+async def stream_to_temporary_file(file_object: UploadFile, directory: Path) -> tuple[Path, str | None]:
+    """Copies an upload into a hidden file in the destination directory one chunk at a time,
+    so memory use stays the same no matter how big the upload is.
+    The partial file is removed if the copy fails or is cancelled part-way.
+    Returns the file, and the SHA-256 of its contents when uploads are deduplicated.
+    """
+    temporary_file = new_temporary_file(directory)
+    temporary_path = Path(temporary_file.name)
+    content_hash = sha256() if is_deduplication_enabled() else None
+    try:
+        with temporary_file:
+            while chunk := await file_object.read(UPLOAD_CHUNK_SIZE):
+                await run_in_threadpool(write_upload_data, temporary_file, chunk, content_hash)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+    return (temporary_path, content_hash.hexdigest() if content_hash is not None else None)
+
+
+async def compress_upload(job: TreeJob, compression: int, digest: str | None = None) -> None:
+    """Compresses a finished upload (job.source) in the compression process pool, then moves it into place.
+    Contents compressed at the same level before are linked to instead of being compressed again.
+    If it cannot be compressed the upload is kept as it is, and if its name was taken in the meantime it is
+    kept under another one, so an upload that was already accepted is never lost.
+    """
+    temporary_file, uploaded_file = job.source, job.destination
+    compressed_path: Path | None = None
+    try:
+        with new_temporary_file(uploaded_file.parent) as compressed_file:
+            compressed_path = Path(compressed_file.name)
+        content_key = get_content_key(digest, compression) if digest else None
+        if content_key is None or not link_content(content_key, compressed_path):
+            await compress(temporary_file, compressed_path, compression)
+        placed_file = place_upload_as_free_name(compressed_path, uploaded_file, content_key)
+        job.add_progress(job.total_bytes)
+        job.finish(True, f"Compressed into {placed_file.name}")
+    except Exception:
+        logger.exception("Compressing %s failed", uploaded_file)
+        try:
+            placed_file = place_upload_as_free_name(temporary_file, uploaded_file.with_suffix(""), digest)
+        except OSError:
+            logger.exception("Keeping %s uncompressed failed, it is left at %s", uploaded_file, temporary_file)
+            job.finish(False, "Compressing failed, and so did keeping the upload uncompressed")
+        else:
+            job.finish(False, f"Compressing failed, kept uncompressed as {placed_file.name}")
+    finally:
+        if compressed_path is not None:
+            compressed_path.unlink(missing_ok=True)
+        temporary_file.unlink(missing_ok=True)
+        pending_uploads.discard(uploaded_file)
+
+
+def place_upload_as_free_name(temporary_file: Path, uploaded_file: Path, content_key: str | None = None) -> Path:
+    """Places an upload that has already been accepted, under "name (2).ext" and so on if its name is taken."""
+    candidate, number = uploaded_file, 1
+    while True:
+        if not candidate.exists():
+            success, _ = place_upload(temporary_file, candidate, content_key, keep_on_conflict=True)
+            if success:
+                return candidate
+        number += 1
+        candidate = uploaded_file.with_name(f"{uploaded_file.stem} ({number}){uploaded_file.suffix}")
+
+
+def place_upload(
+    temporary_file: Path, uploaded_file: Path, content_key: str | None = None, *, keep_on_conflict: bool = False
+) -> tuple[bool, str]:
+    """Atomically moves a finished upload into place, so nobody ever sees a partial file.
+    With a content_key, the upload is added to (or swapped for its copy in) the content store first.
+    If the name is already taken the upload is removed, unless keep_on_conflict is set.
+    """
+    if uploaded_file.exists():
+        if not keep_on_conflict:
+            temporary_file.unlink()
+        return (False, "Already exists!")
+    temporary_file.chmod(UPLOADED_FILE_MODE)
+    if content_key is not None:
+        add_content(temporary_file, content_key)
+    expect_own_size_changes(uploaded_file)
+    temporary_file.rename(uploaded_file)
+    update_directory_sizes(uploaded_file, uploaded_file.stat().st_size)
+    forget_changed_path(uploaded_file)
+    index_path(uploaded_file)
+    queue_thumbnail(uploaded_file)
+    return (True, "Success!")
+
+
+async def delete_upload_sessions(engine: AsyncSession, upload_ids: list[str]) -> int:
+    """Returns how many of the uploads were still there to delete."""
+    await engine.execute(delete(UploadRange).where(UploadRange.upload_id.in_(upload_ids)))
+    result = await engine.execute(delete(StoredUpload).where(StoredUpload.upload_id.in_(upload_ids)))
+    return result.rowcount
+
+
+async def expire_upload_sessions() -> None:
+    async with SessionMaker() as engine:
+        expired = (
+            await engine.execute(
+                select(StoredUpload.upload_id, StoredUpload.temporary_file).where(
+                    StoredUpload.expires < datetime.now()
+                )
+            )
+        ).all()
+        if not expired:
+            return
+        await delete_upload_sessions(engine, [upload_id for upload_id, _ in expired])
+        await engine.commit()
+    for _, temporary_file in expired:
+        Path(temporary_file).unlink(missing_ok=True)
+
+
+async def get_upload_session(upload_id: str, owner: str) -> UploadSession | None:
+    async with SessionMaker() as engine:
+        stored: StoredUpload | None = await engine.get(StoredUpload, upload_id)
+        if not stored or stored.owner != owner:
+            return None
+        if datetime.now() > stored.expires:
+            await delete_upload_sessions(engine, [upload_id])
+            await engine.commit()
+            Path(stored.temporary_file).unlink(missing_ok=True)
+            return None
+        ranges = await engine.execute(
+            select(UploadRange.start, UploadRange.end).where(UploadRange.upload_id == upload_id)
+        )
+        upload = UploadSession(
+            upload_id=upload_id,
+            owner=owner,
+            uploaded_file=Path(stored.uploaded_file),
+            temporary_file=Path(stored.temporary_file),
+            size=stored.size,
+            compression=stored.compression,
+            expires=stored.expires,
+            digest=stored.digest,
+        )
+        for start, end in ranges:
+            upload.add_range(start, end)
+    return upload
+
+
+async def create_upload_session(
+    base: PathLike[str] | str,
+    file_path: PathLike[str] | str,
+    filename: str,
+    size: int,
+    owner: str,
+    *,
+    compression: int | None = None,
+    content_sha256: str | None = None,
+) -> tuple[bool, str]:
+    """Starts a resumable upload.
+    The file is preallocated in a hidden temporary file, chunks are written into it at their offsets,
+    and it only appears under its real name once finish_upload_session is called.
+    If the client declares a SHA-256 of contents that are stored already, the upload is complete as soon as
+    the client has sent the challenge range of the session and it matched them.
+    """
+    await expire_upload_sessions()
+    if size < 0:
+        return (False, "Invalid file size!")
+    directory = get_upload_directory() / safe_join(base, file_path)
+    if not directory.is_dir():
+        return (False, "Upload folder does not exist!")
+    success, destination = check_upload_destination(directory, filename, compression)
+    if not success:
+        return (False, str(destination))
+    digest = content_sha256.lower() if content_sha256 and is_deduplication_enabled() else None
+    # Only the uncompressed size can be compared, since compressed contents are stored compressed
+    if (
+        not size
+        or digest is None
+        or not DIGEST_REGEX.fullmatch(digest)
+        or not has_content(get_content_key(digest, compression), None if compression else size)
+    ):
+        digest = None
+    with new_temporary_file(directory) as temporary_file:
+        temporary_path = Path(temporary_file.name)
+        temporary_file.truncate(size)
+    upload_id = token_hex(16)
+    async with SessionMaker() as engine:
+        engine.add(
+            StoredUpload(
+                upload_id=upload_id,
+                owner=owner,
+                uploaded_file=str(destination),
+                temporary_file=str(temporary_path),
+                size=size,
+                compression=compression,
+                expires=datetime.now() + UPLOAD_SESSION_EXPIRY,
+                digest=digest,
+            )
+        )
+        await engine.commit()
+    return (True, upload_id)
+
+
+async def write_upload_chunk(
+    upload_id: str, owner: str, offset: int, chunks: AsyncIterator[bytes]
+) -> tuple[bool, str | int]:
+    """Writes a chunk at its offset, a buffer at a time in the threadpool so the disk never holds up the event
+    loop, and records the range it covered once all of it is written.
+    """
+    if not (upload := await get_upload_session(upload_id, owner)):
+        return (False, "Upload does not exist!")
+    if offset < 0 or offset > upload.size:
+        return (False, "Offset is outside of the file!")
+    if upload.digest is not None and upload.offset == upload.size:
+        # Shown to be stored contents, which it becomes a link to when it is finished
+        return (True, upload.offset)
+    position = offset
+    buffer = bytearray()
+    with await run_in_threadpool(open, upload.temporary_file, "r+b") as temporary_file:
+        temporary_file.seek(offset)
+        async for chunk in chunks:
+            if position + len(buffer) + len(chunk) > upload.size:
+                return (False, "Chunk goes past the end of the file!")
+            buffer += chunk
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await run_in_threadpool(temporary_file.write, buffer)
+                position += len(buffer)
+                buffer = bytearray()
+        if buffer:
+            await run_in_threadpool(temporary_file.write, buffer)
+            position += len(buffer)
+    async with SessionMaker() as engine:
+        if position > offset:
+            engine.add(UploadRange(upload_id=upload_id, start=offset, end=position))
+        await engine.execute(
+            update(StoredUpload)
+            .where(StoredUpload.upload_id == upload_id)
+            .values(expires=datetime.now() + UPLOAD_SESSION_EXPIRY)
+        )
+        await engine.commit()
+    if position > offset:
+        upload.add_range(offset, position)
+        if (challenge := upload.challenge) is not None and upload.has_range(*challenge):
+            await check_declared_hash(upload)
+    return (True, upload.offset)
+
+
+async def check_declared_hash(upload: UploadSession) -> None:
+    """Once the challenge range has arrived, either takes the upload as complete, if the range matches the
+    stored contents of the declared hash, or drops the declared hash so the upload goes on like any other.
+    """
+    if upload.digest is None or (challenge := upload.challenge) is None:
+        return
+    content_key = get_content_key(upload.digest, upload.compression)
+    matched = await run_in_threadpool(matches_content, content_key, upload.temporary_file, *challenge)
+    async with SessionMaker() as engine:
+        if matched:
+            engine.add(UploadRange(upload_id=upload.upload_id, start=0, end=upload.size))
+        else:
+            await engine.execute(
+                update(StoredUpload).where(StoredUpload.upload_id == upload.upload_id).values(digest=None)
+            )
+        await engine.commit()
+    if matched:
+        upload.add_range(0, upload.size)
+    else:
+        upload.digest = None
+
+
+async def finish_upload_session(upload_id: str, owner: str) -> tuple[bool, str]:
+    if not (upload := await get_upload_session(upload_id, owner)):
+        return (False, "Upload does not exist!")
+    if upload.size and upload.received != [(0, upload.size)]:
+        return (False, "Upload is not complete yet!")
+    if upload.digest is not None and (challenge := upload.challenge) is not None:
+        content_key = get_content_key(upload.digest, upload.compression)
+        if await run_in_threadpool(matches_content, content_key, upload.temporary_file, *challenge):
+            linked = link_content(content_key, upload.temporary_file)
+        else:
+            # With the stored contents still there the challenge never matched, so all of it was sent like for any
+            # other upload. Without them there is no telling.
+            linked = False
+            if has_content(content_key):
+                upload.digest = None
+        if upload.digest is not None and not linked:
+            # The stored contents were swept in the meantime, so the rest of the upload is needed after all
+            async with SessionMaker() as engine:
+                await engine.execute(delete(UploadRange).where(UploadRange.upload_id == upload_id))
+                await engine.execute(
+                    update(StoredUpload).where(StoredUpload.upload_id == upload_id).values(digest=None)
+                )
+                await engine.commit()
+            return (False, "Upload is not complete yet!")
+    async with SessionMaker() as engine:
+        # Only one of several finishes racing each other gets to place the file
+        if not await delete_upload_sessions(engine, [upload_id]):
+            return (False, "Upload does not exist!")
+        await engine.commit()
+    if upload.digest is not None:
+        content_key = get_content_key(upload.digest, upload.compression)
+        return place_upload(upload.temporary_file, upload.uploaded_file, content_key)
+    digest = await run_in_threadpool(hash_file, upload.temporary_file) if is_deduplication_enabled() else None
+    return store_upload(upload.temporary_file, upload.uploaded_file, upload.compression, digest, owner)
+
+
+async def cancel_upload_session(upload_id: str, owner: str) -> tuple[bool, str]:
+    if not (upload := await get_upload_session(upload_id, owner)):
+        return (False, "Upload does not exist!")
+    async with SessionMaker() as engine:
+        await delete_upload_sessions(engine, [upload_id])
+        await engine.commit()
+    upload.temporary_file.unlink(missing_ok=True)
+    return (True, "Upload cancelled")
+
+
+async def delete_file(
+    base: PathLike[str] | str, file_path: PathLike[str] | str, share_changes: list[ShareChange] | None = None
+) -> tuple[bool, str]:
+    """share_changes collects the shares to remove instead of removing them straight away, as run_batch does."""
     share_path = safe_join(base, file_path)
     file_path = get_upload_directory() / share_path
     if not file_path.exists():
         return (False, "Cannot delete nonexistent file")
+    # Walking a folder that is not indexed would make deleting it as slow as the folder is big
+    size_bytes = get_indexed_size(file_path)
     if file_path.is_dir():
-        for root, directories, files in file_path.walk():
-            for file_ in files:
-                (root / file_).unlink()
-            for directory in directories:
-                (root / directory).rmdir()
-        file_path.rmdir()
+        # Its own removal would otherwise be seen as changes inside it
+        forget_directory_sizes(file_path)
+    expect_own_size_changes(file_path)
+    # Moving into the trash is a single rename however big the folder is, and the folder is removed from there
+    # in the background. Without the trash (or across filesystems) it is removed before answering.
+    if CONFIG.get("background_deletes", True) and move_to_trash(file_path) is not None:
+        schedule_trash_reaping()
     else:
-        file_path.unlink()
-    with SessionMaker() as engine:
-        shares = engine.execute(select(Share).filter(Share.path.startswith(str(share_path)))).scalars()
-        for share in shares:
-            engine.delete(share)
-        engine.commit()
+        await run_in_threadpool(remove_tree, file_path)
+        schedule_content_sweep()
+    apply_size_change(file_path, None if size_bytes is None else -size_bytes)
+    forget_changed_path(file_path)
+    unindex_path(file_path)
+    if share_changes is None:
+        await apply_share_changes([(share_path, None)])
+    else:
+        share_changes.append((share_path, None))
     return (True, "File deleted")
 
 
@@ -217,10 +1571,18 @@ async def new_folder(base: PathLike[str] | str, file_path: PathLike[str] | str,
     if new_folder.exists():
         return (False, "Name already exists!")
     new_folder.mkdir()
+    expect_own_size_changes(new_folder)
+    forget_changed_path(new_folder)
+    index_path(new_folder)
     return (True, "Folder created!")
 
 
-async def rename(base: PathLike[str] | str, file_path: PathLike[str] | str, new_name: str) -> tuple[bool, str]:
+async def rename(
+    base: PathLike[str] | str,
+    file_path: PathLike[str] | str,
+    new_name: str,
+    share_changes: list[ShareChange] | None = None,
+) -> tuple[bool, str]:
     share_path = safe_join(base, file_path)
     file_path = get_upload_directory() / share_path
     if not file_path.exists():
@@ -232,63 +1594,319 @@ async def rename(base: PathLike[str] | str, file_path: PathLike[str] | str, new_
     if new_path.exists():
         return (False, "Name already exists!")
     file_path.rename(new_path)
-    with SessionMaker() as engine:
-        shares = engine.execute(select(Share).filter(Share.path.startswith(str(share_path)))).scalars()
-        for share in shares:
-            share.path = share.path.replace(str(share_path), str(share_path.with_stem(new_name)))
-        engine.commit()
+    forget_directory_sizes(file_path)
+    expect_own_size_changes(file_path, new_path)
+    forget_changed_path(file_path)
+    move_indexed_path(file_path, new_path)
+    if share_changes is None:
+        await apply_share_changes([(share_path, share_path.with_name(new_name))])
+    else:
+        share_changes.append((share_path, share_path.with_name(new_name)))
     return (True, "Renamed!")
 
 
 async def move(
-    base: PathLike[str] | str, to_base: PathLike[str] | str, file_path: PathLike[str] | str, to: PathLike[str] | str
+    base: PathLike[str] | str,
+    to_base: PathLike[str] | str,
+    file_path: PathLike[str] | str,
+    to: PathLike[str] | str,
+    owner: str | None = None,
+    share_changes: list[ShareChange] | None = None,
 ) -> tuple[bool, str]:
-    file_path = get_upload_directory() / safe_join(base, file_path)
-    to = get_upload_directory() / safe_join(to_base, to) / file_path.name
+    """Moves a file or folder into another folder. Across filesystems that cannot be a rename, so it is
+    copied in the background instead, as a job whose progress get_tree_jobs(owner) reports.
+    """
+    share_path = safe_join(base, file_path)
+    new_share_path = safe_join(to_base, to) / share_path.name
+    file_path = get_upload_directory() / share_path
+    to = get_upload_directory() / new_share_path
     if file_path == to:
         return (True, "Already here!")
-    if to.exists():
+    if to.exists() or to in pending_uploads:
         return (False, "A file or folder with the same name already exists here!")
-    file_path.rename(to)
+    size_bytes = get_indexed_size(file_path)
+    try:
+        file_path.rename(to)
+    except OSError as error:
+        if error.errno != EXDEV:
+            return (False, "Unable to move here!")
+        # The job measures what it copies in the background when the size is not indexed
+        job = new_tree_job(owner or str(base), file_path, to, size_bytes or 0)
+        pending_uploads.add(to)
+        task = create_task(copy_across_filesystems(job, share_path, new_share_path))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        return (True, "Moving in the background...")
+    expect_own_size_changes(file_path, to)
+    await finish_move(share_path, new_share_path, size_bytes, share_changes)
     return (True, "Renamed!")
 
 
-async def list_shares(owner: str, filter: Optional[str] = None) -> list[dict]:
+async def finish_move(
+    share_path: Path, new_share_path: Path, size_bytes: int | None, share_changes: list[ShareChange] | None = None
+) -> None:
+    """size_bytes is None when the size of what moved is not known without walking it."""
+    file_path = get_upload_directory() / share_path
+    to = get_upload_directory() / new_share_path
+    forget_directory_sizes(file_path)
+    apply_size_change(file_path, None if size_bytes is None else -size_bytes)
+    apply_size_change(to, size_bytes)
+    forget_changed_path(file_path)
+    forget_changed_path(to)
+    move_indexed_path(file_path, to)
+    if share_changes is None:
+        await apply_share_changes([(share_path, new_share_path)])
+    else:
+        share_changes.append((share_path, new_share_path))
+
+
+async def run_batch_operation(
+    base: PathLike[str] | str,
+    operation: BatchOperation,
+    owner: str | None,
+    roots: dict[str, PathLike[str] | str],
+    share_changes: list[ShareChange],
+) -> tuple[bool, str]:
+    match operation.action:
+        case "move":
+            if operation.to is None:
+                return (False, "No folder to move to!")
+            to_base, to = (roots[operation.to], "") if operation.to in roots else (base, operation.to)
+            return await move(
+                base=base, to_base=to_base, file_path=operation.path, to=to, owner=owner, share_changes=share_changes
+            )
+        case "rename":
+            if not operation.name:
+                return (False, "No new name!")
+            return await rename(base, operation.path, operation.name, share_changes)
+        case "delete":
+            return await delete_file(base, operation.path, share_changes)
+    return (False, "Unknown action!")
+
+
+def get_batch_paths(
+    base: PathLike[str] | str, operation: BatchOperation, roots: dict[str, PathLike[str] | str]
+) -> list[Path]:
+    """What a batch operation changes: the path it acts on, and for a move or rename the path that ends up at."""
+    try:
+        share_path = safe_join(base, operation.path)
+        match operation.action:
+            case "move" if operation.to is not None:
+                to_base, to = (roots[operation.to], "") if operation.to in roots else (base, operation.to)
+                return [share_path, safe_join(to_base, to) / share_path.name]
+            case "rename" if operation.name:
+                return [share_path, share_path.with_name(operation.name)]
+        return [share_path]
+    except ValueError:
+        # Left to fail on its own
+        return []
+
+
+def check_batch_overlaps(
+    base: PathLike[str] | str, operations: list[BatchOperation], roots: dict[str, PathLike[str] | str]
+) -> None:
+    """Raises ValueError if two operations touch the same path or one inside the other, such as a rename of a
+    folder another operation moves something into, since side by side either could happen first.
+    Sorted by their parts, the paths inside a path come right after it, so the ones still open on the stack
+    are the only ones a path can be inside of.
+    """
+    paths = sorted(
+        (path.parts, index)
+        for index, operation in enumerate(operations)
+        for path in get_batch_paths(base, operation, roots)
+    )
+    open_paths: list[tuple[tuple[str, ...], int]] = []
+    for parts, index in paths:
+        while open_paths and open_paths[-1][0] != parts[: len(open_paths[-1][0])]:
+            open_paths.pop()
+        for open_parts, open_index in open_paths:
+            if open_index != index:
+                raise ValueError(
+                    f"Entries {open_index + 1} and {index + 1} both change {Path(*open_parts)}, so they cannot be "
+                    "done together!"
+                )
+        open_paths.append((parts, index))
+
+
+async def run_batch(
+    base: PathLike[str] | str,
+    operations: list[BatchOperation],
+    owner: str | None = None,
+    roots: dict[str, PathLike[str] | str] | None = None,
+) -> list[tuple[bool, str]]:
+    """Moves, renames and deletes up to BATCH_CONCURRENCY files at a time, answering with the outcome of each
+    in the order they were given. They run side by side, so a batch where one depends on another is turned away
+    with a ValueError before anything is done. The shares they affect are fixed up together once all of them are
+    done, in one transaction rather than one each.
+    roots maps folders to move into that are named by a marker instead of a path (like "" for home) to their base.
+    """
+    check_batch_overlaps(base, operations, roots or {})
+    semaphore = Semaphore(BATCH_CONCURRENCY)
+    share_changes: list[ShareChange] = []
+
+    async def run(operation: BatchOperation) -> tuple[bool, str]:
+        async with semaphore:
+            try:
+                return await run_batch_operation(base, operation, owner, roots or {}, share_changes)
+            except (OSError, ValueError):
+                return (False, "Unable to do that here!")
+            except Exception:
+                logger.exception("Batch %s of %s failed", operation.action, operation.path)
+                return (False, "Something went wrong!")
+
+    # Every operation has settled before the shares are fixed up, so none of the changes are left out
+    results = await gather(*(run(operation) for operation in operations), return_exceptions=True)
+    await apply_share_changes(share_changes)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results  # type: ignore[return-value]
+
+
+async def copy_across_filesystems(job: TreeJob, share_path: Path, new_share_path: Path) -> None:
+    """Copies (and verifies) into a hidden folder next to the destination, renames it into place once
+    everything is there, and only then removes the original, so a failure part-way loses nothing.
+    """
+    partial_path = job.destination.with_name(f"{TEMPORARY_UPLOAD_PREFIX}{token_hex(8)}")
+    try:
+        if not job.total_bytes:
+            job.total_bytes = await run_in_threadpool(get_tree_size, job.source)
+        await run_in_threadpool(copy_tree, job.source, partial_path, job)
+        if job.destination.exists():
+            raise FileExistsError("A file or folder with the same name already exists here!")
+        partial_path.rename(job.destination)
+    except (OSError, ValueError) as error:
+        await run_in_threadpool(remove_tree, partial_path)
+        job.finish(False, str(error))
+        return
+    finally:
+        pending_uploads.discard(job.destination)
+    await finish_move(share_path, new_share_path, job.done_bytes)
+    if move_to_trash(job.source) is not None:
+        schedule_trash_reaping()
+    else:
+        await run_in_threadpool(remove_tree, job.source)
+        schedule_content_sweep()
+    job.finish(True, "Moved!")
+
+
+@dataclass(frozen=True, slots=True)
+class ShareRecord:
+    """Everything the share routes need to know about a share, detached from the database session."""
+
+    share_id: str
+    owner: str
+    path: Path
+    expires: datetime | None
+    anonymous_access: bool
+    collaborative: bool
+    allowed_users: frozenset[str]
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and datetime.now() > self.expires
+
+
+share_records_lock = Lock()
+share_records: OrderedDict[str, tuple[ShareRecord, datetime]] = OrderedDict()
+share_record_stats: dict[str, int] = {"hits": 0, "misses": 0}
+
+
+async def get_share_record(share_id: str) -> ShareRecord | None:
+    """Looks a share up, answering from the in-process cache when it can.
+    Records are kept for SHARE_CACHE_TTL and the least recently used are dropped past SHARE_CACHE_SIZE.
+    """
+    now = datetime.now()
+    with share_records_lock:
+        if (cached := share_records.get(share_id)) and now < cached[1]:
+            share_records.move_to_end(share_id)
+            share_record_stats["hits"] += 1
+            return cached[0]
+        share_record_stats["misses"] += 1
+    try:
+        share_id_bytes = bytes.fromhex(share_id)
+    except ValueError:
+        return None
+    async with SessionMaker() as engine:
+        share: Share | None = await engine.scalar(
+            select(Share).filter_by(share_id=share_id_bytes).options(selectinload(Share.allowed_users))
+        )
+        if not share:
+            return None
+        record = ShareRecord(
+            share_id=share_id,
+            owner=share.owner.hex(),
+            path=Path(share.path),
+            expires=share.expires,
+            anonymous_access=share.anonymous_access,
+            collaborative=share.collaborative,
+            allowed_users=frozenset(allowed.user_id.hex() for allowed in share.allowed_users),
+        )
+    with share_records_lock:
+        share_records[share_id] = (record, now + SHARE_CACHE_TTL)
+        share_records.move_to_end(share_id)
+        while len(share_records) > SHARE_CACHE_SIZE:
+            share_records.popitem(last=False)
+    return record
+
+
+def forget_share_records(*, share_id: str | None = None, paths: list[PathLike[str] | str] | None = None) -> None:
+    """Drops cached share records, either one share by ID, every share on or below any of paths, or everything."""
+    with share_records_lock:
+        if share_id is not None:
+            share_records.pop(share_id, None)
+            return
+        if paths is None:
+            share_records.clear()
+            return
+        changed = [Path(changed_path) for changed_path in paths]
+        for cached_id in [
+            cached_id
+            for cached_id, (record, _) in share_records.items()
+            if any(record.path.is_relative_to(changed_path) for changed_path in changed)
+        ]:
+            del share_records[cached_id]
+
+
+def get_share_record_stats() -> dict[str, int]:
+    with share_records_lock:
+        return share_record_stats | {"size": len(share_records)}
+
+
+async def list_shares(owner: str, filter: str | None = None) -> list[dict]:
+    owned_shares: dict[bytes, dict] = {}
+    query = select(Share).filter_by(owner=bytes.fromhex(owner)).order_by(Share.path)
     if filter:
-        filter = str(Path(owner) / filter)
-    owned_shares: list[dict] = []
-    with SessionMaker() as engine:
-        shares = engine.execute(select(Share).filter_by(owner=bytes.fromhex(owner)).order_by(Share.path)).scalars()
-        for share in shares:
-            allow_list: list[str] = []
-            if share.user_whitelist:
-                for user_id in share.user_whitelist.split("$"):
-                    if user := engine.execute(
-                        select(User).filter_by(user_id=bytes.fromhex(user_id))
-                    ).scalar_one_or_none():
-                        allow_list.append(user.username)
-            if filter and not share.path == filter:
-                continue
-            owned_shares.append(
-                {
-                    "id": share.share_id.hex(),
-                    "shared_filename": Path(share.path).name,
-                    "shared_file": "/".join(Path(share.path).parts[1:]),
-                    "anonymous_access": share.anonymous_access,
-                    "collaborative": share.collaborative,
-                    "allowed_users": allow_list,
-                }
+        query = query.filter_by(path=str(Path(owner) / filter))
+    async with SessionMaker() as engine:
+        for share in await engine.scalars(query):
+            owned_shares[share.share_id] = {
+                "id": share.share_id.hex(),
+                "shared_filename": Path(share.path).name,
+                "shared_file": "/".join(Path(share.path).parts[1:]),
+                "anonymous_access": share.anonymous_access,
+                "collaborative": share.collaborative,
+                "allowed_users": [],
+            }
+        if owned_shares:
+            allowed_users = await engine.execute(
+                select(ShareAllowedUser.share_id, User.username)
+                .join(User, User.user_id == ShareAllowedUser.user_id)
+                .where(ShareAllowedUser.share_id.in_(owned_shares))
+                .order_by(User.username)
             )
-    return owned_shares
+            for share_id, username in allowed_users:
+                owned_shares[share_id]["allowed_users"].append(username)
+    return list(owned_shares.values())
 
 
 async def create_share(
     user_id: str,
     file_path: PathLike[str] | str,
-    expires: Optional[datetime] = None,
+    expires: datetime | None = None,
     anonymous_access: bool = True,
     collaborative: bool = False,
-    whitelist: Optional[list[str]] = None,
+    whitelist: list[str] | None = None,
 ) -> tuple[bool, str]:
     # NOTE - since this method forces the share to be created under the user's home folder,
     #   remember to have anything shared from /public to return that canonical url
@@ -307,23 +1925,47 @@ async def create_share(
         path=str(file_path_to_save),
         anonymous_access=anonymous_access,
         collaborative=collaborative if collaborative and file_path.is_dir() else False,
-        user_whitelist="$".join(whitelist) if whitelist else None,
     )
+    new_share.allowed_users = [
+        ShareAllowedUser(share_id=new_share.share_id, user_id=bytes.fromhex(user_id))
+        for user_id in set(whitelist or ())
+    ]
     new_share_link = new_share.share_id.hex()
-    with SessionMaker() as engine:
+    async with SessionMaker() as engine:
         engine.add(new_share)
-        engine.commit()
+        await engine.commit()
+    forget_share_records(share_id=new_share_link)
     return (True, new_share_link)
 
 
+async def update_share(
+    share_id: str,
+    owner_id: str,
+    *,
+    anonymous_access: bool | None = None,
+    collaborative: bool | None = None,
+) -> tuple[bool, str]:
+    """Changes the options of a share; those left as None stay as they are."""
+    async with SessionMaker() as engine:
+        share: Share | None = await engine.scalar(select(Share).filter_by(share_id=bytes.fromhex(share_id)))
+        if not share or share.owner.hex() != owner_id:
+            return (False, "Cannot change nonexistent share!")
+        if anonymous_access is not None:
+            share.anonymous_access = anonymous_access
+        if collaborative is not None:
+            share.collaborative = collaborative and (get_upload_directory() / share.path).is_dir()
+        await engine.commit()
+    forget_share_records(share_id=share_id)
+    return (True, "Share updated")
+
+
 async def delete_share(share_id: str, owner_id: str) -> tuple[bool, str]:
-    with SessionMaker() as engine:
-        share: Share | None = engine.execute(
-            select(Share).filter_by(share_id=bytes.fromhex(share_id))
-        ).scalar_one_or_none()
+    async with SessionMaker() as engine:
+        share: Share | None = await engine.scalar(select(Share).filter_by(share_id=bytes.fromhex(share_id)))
         if share and share.owner.hex() == owner_id:
-            engine.delete(share)
-            engine.commit()
+            await engine.delete(share)
+            await engine.commit()
         else:
             return (False, "Cannot delete nonexistent share!")
+    forget_share_records(share_id=share_id)
     return (True, "Share deleted")
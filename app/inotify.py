@@ -0,0 +1,140 @@
+"""A minimal inotify binding, so caches of directory contents notice changes made outside the app.
+Only available on Linux; everywhere else DirectoryWatcher.create returns None and callers go without.
+"""
+
+from asyncio import AbstractEventLoop
+from collections.abc import Callable
+from ctypes import CDLL, c_char_p, c_int, c_uint32
+from ctypes.util import find_library
+from os import O_CLOEXEC, O_NONBLOCK, close, fsdecode, fsencode, read, sep
+from struct import Struct
+from sys import platform
+from threading import Lock
+
+IN_ATTRIB: int = 0x00000004
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_FROM: int = 0x00000040
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE: int = 0x00000200
+IN_DELETE_SELF: int = 0x00000400
+IN_MOVE_SELF: int = 0x00000800
+IN_Q_OVERFLOW: int = 0x00004000
+IN_IGNORED: int = 0x00008000
+IN_ONLYDIR: int = 0x01000000
+IN_ISDIR: int = 0x40000000
+
+# Everything that changes what a listing of the directory shows. IN_MODIFY is left out on purpose,
+# since it fires for every write; the size of a file being written is picked up when it is closed.
+LISTING_EVENTS: int = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+# Events that mean the watched directory itself is gone, or will not be reported on any more
+SELF_EVENTS: int = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+EVENT_HEADER = Struct("iIII")
+EVENT_BUFFER_SIZE: int = 64 * 1024
+
+
+class DirectoryWatcher:
+    """Watches individual directories (not their subdirectories) and calls back with
+    (watched directory, name inside it or "", event mask) from the event loop it was started on.
+    An IN_Q_OVERFLOW means events were lost, and is reported with an empty directory.
+    """
+
+    def __init__(self, libc: CDLL, fd: int, callback: Callable[[str, str, int], None]) -> None:
+        self.libc = libc
+        self.fd = fd
+        self.callback = callback
+        self.loop: AbstractEventLoop | None = None
+        self.watches_lock = Lock()
+        self.directories: dict[int, str] = {}
+        self.descriptors: dict[str, int] = {}
+
+    @classmethod
+    def create(cls, callback: Callable[[str, str, int], None]) -> "DirectoryWatcher | None":
+        if not platform.startswith("linux"):
+            return None
+        try:
+            libc = CDLL(find_library("c"), use_errno=True)
+            libc.inotify_init1.argtypes = (c_int,)
+            libc.inotify_add_watch.argtypes = (c_int, c_char_p, c_uint32)
+            libc.inotify_rm_watch.argtypes = (c_int, c_int)
+        except (OSError, AttributeError):
+            return None
+        if (fd := libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)) < 0:
+            return None
+        return cls(libc, fd, callback)
+
+    def start(self, loop: AbstractEventLoop) -> None:
+        self.loop = loop
+        loop.add_reader(self.fd, self.read_events)
+
+    def close(self) -> None:
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop = None
+        with self.watches_lock:
+            self.directories.clear()
+            self.descriptors.clear()
+        close(self.fd)
+
+    def watch(self, directory: str) -> bool:
+        """Starts watching a directory, if it is not watched already. Returns whether it is now watched."""
+        with self.watches_lock:
+            if directory in self.descriptors:
+                return True
+            wd = self.libc.inotify_add_watch(self.fd, fsencode(directory), LISTING_EVENTS | IN_ONLYDIR)
+            if wd < 0:
+                # Most often ENOSPC, when fs.inotify.max_user_watches has been reached
+                return False
+            if (previous := self.directories.get(wd)) is not None:
+                # The same directory under another name, which only one of them can be kept for
+                self.descriptors.pop(previous, None)
+            self.directories[wd] = directory
+            self.descriptors[directory] = wd
+            return True
+
+    def unwatch(self, directory: str) -> None:
+        with self.watches_lock:
+            if (wd := self.descriptors.pop(directory, None)) is None:
+                return
+            self.directories.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def unwatch_tree(self, directory: str | None = None) -> None:
+        """Stops watching a directory and everything watched below it, or everything without a directory.
+        Watches follow a directory when it is moved, so the old names of a moved tree have to be let go
+        before something else can be watched under them.
+        """
+        with self.watches_lock:
+            for watched in [
+                watched
+                for watched in self.descriptors
+                if directory is None or watched == directory or watched.startswith(directory + sep)
+            ]:
+                wd = self.descriptors.pop(watched)
+                self.directories.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> None:
+        try:
+            buffer = read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.callback("", "", mask)
+                continue
+            with self.watches_lock:
+                directory = self.directories.get(wd)
+                if directory is not None and mask & IN_IGNORED:
+                    self.directories.pop(wd, None)
+                    self.descriptors.pop(directory, None)
+            if directory is not None:
+                self.callback(directory, name, mask)
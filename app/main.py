@@ -1,39 +1,89 @@
 """The main server monolith."""
 
+from asyncio import create_task
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from json import dumps
 from mimetypes import guess_file_type
 from os import PathLike
 from pathlib import Path
-from typing import Annotated, Optional
-from urllib.parse import urlparse
-
-from fastapi import Body, Cookie, FastAPI, Form, HTTPException, Request, Security, UploadFile, status
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, Response
+from typing import Annotated, Literal, Optional
+from urllib.parse import quote, urlparse
+
+from fastapi import (
+    Body,
+    Depends,
+    FastAPI,
+    Form,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Security,
+    UploadFile,
+    status,
+)
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from jinja2 import Environment
-from sqlalchemy import select
 
-from . import auth, file_handler
+from . import auth, database, file_handler
+from .access import get_session, resolve_share
 from .api import api_v0
 from .config import CONFIG
-from .database import SessionMaker
-from .objects import Share
 
 jinja2_environment = Environment()
 jinja2_environment.policies["json.dumps_kwargs"]["ensure_ascii"] = False
 
-app = FastAPI(openapi_url=None)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    session_sweeper = create_task(auth.invalidate_sessions())
+    file_handler.start_listing_watcher()
+    file_handler.start_size_watcher()
+    file_handler.schedule_trash_reaping()
+    file_handler.start_search_index()
+    yield
+    session_sweeper.cancel()
+    file_handler.stop_listing_watcher()
+    file_handler.stop_size_watcher()
+    file_handler.stop_search_index()
+    await database.engine.dispose()
+
+
+app = FastAPI(openapi_url=None, lifespan=lifespan)
 templates = Jinja2Templates(Path(__file__).parent / "templates")
 
 app.mount("/static", StaticFiles(directory=Path(__file__).parent / "static"), name="static")
 app.mount("/.well-known", StaticFiles(directory=Path(__file__).parent / ".well-known"), name=".well-known")
 
 
-async def get_session(session_id: Annotated[Optional[str], Cookie()] = None) -> auth.Session | None:
-    if session_id and (session := auth.check_session(session_id)):
-        return session
-    return None
+# hls.js, for browsers that cannot play HLS natively
+HLS_PLAYER_URL: str = "https://cdn.jsdelivr.net/npm/hls.js@1/dist/hls.min.js"
+# Views whose rows come from another template's file_rows macro
+ROW_TEMPLATES: dict[str, str] = {"collab_view.html": "file_view.html"}
+
+
+@dataclass(slots=True)
+class ListingOptions:
+    sort: str = "name"
+    descending: bool = False
+    cursor: Optional[str] = None
+    rows_only: bool = False
+    format: str = "html"
+
+
+async def listing_options(
+    sort: Literal["name", "type", "size", "mtime"] = "name",
+    descending: bool = False,
+    cursor: Optional[str] = None,
+    rows_only: bool = False,
+    format: Literal["html", "ndjson"] = "html",
+) -> ListingOptions:
+    return ListingOptions(sort=sort, descending=descending, cursor=cursor, rows_only=rows_only, format=format)
 
 
 # TODO - rename
@@ -41,28 +91,81 @@ async def directory_list(
     base: PathLike[str] | str,
     file_path: Optional[PathLike[str] | str],
     access_level: int = 0,
-) -> list | None:
+    listing: Optional[ListingOptions] = None,
+) -> tuple[list[dict], Optional[str]] | None:
     if file_path is not None:
         file_path = file_handler.safe_path_regex.sub(".", str(file_path))
-    files = await file_handler.list_files(base=base, subfolder=file_path, access_level=access_level)
-    return files
+    listing = listing or ListingOptions()
+    try:
+        return await file_handler.list_files(
+            base=base,
+            subfolder=file_path,
+            access_level=access_level,
+            sort=listing.sort,
+            descending=listing.descending,
+            cursor=listing.cursor,
+            limit=file_handler.LISTING_PAGE_SIZE,
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+
+
+def listing_response(
+    request: Request,
+    template: str,
+    files: list[dict],
+    next_cursor: Optional[str],
+    listing: ListingOptions,
+    context: dict,
+) -> Response:
+    """Answers a directory listing as a full page, as just the rows of a further page
+    (loaded by listing.js as the list scrolls), or as NDJSON with one file per line.
+    """
+    next_page_url = None
+    if next_cursor:
+        next_page_url = str(request.url.include_query_params(cursor=next_cursor, rows_only=True))
+    if listing.format == "ndjson":
+        headers = {}
+        if next_cursor:
+            next_url = request.url.include_query_params(cursor=next_cursor, rows_only=False)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return StreamingResponse(
+            (dumps(file) + "\n" for file in files), media_type="application/x-ndjson", headers=headers
+        )
+    context = context | {"files": files, "next_page_url": next_page_url}
+    if listing.rows_only:
+        view_template = ROW_TEMPLATES.get(template, template)
+        return templates.TemplateResponse(
+            request=request, name="file_rows.html", context=context | {"view_template": view_template}
+        )
+    return templates.TemplateResponse(request=request, name=template, context=context)
 
 
 async def get_direct_file_response(
+    request: Request,
     base: PathLike[str] | str,
     file_path: PathLike[str] | str,
 ):
-    if file_contents := await file_handler.get_file(base=base, file_path=file_path, direct=True):
+    if file_contents := await file_handler.get_file(
+        base=base, file_path=file_path, direct=True, request_headers=request.headers
+    ):
         return file_contents
     raise HTTPException(status_code=404, detail="Unable to get file")
 
 
 async def get_file_response_or_embed(
-    request: Request, base: PathLike[str] | str, file_path: PathLike[str] | str, direct_url: str
+    request: Request,
+    base: PathLike[str] | str,
+    file_path: PathLike[str] | str,
+    direct_url: str,
+    stream_url: Optional[str] = None,
 ):
-    if file_contents := await file_handler.get_file(base=base, file_path=file_path):
+    if file_contents := await file_handler.get_file(base=base, file_path=file_path, request_headers=request.headers):
         if file_contents == "||video||":
             file_path_to_serve = file_handler.get_upload_directory() / file_handler.safe_join(base, file_path)
+            # Played directly until its HLS renditions are ready
+            if stream_url and not file_handler.prepare_video_stream(base, file_path):
+                stream_url = None
             return templates.TemplateResponse(
                 request=request,
                 name="embed_video.html",
@@ -70,6 +173,8 @@ async def get_file_response_or_embed(
                     "url": str(request.url),
                     "mime_type": guess_file_type(file_path_to_serve)[0],
                     "direct_url": direct_url,
+                    "stream_url": stream_url,
+                    "hls_player_url": CONFIG.get("hls_player_url", HLS_PLAYER_URL),
                     "title": file_path_to_serve.name,
                 },
             )
@@ -85,30 +190,43 @@ async def get_full_file_response(
     username: Optional[str] = None,
     access_level: int = 0,
     public: bool = False,
+    listing: Optional[ListingOptions] = None,
 ):
-    files = await directory_list(
+    listing = listing or ListingOptions()
+    listed = await directory_list(
         base=base,
         file_path=file_path,
         access_level=access_level,
+        listing=listing,
     )
-    if files is not None:
+    if listed is not None:
+        files, next_cursor = listed
         path_segments = [{"path": "", "name": "Public Files"}] if public else []
         current_path = []
         if file_path:
             for segment in Path(file_path).parts:
                 current_path.append(segment)
                 path_segments.append({"path": "/".join(current_path), "name": segment})
-        return templates.TemplateResponse(
-            request=request,
-            name="file_view.html",
-            context={
-                "files": files,
+        return listing_response(
+            request,
+            "file_view.html",
+            files,
+            next_cursor,
+            listing,
+            {
                 "media_files": list(filter(lambda f: f["type"] not in ("dir", "public_directory"), files)),
                 "current_directory_url": str(current_directory_url),
                 "username": username,
                 "access_level": access_level,
                 "path_segments": path_segments,
                 "in_public_folder": public,
+                "thumbnail_url": str(
+                    request.url_for("serve_public_thumbnail" if public else "serve_thumbnail", file_path="")
+                ),
+                "zip_url": str(request.url_for("serve_public_zip" if public else "serve_zip", file_path="")),
+                "search_url": (
+                    str(request.url_for("search_public" if public else "search")) if file_handler.search_index else None
+                ),
             },
         )
     if file_path is not None:
@@ -121,6 +239,12 @@ async def get_full_file_response(
                 if public
                 else str(request.url_for("serve_file_direct", file_path=file_path))
             ),
+            stream_url=str(
+                request.url_for(
+                    "serve_public_video_stream" if public else "serve_video_stream",
+                    stream_path=f"{file_path}/master.m3u8",
+                )
+            ),
         ):
             return file_contents
     raise HTTPException(status_code=404, detail="Unable to get files")
@@ -133,13 +257,17 @@ async def get_share_response(
     file_path: Optional[PathLike[str] | str],
     username: Optional[str] = None,
     access_level: int = -1,
+    listing: Optional[ListingOptions] = None,
 ):
-    files = await directory_list(
+    listing = listing or ListingOptions()
+    listed = await directory_list(
         base=base,
         file_path=file_path,
         access_level=access_level,
+        listing=listing,
     )
-    if files is not None:
+    if listed is not None:
+        files, next_cursor = listed
         folder_name = Path(base).name
         path_segments = [{"path": "", "name": f"{folder_name} (Shared Folder)"}]
         current_path = []
@@ -147,16 +275,23 @@ async def get_share_response(
             for segment in Path(file_path).parts:
                 current_path.append(segment)
                 path_segments.append({"path": "/".join(current_path), "name": segment})
-        return templates.TemplateResponse(
-            request=request,
-            name="share_view.html",
-            context={
-                "files": files,
+        return listing_response(
+            request,
+            "share_view.html",
+            files,
+            next_cursor,
+            listing,
+            {
                 "media_files": list(filter(lambda f: f["type"] not in ("dir", "public_directory"), files)),
                 "current_directory_url": str(request.url_for("get_share", share_id=share_id)),
                 "username": username,
                 "access_level": access_level,
                 "path_segments": path_segments,
+                "thumbnail_url": str(request.url_for("serve_share_thumbnail", share_id=share_id, file_path="")),
+                "zip_url": str(request.url_for("serve_share_zip", share_id=share_id, file_path="")),
+                "search_url": (
+                    str(request.url_for("search_share", share_id=share_id)) if file_handler.search_index else None
+                ),
             },
         )
     if file_path is not None:
@@ -165,6 +300,9 @@ async def get_share_response(
             base=base,
             file_path=file_path,
             direct_url=str(request.url_for("serve_share_file_direct", share_id=share_id, file_path=file_path)),
+            stream_url=str(
+                request.url_for("serve_share_video_stream", share_id=share_id, stream_path=f"{file_path}/master.m3u8")
+            ),
         ):
             return file_contents
     raise HTTPException(status_code=404, detail="Unable to get files")
@@ -177,13 +315,17 @@ async def get_collab_response(
     file_path: Optional[PathLike[str] | str],
     username: Optional[str] = None,
     access_level: int = -1,
+    listing: Optional[ListingOptions] = None,
 ):
-    files = await directory_list(
+    listing = listing or ListingOptions()
+    listed = await directory_list(
         base=base,
         file_path=file_path,
         access_level=access_level,
+        listing=listing,
     )
-    if files is not None:
+    if listed is not None:
+        files, next_cursor = listed
         folder_name = Path(base).name
         path_segments = [{"path": "", "name": f"{folder_name} (Shared Folder)"}]
         current_path = []
@@ -191,18 +333,25 @@ async def get_collab_response(
             for segment in Path(file_path).parts:
                 current_path.append(segment)
                 path_segments.append({"path": "/".join(current_path), "name": segment})
-        return templates.TemplateResponse(
-            request=request,
-            name="collab_view.html",
-            context={
+        return listing_response(
+            request,
+            "collab_view.html",
+            files,
+            next_cursor,
+            listing,
+            {
                 "share_id": share_id,
-                "files": files,
                 "media_files": list(filter(lambda f: f["type"] not in ("dir", "public_directory"), files)),
                 "current_directory_url": str(request.url_for("get_collab", share_id=share_id)),
                 "username": username,
                 "access_level": access_level,
                 "path_segments": path_segments,
                 "in_public_folder": False,
+                "thumbnail_url": str(request.url_for("serve_share_thumbnail", share_id=share_id, file_path="")),
+                "zip_url": str(request.url_for("serve_share_zip", share_id=share_id, file_path="")),
+                "search_url": (
+                    str(request.url_for("search_share", share_id=share_id)) if file_handler.search_index else None
+                ),
             },
         )
     if file_path is not None:
@@ -211,34 +360,38 @@ async def get_collab_response(
             base=base,
             file_path=file_path,
             direct_url=str(request.url_for("serve_share_file_direct", share_id=share_id, file_path=file_path)),
+            stream_url=str(
+                request.url_for("serve_share_video_stream", share_id=share_id, stream_path=f"{file_path}/master.m3u8")
+            ),
         ):
             return file_contents
     raise HTTPException(status_code=404, detail="Unable to get files")
 
 
 async def get_collab_share_info(session: Optional[auth.Session], share_id: str) -> dict:
-    try:
-        share_id_bytes = bytes.fromhex(share_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid share ID.")
-
-    with SessionMaker() as engine:
-        share: Share | None = engine.execute(select(Share).filter_by(share_id=share_id_bytes)).scalar_one_or_none()
-        if not share:
-            raise HTTPException(status_code=404, detail="Share ID not found.")
-        if not share.collaborative:
-            raise HTTPException(status_code=405, detail="Not a collaborative share.")
-        allow_list = share.user_whitelist
-        if allow_list:
-            allow_list.split("$")
-            if not (session and session.user_id in allow_list):
-                raise HTTPException(status_code=403, detail="User ID not on allow list.")
-        share_path = Path(share.path)
-        return {
-            "base": share_path,
-            "anonymous_access": share.anonymous_access,
-            "allow_list": allow_list or None,
-        }
+    share = await resolve_share(session, share_id)
+    if not share.collaborative:
+        raise HTTPException(status_code=405, detail="Not a collaborative share.")
+    return {
+        "base": share.path,
+        "anonymous_access": share.anonymous_access,
+        "allow_list": share.allowed_users or None,
+    }
+
+
+def upload_session_response(upload: Optional[file_handler.UploadSession]) -> Response:
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload does not exist.")
+    headers = {
+        "Upload-Offset": str(upload.offset),
+        "Upload-Length": str(upload.size),
+        "Upload-Ranges": ",".join(f"{start}-{end}" for start, end in upload.received),
+        "Cache-Control": "no-store",
+    }
+    if (challenge := upload.challenge) is not None and upload.offset < upload.size:
+        # The range to send first, after which the server has the rest already if it matched
+        headers["Upload-Challenge"] = f"{challenge[0]}-{challenge[1]}"
+    return Response(status_code=204, headers=headers)
 
 
 @app.exception_handler(404)
@@ -246,6 +399,16 @@ async def not_found(request: Request, exception: HTTPException):
     return templates.TemplateResponse(request=request, name="404.html")
 
 
+@app.exception_handler(auth.PasswordHashingBusy)
+async def password_hashing_busy(request: Request, exception: auth.PasswordHashingBusy):
+    return Response(
+        content="Too many sign-in attempts are being processed, please try again shortly.",
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(auth.PASSWORD_RETRY_AFTER)},
+        media_type="text/plain",
+    )
+
+
 @app.get("/")
 async def root(request: Request, session: Annotated[Optional[auth.Session], Security(get_session)]):
     if session is None:
@@ -263,7 +426,7 @@ async def settings(request: Request, session: Annotated[Optional[auth.Session],
         context={
             "username": session.username,
             "access_level": session.access_level,
-            "has_password": auth.check_user_has_password(session.username),
+            "has_password": await auth.check_user_has_password(session.username),
         },
     )
 
@@ -284,11 +447,26 @@ async def control_panel(request: Request, session: Annotated[Optional[auth.Sessi
     )
 
 
+@app.get("/control_panel/share_cache")
+async def share_cache_stats(session: Annotated[Optional[auth.Session], Security(get_session)]):
+    if session is None or session.access_level < 2:
+        raise HTTPException(status_code=403, detail="Access level insufficient.")
+    return file_handler.get_share_record_stats()
+
+
+@app.get("/control_panel/listing_cache")
+async def listing_cache_stats(session: Annotated[Optional[auth.Session], Security(get_session)]):
+    if session is None or session.access_level < 2:
+        raise HTTPException(status_code=403, detail="Access level insufficient.")
+    return file_handler.get_listing_cache_stats()
+
+
 @app.get("/f")
 @app.get("/f/{file_path:path}")
 async def get_files(
     request: Request,
     session: Annotated[Optional[auth.Session], Security(get_session)],
+    listing: Annotated[ListingOptions, Depends(listing_options)],
     file_path: Optional[PathLike[str]] = None,
 ):
     if session is None:
@@ -302,6 +480,7 @@ async def get_files(
         current_directory_url=str(request.url_for("get_files")),
         username=session.username,
         access_level=session.access_level,
+        listing=listing,
     )
 
 
@@ -313,7 +492,7 @@ async def serve_file_direct(
 ):
     if session is None:
         return RedirectResponse(url=request.url_for("login_page").include_query_params(next=request.url.path))
-    return await get_direct_file_response(base=session.user_id, file_path=file_path)
+    return await get_direct_file_response(request=request, base=session.user_id, file_path=file_path)
 
 
 @app.get("/public")
@@ -321,6 +500,7 @@ async def serve_file_direct(
 async def get_public_files(
     request: Request,
     session: Annotated[Optional[auth.Session], Security(get_session)],
+    listing: Annotated[ListingOptions, Depends(listing_options)],
     file_path: Optional[PathLike[str]] = None,
 ):
     if not CONFIG.get("public_directory"):
@@ -339,6 +519,7 @@ async def get_public_files(
         username=session.username if session else None,
         access_level=session.access_level if session else -1,
         public=True,
+        listing=listing,
     )
 
 
@@ -356,7 +537,9 @@ async def serve_public_file_direct(
     else:
         if session.access_level < CONFIG.get("public_access_level", -1):
             raise HTTPException(status_code=403, detail="User level insufficient.")
-    return await get_direct_file_response(base=str(CONFIG.get("public_directory")), file_path=file_path)
+    return await get_direct_file_response(
+        request=request, base=str(CONFIG.get("public_directory")), file_path=file_path
+    )
 
 
 @app.get("/s/{share_id}")
@@ -365,40 +548,29 @@ async def get_share(
     request: Request,
     session: Annotated[Optional[auth.Session], Security(get_session)],
     share_id: str,
+    listing: Annotated[ListingOptions, Depends(listing_options)],
     file_path: Optional[PathLike[str] | str] = None,
 ):
     if file_path:
         file_path = file_handler.safe_path_regex.sub(".", str(file_path))
     else:
         file_path = "."
-    try:
-        share_id_bytes = bytes.fromhex(share_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid share ID.")
-
-    with SessionMaker() as engine:
-        share: Share | None = engine.execute(select(Share).filter_by(share_id=share_id_bytes)).scalar_one_or_none()
-        if not share:
-            raise HTTPException(status_code=404, detail="Share ID not found.")
-        if allow_list := share.user_whitelist:
-            if not (session and session.user_id in allow_list.split("$")):
-                raise HTTPException(status_code=403, detail="Not on share list.")
-        elif not (share.anonymous_access or session):
-            raise HTTPException(status_code=401, detail="Share not publicly accessible.")
-        if share.collaborative:
-            return RedirectResponse(url=request.url_for("get_collab", share_id=share_id, file_path=file_path))
-        share_path = Path(share.path)
-        # owner_id = share_path.parts[0]
-        # share_path = share_path.relative_to(owner_id)
-        # share_subpath = share_path / file_path
-        return await get_share_response(
-            request=request,
-            share_id=share_id,
-            base=share_path,
-            file_path=file_path,
-            username=session.username if session else None,
-            access_level=session.access_level if session else -1,
-        )
+    share = await resolve_share(session, share_id)
+    if share.collaborative:
+        return RedirectResponse(url=request.url_for("get_collab", share_id=share_id, file_path=file_path))
+    share_path = share.path
+    # owner_id = share_path.parts[0]
+    # share_path = share_path.relative_to(owner_id)
+    # share_subpath = share_path / file_path
+    return await get_share_response(
+        request=request,
+        share_id=share_id,
+        base=share_path,
+        file_path=file_path,
+        username=session.username if session else None,
+        access_level=session.access_level if session else -1,
+        listing=listing,
+    )
 
 
 @app.get("/d_s/{share_id}/{file_path:path}")
@@ -409,21 +581,272 @@ async def serve_share_file_direct(
     file_path: PathLike[str] | str,
 ):
     file_path = file_handler.safe_path_regex.sub(".", str(file_path))
-    try:
-        share_id_bytes = bytes.fromhex(share_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid share ID.")
-    with SessionMaker() as engine:
-        share: Share | None = engine.execute(select(Share).filter_by(share_id=share_id_bytes)).scalar_one_or_none()
-        if not share:
-            raise HTTPException(status_code=404, detail="Share ID not found.")
-        if allow_list := share.user_whitelist:
-            if not (session and session.user_id in allow_list.split("$")):
-                raise HTTPException(status_code=403, detail="Not on share list.")
-        elif not (share.anonymous_access or session):
-            raise HTTPException(status_code=401, detail="Share not publicly accessible.")
-        share_path = Path(share.path)
-    return await get_direct_file_response(base=share_path, file_path=file_path)
+    share = await resolve_share(session, share_id)
+    return await get_direct_file_response(request=request, base=share.path, file_path=file_path)
+
+
+async def get_thumbnail_response(request: Request, base: PathLike[str] | str, file_path: PathLike[str] | str):
+    if thumbnail := await file_handler.get_file_thumbnail(
+        base=base, file_path=file_path, request_headers=request.headers
+    ):
+        return thumbnail
+    raise HTTPException(status_code=404, detail="No thumbnail for this file")
+
+
+@app.get("/thumb/{file_path:path}")
+async def serve_thumbnail(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    file_path: PathLike[str] | str,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    return await get_thumbnail_response(request=request, base=session.user_id, file_path=file_path)
+
+
+@app.get("/thumb_public/{file_path:path}")
+async def serve_public_thumbnail(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    file_path: PathLike[str] | str,
+):
+    if not CONFIG.get("public_directory"):
+        raise HTTPException(status_code=404, detail="Public directory not enabled.")
+    if session is None:
+        if CONFIG.get("public_access_requires_login", True):
+            raise HTTPException(status_code=401, detail="Not logged in.")
+    elif session.access_level < CONFIG.get("public_access_level", -1):
+        raise HTTPException(status_code=403, detail="User level insufficient.")
+    return await get_thumbnail_response(request=request, base=str(CONFIG.get("public_directory")), file_path=file_path)
+
+
+@app.get("/thumb_s/{share_id}/{file_path:path}")
+async def serve_share_thumbnail(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    file_path: PathLike[str] | str,
+):
+    file_path = file_handler.safe_path_regex.sub(".", str(file_path))
+    share = await resolve_share(session, share_id)
+    return await get_thumbnail_response(request=request, base=share.path, file_path=file_path)
+
+
+async def get_video_stream_response(request: Request, base: PathLike[str] | str, stream_path: str):
+    if stream_file := file_handler.get_video_stream_file(
+        base=base, stream_path=stream_path, request_headers=request.headers
+    ):
+        return stream_file
+    raise HTTPException(status_code=404, detail="No stream for this video")
+
+
+@app.get("/hls/{stream_path:path}")
+async def serve_video_stream(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    stream_path: str,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    return await get_video_stream_response(request=request, base=session.user_id, stream_path=stream_path)
+
+
+@app.get("/hls_public/{stream_path:path}")
+async def serve_public_video_stream(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    stream_path: str,
+):
+    if not CONFIG.get("public_directory"):
+        raise HTTPException(status_code=404, detail="Public directory not enabled.")
+    if session is None:
+        if CONFIG.get("public_access_requires_login", True):
+            raise HTTPException(status_code=401, detail="Not logged in.")
+    elif session.access_level < CONFIG.get("public_access_level", -1):
+        raise HTTPException(status_code=403, detail="User level insufficient.")
+    return await get_video_stream_response(
+        request=request, base=str(CONFIG.get("public_directory")), stream_path=stream_path
+    )
+
+
+@app.get("/hls_s/{share_id}/{stream_path:path}")
+async def serve_share_video_stream(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    stream_path: str,
+):
+    stream_path = file_handler.safe_path_regex.sub(".", stream_path)
+    share = await resolve_share(session, share_id)
+    return await get_video_stream_response(request=request, base=share.path, stream_path=stream_path)
+
+
+def get_zip_response(
+    base: PathLike[str] | str,
+    file_path: Optional[PathLike[str] | str],
+    selected: Optional[list[str]],
+    root_name: str = "files",
+):
+    archive = file_handler.get_zip(base=base, file_path=file_path, selected=selected, root_name=root_name)
+    if archive is None:
+        raise HTTPException(status_code=404, detail="Unable to get files")
+    content, filename = archive
+    ascii_filename = filename.encode("ascii", "replace").decode().replace('"', "_")
+    return StreamingResponse(
+        content,
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename=\"{ascii_filename}\"; filename*=UTF-8''{quote(filename)}"
+        },
+    )
+
+
+@app.get("/zip")
+@app.get("/zip/{file_path:path}")
+async def serve_zip(
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    file_path: Optional[str] = None,
+    select: Annotated[Optional[list[str]], Query()] = None,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    return get_zip_response(base=session.user_id, file_path=file_path, selected=select)
+
+
+@app.get("/zip_public")
+@app.get("/zip_public/{file_path:path}")
+async def serve_public_zip(
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    file_path: Optional[str] = None,
+    select: Annotated[Optional[list[str]], Query()] = None,
+):
+    if not CONFIG.get("public_directory"):
+        raise HTTPException(status_code=404, detail="Public directory not enabled.")
+    if session is None:
+        if CONFIG.get("public_access_requires_login", True):
+            raise HTTPException(status_code=401, detail="Not logged in.")
+    elif session.access_level < CONFIG.get("public_access_level", -1):
+        raise HTTPException(status_code=403, detail="User level insufficient.")
+    return get_zip_response(
+        base=str(CONFIG.get("public_directory")), file_path=file_path, selected=select, root_name="public"
+    )
+
+
+@app.get("/zip_s/{share_id}")
+@app.get("/zip_s/{share_id}/{file_path:path}")
+async def serve_share_zip(
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    file_path: Optional[str] = None,
+    select: Annotated[Optional[list[str]], Query()] = None,
+):
+    if file_path:
+        file_path = file_handler.safe_path_regex.sub(".", file_path)
+    share = await resolve_share(session, share_id)
+    return get_zip_response(base=share.path, file_path=file_path, selected=select, root_name=Path(share.path).name)
+
+
+async def search_folder(
+    base: PathLike[str] | str, query: str, file_path: Optional[str], current_directory_url: str
+) -> list[dict]:
+    files = await file_handler.search_files(base=base, query=query, subfolder=file_path)
+    if files is None:
+        raise HTTPException(status_code=404, detail="Search not enabled.")
+    for file in files:
+        file["url"] = f"{current_directory_url}/{file['view_path'] or file['path']}"
+    return files
+
+
+def search_response(
+    request: Request,
+    files: list[dict],
+    query: str,
+    file_path: Optional[str],
+    search_url: str,
+    username: Optional[str],
+    access_level: int,
+) -> Response:
+    return templates.TemplateResponse(
+        request=request,
+        name="search_view.html",
+        context={
+            "files": files,
+            "query": query,
+            "search_path": file_path or "",
+            "search_url": search_url,
+            "username": username,
+            "access_level": access_level,
+        },
+    )
+
+
+@app.get("/search")
+async def search(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    q: str = "",
+    path: Optional[str] = None,
+):
+    if session is None:
+        return RedirectResponse(url=request.url_for("login_page").include_query_params(next=request.url.path))
+    files = await search_folder(session.user_id, q, path, str(request.url_for("get_files")))
+    # The public folder shows up at the top of the home folder, so a search from there covers it too
+    if not path and CONFIG.get("public_directory") and session.access_level >= CONFIG.get("public_access_level", -1):
+        public_directory = str(CONFIG.get("public_directory"))
+        public_files = await search_folder(public_directory, q, None, str(request.url_for("get_public_files")))
+        for file in public_files:
+            file["folder"] = "/".join(filter(None, (Path(public_directory).name, file["folder"])))
+        files += public_files
+    search_url = str(request.url_for("search"))
+    return search_response(request, files, q, path, search_url, session.username, session.access_level)
+
+
+@app.get("/search_public")
+async def search_public(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    q: str = "",
+    path: Optional[str] = None,
+):
+    if not CONFIG.get("public_directory"):
+        raise HTTPException(status_code=404, detail="Public directory not enabled.")
+    if session is None:
+        if CONFIG.get("public_access_requires_login", True):
+            return RedirectResponse(url=request.url_for("login_page").include_query_params(next=request.url.path))
+    elif session.access_level < CONFIG.get("public_access_level", -1):
+        raise HTTPException(status_code=403, detail="User level insufficient.")
+    files = await search_folder(str(CONFIG.get("public_directory")), q, path, str(request.url_for("get_public_files")))
+    return search_response(
+        request,
+        files,
+        q,
+        path,
+        str(request.url_for("search_public")),
+        session.username if session else None,
+        session.access_level if session else -1,
+    )
+
+
+@app.get("/search_s/{share_id}")
+async def search_share(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    q: str = "",
+    path: Optional[str] = None,
+):
+    share = await resolve_share(session, share_id)
+    share_url = str(request.url_for("get_collab" if share.collaborative else "get_share", share_id=share_id))
+    files = await search_folder(share.path, q, path, share_url)
+    return search_response(
+        request,
+        files,
+        q,
+        path,
+        str(request.url_for("search_share", share_id=share_id)),
+        session.username if session else None,
+        session.access_level if session else -1,
+    )
 
 
 @app.get("/collab/{share_id}")
@@ -432,40 +855,29 @@ async def get_collab(
     request: Request,
     session: Annotated[Optional[auth.Session], Security(get_session)],
     share_id: str,
+    listing: Annotated[ListingOptions, Depends(listing_options)],
     file_path: Optional[str] = None,
 ):
     if file_path:
         file_path = file_handler.safe_path_regex.sub(".", str(file_path))
     else:
         file_path = "."
-    try:
-        share_id_bytes = bytes.fromhex(share_id)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid share ID.")
-
-    with SessionMaker() as engine:
-        share: Share | None = engine.execute(select(Share).filter_by(share_id=share_id_bytes)).scalar_one_or_none()
-        if not share:
-            raise HTTPException(status_code=404, detail="Share ID not found.")
-        if allow_list := share.user_whitelist:
-            if not (session and session.user_id in allow_list.split("$")):
-                raise HTTPException(status_code=403, detail="Not on share list.")
-        elif not (share.anonymous_access or session):
-            raise HTTPException(status_code=401, detail="Share not publicly accessible.")
-        if not share.collaborative:
-            return RedirectResponse(url=request.url_for("get_share", share_id=share_id, file_path=file_path))
-        share_path = Path(share.path)
-        # owner_id = share_path.parts[0]
-        # share_path = share_path.relative_to(owner_id)
-        # share_subpath = share_path / file_path
-        return await get_collab_response(
-            request=request,
-            share_id=share_id,
-            base=share_path,
-            file_path=file_path,
-            username=session.username if session else None,
-            access_level=session.access_level if session else -1,
-        )
+    share = await resolve_share(session, share_id)
+    if not share.collaborative:
+        return RedirectResponse(url=request.url_for("get_share", share_id=share_id, file_path=file_path))
+    share_path = share.path
+    # owner_id = share_path.parts[0]
+    # share_path = share_path.relative_to(owner_id)
+    # share_subpath = share_path / file_path
+    return await get_collab_response(
+        request=request,
+        share_id=share_id,
+        base=share_path,
+        file_path=file_path,
+        username=session.username if session else None,
+        access_level=session.access_level if session else -1,
+        listing=listing,
+    )
 
 
 @app.post("/new_share")
@@ -570,9 +982,44 @@ async def move(
         to_base=to_base or base,
         file_path=file_path,
         to=to,
+        owner=session.user_id,
     )
 
 
+@app.post("/batch")
+async def batch(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    operations: Annotated[list[file_handler.BatchOperation], Body()],
+    to_public: Annotated[bool, Body()],
+):
+    """Moves, renames and deletes a whole selection in one request. A move to "" is into the home folder and
+    one to "||public||" into the public folder, as with /move.
+    """
+    if session is None:
+        raise HTTPException(status_code=401, detail="Anonymous users cannot move, rename or delete!")
+    base = CONFIG.get("public_directory") if to_public and CONFIG.get("public_directory") else session.user_id
+    try:
+        return await file_handler.run_batch(
+            base,
+            operations,
+            owner=session.user_id,
+            roots={"": session.user_id, "||public||": CONFIG.get("public_directory") or session.user_id},
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+
+
+@app.get("/jobs")
+async def list_jobs(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="Not logged in.")
+    return file_handler.get_tree_jobs(session.user_id)
+
+
 # FIXME
 @app.post("/compose")
 async def compose_file_view(
@@ -587,9 +1034,10 @@ async def compose_file_view(
         base = CONFIG.get("public_directory")
     else:
         base = session.user_id
-    files = await file_handler.list_files(base=str(base), subfolder=file_path)
-    if files is None:
+    listed = await file_handler.list_files(base=str(base), subfolder=file_path)
+    if listed is None:
         raise HTTPException(status_code=404, detail="Unable to get files")
+    files, _ = listed
     return templates.TemplateResponse(
         request=request,
         name="compose_file_list.html",
@@ -617,9 +1065,79 @@ async def upload(
         file_path=file_path,
         files=files,
         compression=compression_level,
+        owner=session.user_id,
+    )
+
+
+@app.post("/upload/session")
+async def create_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    file_path: Annotated[str, Body()],
+    to_public: Annotated[bool, Body()],
+    filename: Annotated[str, Body()],
+    size: Annotated[int, Body()],
+    compression_level: Annotated[int, Body()] = 0,
+    sha256: Annotated[Optional[str], Body()] = None,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="You may not upload anonymously!")
+    return await file_handler.create_upload_session(
+        base=CONFIG.get("public_directory") if to_public and CONFIG.get("public_directory") else session.user_id,
+        file_path=file_path,
+        filename=filename,
+        size=size,
+        owner=session.user_id,
+        compression=compression_level,
+        content_sha256=sha256,
     )
 
 
+@app.head("/upload/session/{upload_id}")
+async def get_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    upload_id: str,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="You may not upload anonymously!")
+    return upload_session_response(await file_handler.get_upload_session(upload_id, session.user_id))
+
+
+@app.patch("/upload/session/{upload_id}")
+async def upload_chunk(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    upload_id: str,
+    upload_offset: Annotated[int, Header()],
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="You may not upload anonymously!")
+    return await file_handler.write_upload_chunk(upload_id, session.user_id, upload_offset, request.stream())
+
+
+@app.post("/upload/session/{upload_id}/finish")
+async def finish_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    upload_id: str,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="You may not upload anonymously!")
+    return await file_handler.finish_upload_session(upload_id, session.user_id)
+
+
+@app.delete("/upload/session/{upload_id}")
+async def cancel_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    upload_id: str,
+):
+    if session is None:
+        raise HTTPException(status_code=401, detail="You may not upload anonymously!")
+    return await file_handler.cancel_upload_session(upload_id, session.user_id)
+
+
 @app.post("/delete")
 async def delete(
     request: Request,
@@ -646,7 +1164,7 @@ async def change_password(
         raise HTTPException(status_code=401, detail="Cannot change password without being logged in first!")
     if new_password != confirm_new_password:
         return (False, "New passwords must match!")
-    return auth.change_password(session.username, new_password=new_password, old_password=old_password)
+    return await auth.change_password(session.username, new_password=new_password, old_password=old_password)
 
 
 @app.post("/add_password")
@@ -662,8 +1180,8 @@ async def add_password(
         return (False, "Cannot add a blank password!")
     if new_password != confirm_new_password:
         return (False, "New passwords must match!")
-    if not auth.check_user_has_password(session.username):
-        return auth.change_password(session.username, new_password=new_password)
+    if not await auth.check_user_has_password(session.username):
+        return await auth.change_password(session.username, new_password=new_password)
     return (False, "Cannot add a password to an account that already has one!")
 
 
@@ -674,7 +1192,7 @@ async def remove_password(
 ):
     if session is None:
         raise HTTPException(status_code=401, detail="Cannot remove password without being logged in first!")
-    return auth.remove_password(session.username)
+    return await auth.remove_password(session.username)
 
 
 @app.post("/change_username")
@@ -685,7 +1203,7 @@ async def change_username(
 ):
     if session is None:
         raise HTTPException(status_code=401, detail="Cannot change username without being logged in first!")
-    return auth.change_username(old_username=session.username, new_username=new_username)
+    return await auth.change_username(old_username=session.username, new_username=new_username)
 
 
 @app.get("/login")
@@ -708,7 +1226,7 @@ async def login_page(request: Request, next: Optional[str] = None, messages: Opt
 async def login(request: Request, form: Annotated[OAuth2PasswordRequestForm, Security()], next: Optional[str] = None):
     username = form.username
     password = form.password
-    success = auth.login_with_password(username, password)
+    success = await auth.login_with_password(username, password)
     if success:
         # Get rid of any unexpected redirects
         if next:
@@ -721,7 +1239,9 @@ async def login(request: Request, form: Annotated[OAuth2PasswordRequestForm, Sec
         )  # type:ignore
         response.set_cookie(
             key="session_id",
-            value=auth.new_session(username, invalidate_previous_sessions=CONFIG.get("multiple_sessions_signout")),
+            value=await auth.new_session(
+                username, invalidate_previous_sessions=CONFIG.get("multiple_sessions_signout")
+            ),
             # secure=True,
             max_age=int(auth.SESSION_EXPIRY.total_seconds()),
         )
@@ -782,14 +1302,14 @@ async def enroll(
     stored_passcode = CONFIG.get("self_enrollment_passcode")
     if stored_passcode and passcode != stored_passcode:
         return await enroll_page(request=request, next=next, messages=[("error", "Passcode is incorrect!")])
-    success, message = auth.add_user(username=username, password=password)
+    success, message = await auth.add_user(username=username, password=password)
     if success:
         response = RedirectResponse(
             url=next or request.url_for("root"), status_code=status.HTTP_303_SEE_OTHER
         )  # type:ignore
         response.set_cookie(
             key="session_id",
-            value=auth.new_session(username),
+            value=await auth.new_session(username),
             # secure=True,
             max_age=int(auth.SESSION_EXPIRY.total_seconds()),
         )
@@ -844,9 +1364,34 @@ async def collab_move(
         to_base=share_info["base"],
         file_path=file_path,
         to=to,
+        owner=share_id,
     )
 
 
+@app.post("/collab/{share_id}/batch")
+async def collab_batch(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    operations: Annotated[list[file_handler.BatchOperation], Body(embed=True)],
+):
+    share_info = await get_collab_share_info(session, share_id)
+    try:
+        return await file_handler.run_batch(share_info["base"], operations, owner=share_id)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from error
+
+
+@app.get("/collab/{share_id}/jobs")
+async def collab_list_jobs(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+):
+    await get_collab_share_info(session, share_id)
+    return file_handler.get_tree_jobs(share_id)
+
+
 @app.post("/collab/{share_id}/upload")
 async def collab_upload(
     request: Request,
@@ -862,9 +1407,78 @@ async def collab_upload(
         file_path=file_path,
         files=files,
         compression=compression_level,
+        owner=share_id,
     )
 
 
+@app.post("/collab/{share_id}/upload/session")
+async def collab_create_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    file_path: Annotated[str, Body()],
+    filename: Annotated[str, Body()],
+    size: Annotated[int, Body()],
+    compression_level: Annotated[int, Body()] = 0,
+    sha256: Annotated[Optional[str], Body()] = None,
+):
+    share_info = await get_collab_share_info(session, share_id)
+    return await file_handler.create_upload_session(
+        base=share_info["base"],
+        file_path=file_path,
+        filename=filename,
+        size=size,
+        owner=share_id,
+        compression=compression_level,
+        content_sha256=sha256,
+    )
+
+
+@app.head("/collab/{share_id}/upload/session/{upload_id}")
+async def collab_get_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    upload_id: str,
+):
+    await get_collab_share_info(session, share_id)
+    return upload_session_response(await file_handler.get_upload_session(upload_id, share_id))
+
+
+@app.patch("/collab/{share_id}/upload/session/{upload_id}")
+async def collab_upload_chunk(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    upload_id: str,
+    upload_offset: Annotated[int, Header()],
+):
+    await get_collab_share_info(session, share_id)
+    return await file_handler.write_upload_chunk(upload_id, share_id, upload_offset, request.stream())
+
+
+@app.post("/collab/{share_id}/upload/session/{upload_id}/finish")
+async def collab_finish_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    upload_id: str,
+):
+    await get_collab_share_info(session, share_id)
+    return await file_handler.finish_upload_session(upload_id, share_id)
+
+
+@app.delete("/collab/{share_id}/upload/session/{upload_id}")
+async def collab_cancel_upload_session(
+    request: Request,
+    session: Annotated[Optional[auth.Session], Security(get_session)],
+    share_id: str,
+    upload_id: str,
+):
+    await get_collab_share_info(session, share_id)
+    return await file_handler.cancel_upload_session(upload_id, share_id)
+
+
 @app.post("/collab/{share_id}/delete")
 async def collab_delete(
     request: Request,
@@ -885,7 +1499,7 @@ async def collab_delete(
 async def logout(request: Request, session: Annotated[Optional[auth.Session], Security(get_session)]):
     response = RedirectResponse(url=request.url_for("root"))
     if session:
-        auth.invalidate_session(session.session_id)
+        await auth.invalidate_session(session.session_id)
         response.delete_cookie(key="session_id")
     return response
 
@@ -2,7 +2,7 @@ from datetime import datetime
 from typing import Optional
 from uuid import uuid4
 
-from sqlalchemy import BLOB, Boolean, DateTime, ForeignKey, String, Integer
+from sqlalchemy import BLOB, BigInteger, Boolean, DateTime, ForeignKey, Integer, String
 from sqlalchemy.orm import DeclarativeBase, Mapped, MappedAsDataclass, mapped_column, relationship
 
 
@@ -18,20 +18,80 @@ class PublicKey(Base):
     name: Mapped[str] = mapped_column(String(32))
 
 
+class ShareAllowedUser(Base):
+    __tablename__ = "ShareWhitelist"
+
+    share_id: Mapped[bytes] = mapped_column(ForeignKey("Shares.share_id", ondelete="CASCADE"), primary_key=True)
+    user_id: Mapped[bytes] = mapped_column(
+        ForeignKey("Users.user_id", ondelete="CASCADE"), primary_key=True, index=True
+    )
+
+
 class Share(Base):
     __tablename__ = "Shares"
 
     owner: Mapped[bytes] = mapped_column(ForeignKey("Users.user_id"))
     expires: Mapped[Optional[datetime]] = mapped_column(DateTime(), nullable=True)
-    path: Mapped[str] = mapped_column(String(32760))  # https://en.wikipedia.org/wiki/Comparison_of_file_systems#Limits
+    # https://en.wikipedia.org/wiki/Comparison_of_file_systems#Limits
+    path: Mapped[str] = mapped_column(String(32760), index=True)
     anonymous_access: Mapped[bool] = mapped_column(Boolean())
-    user_whitelist: Mapped[Optional[str]] = mapped_column(
-        String(), nullable=True
-    )  # TODO - Maybe make it an "association" class?
+    # Legacy "$"-joined allow list, moved into ShareWhitelist on startup. New shares leave it empty.
+    user_whitelist: Mapped[Optional[str]] = mapped_column(String(), nullable=True, default=None)
     collaborative: Mapped[bool] = mapped_column(Boolean(), default=False)
+    allowed_users: Mapped[list[ShareAllowedUser]] = relationship(
+        "ShareAllowedUser", default_factory=list, cascade="all, delete-orphan"
+    )
     share_id: Mapped[bytes] = mapped_column(BLOB(16), primary_key=True, default_factory=lambda: uuid4().bytes)
 
 
+class LoginSession(Base):
+    __tablename__ = "Sessions"
+
+    session_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    user_id: Mapped[bytes] = mapped_column(ForeignKey("Users.user_id", ondelete="CASCADE"), index=True)
+    username: Mapped[str] = mapped_column(String(24))
+    access_level: Mapped[int] = mapped_column(Integer)
+    expires: Mapped[datetime] = mapped_column(DateTime(), index=True)
+
+
+class RevokedSession(Base):
+    """A signed session token that may no longer be used, or a user whose tokens issued before revoked may not."""
+
+    __tablename__ = "RevokedSessions"
+
+    # The SHA-256 of a token (64 hex digits) or a user ID (32 hex digits)
+    revoked_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    revoked: Mapped[datetime] = mapped_column(DateTime())
+    # Once every token this applies to has run out, it can be forgotten
+    expires: Mapped[datetime] = mapped_column(DateTime(), index=True)
+
+
+class StoredUpload(Base):
+    """A resumable upload in progress, kept here so its chunks may reach any worker."""
+
+    __tablename__ = "Uploads"
+
+    upload_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(32))
+    uploaded_file: Mapped[str] = mapped_column(String(32760))
+    temporary_file: Mapped[str] = mapped_column(String(32760))
+    size: Mapped[int] = mapped_column(BigInteger)
+    compression: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    expires: Mapped[datetime] = mapped_column(DateTime(), index=True)
+    digest: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, default=None)
+
+
+class UploadRange(Base):
+    """A byte range of a resumable upload that has been written. Ranges may overlap, and are merged on reading."""
+
+    __tablename__ = "UploadRanges"
+
+    upload_id: Mapped[str] = mapped_column(ForeignKey("Uploads.upload_id", ondelete="CASCADE"), index=True)
+    start: Mapped[int] = mapped_column(BigInteger)
+    end: Mapped[int] = mapped_column(BigInteger)
+    range_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True, init=False)
+
+
 class User(Base):
     __tablename__ = "Users"
 
@@ -0,0 +1,267 @@
+"""File responses with byte range and conditional request support, shared by every download route."""
+
+from collections.abc import AsyncIterator
+from email.utils import formatdate, parsedate_to_datetime
+from mimetypes import guess_type
+from os import PathLike, stat_result as StatResult
+from pathlib import Path
+from secrets import token_hex
+
+from anyio import open_file
+from starlette.concurrency import iterate_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from .compression import XZStream, iter_decompressed_range
+
+# More ranges than this in one request is almost certainly abuse, so the whole file is sent instead
+MAX_RANGES: int = 16
+# ASGI extensions that let the server send file contents itself (with sendfile), instead of the app reading them
+PATHSEND_EXTENSION: str = "http.response.pathsend"
+ZEROCOPYSEND_EXTENSION: str = "http.response.zerocopysend"
+
+
+def parse_range_header(range_header: str, size: int) -> list[tuple[int, int]] | None:
+    """Parses a Range header into sorted, merged (start, end) pairs with inclusive ends.
+    Returns None when the header should be ignored and an empty list when nothing is satisfiable.
+    """
+    unit, _, range_specifiers = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges: list[tuple[int, int]] = []
+    for range_specifier in range_specifiers.split(","):
+        start_text, separator, end_text = range_specifier.strip().partition("-")
+        if not separator:
+            return None
+        try:
+            if not start_text:
+                suffix_length = int(end_text)
+                if suffix_length > 0 and size > 0:
+                    ranges.append((max(size - suffix_length, 0), size - 1))
+                continue
+            start = int(start_text)
+            end = int(end_text) if end_text else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def make_etag(stat_result: StatResult, variant: str = "") -> str:
+    """A strong validator: the same inode, modification time and size always means the same bytes."""
+    return f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}{variant}"'
+
+
+def etag_matches(header_value: str, etag: str, *, weak: bool = True) -> bool:
+    for value in header_value.split(","):
+        candidate = value.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def header_timestamp(header_value: str) -> float | None:
+    try:
+        return parsedate_to_datetime(header_value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class RangedFileResponse(Response):
+    """Serves a file with Range, If-Range, If-None-Match and If-Modified-Since handling.
+    Conditional requests are answered from the stat result alone, so a 304 never opens the file.
+    When the server offers the pathsend or zerocopysend extension, the bytes never pass through Python.
+    """
+
+    chunk_size: int = 1024 * 1024
+    # Whether the bytes sent are the file's own, so the server can be handed the file instead
+    zero_copy: bool = True
+
+    def __init__(
+        self,
+        path: PathLike[str] | str,
+        request_headers: Headers,
+        *,
+        stat_result: StatResult | None = None,
+        media_type: str | None = None,
+    ) -> None:
+        self.path = Path(path)
+        self.stat_result = stat_result or self.path.stat()
+        self.size = self.get_size()
+        self.etag = self.get_etag()
+        self.content_type = media_type or guess_type(self.path)[0] or "application/octet-stream"
+        self.background = None
+        self.body = b""
+        self.media_type = None
+        self.ranges: list[tuple[int, int]] = []
+        self.boundary = ""
+
+        headers = {
+            "Accept-Ranges": "bytes",
+            "ETag": self.etag,
+            "Last-Modified": formatdate(self.stat_result.st_mtime, usegmt=True),
+        }
+        if self.is_not_modified(request_headers):
+            self.status_code = 304
+            self.init_headers(headers)
+            return
+
+        ranges = None
+        if (range_header := request_headers.get("range")) and self.should_use_range(request_headers.get("if-range")):
+            ranges = parse_range_header(range_header, self.size)
+        if ranges is None:
+            self.status_code = 200
+            self.ranges = [(0, self.size - 1)] if self.size else []
+            headers |= {"Content-Type": self.content_type, "Content-Length": str(self.size)}
+        elif not ranges:
+            self.status_code = 416
+            headers |= {"Content-Range": f"bytes */{self.size}", "Content-Length": "0"}
+        elif len(ranges) == 1:
+            self.status_code = 206
+            self.ranges = ranges
+            start, end = ranges[0]
+            headers |= {
+                "Content-Type": self.content_type,
+                "Content-Range": f"bytes {start}-{end}/{self.size}",
+                "Content-Length": str(end - start + 1),
+            }
+        else:
+            self.status_code = 206
+            self.ranges = ranges
+            self.boundary = token_hex(13)
+            content_length = sum(len(self.part_header(start, end)) + end - start + 3 for start, end in ranges)
+            content_length += len(self.boundary) + 6
+            headers |= {
+                "Content-Type": f"multipart/byteranges; boundary={self.boundary}",
+                "Content-Length": str(content_length),
+            }
+        self.init_headers(headers)
+
+    def get_size(self) -> int:
+        return self.stat_result.st_size
+
+    def get_etag(self) -> str:
+        return make_etag(self.stat_result)
+
+    def is_not_modified(self, request_headers: Headers) -> bool:
+        if (if_none_match := request_headers.get("if-none-match")) is not None:
+            return etag_matches(if_none_match, self.etag)
+        if (if_modified_since := request_headers.get("if-modified-since")) is not None:
+            timestamp = header_timestamp(if_modified_since)
+            return timestamp is not None and int(self.stat_result.st_mtime) <= timestamp
+        return False
+
+    def should_use_range(self, if_range: str | None) -> bool:
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', "W/")):
+            return etag_matches(if_range, self.etag, weak=False)
+        return header_timestamp(if_range) == int(self.stat_result.st_mtime)
+
+    def part_header(self, start: int, end: int) -> bytes:
+        return (
+            f"--{self.boundary}\r\nContent-Type: {self.content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n"
+        ).encode("latin-1")
+
+    async def iter_range(self, start: int, end: int) -> AsyncIterator[bytes]:
+        async with await open_file(self.path, "rb") as file_:
+            await file_.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await file_.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    async def send_zero_copy(self, extensions: dict, send: Send) -> bool:
+        """Hands the whole file (pathsend) or its one range (zerocopysend) to the server to send.
+        Returns False, having sent nothing, when the server supports neither for this response.
+        """
+        if not self.zero_copy or self.boundary:
+            return False
+        start, end = self.ranges[0]
+        if PATHSEND_EXTENSION in extensions and start == 0 and end == self.size - 1:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return True
+        if ZEROCOPYSEND_EXTENSION in extensions:
+            async with await open_file(self.path, "rb") as file_:
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": file_.wrapped,
+                        "offset": start,
+                        "count": end - start + 1,
+                        "more_body": False,
+                    }
+                )
+            return True
+        return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or not self.ranges:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if await self.send_zero_copy(scope.get("extensions") or {}, send):
+            return
+        for start, end in self.ranges:
+            if self.boundary:
+                await send({"type": "http.response.body", "body": self.part_header(start, end), "more_body": True})
+            async for chunk in self.iter_range(start, end):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if self.boundary:
+                await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+        if self.boundary:
+            await send({"type": "http.response.body", "body": f"--{self.boundary}--\r\n".encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class DecompressedFileResponse(RangedFileResponse):
+    """Serves the original contents of an .xz file, decompressing on the fly in a worker thread.
+    Range requests only decompress from the start of the xz stream containing the range.
+    """
+
+    zero_copy: bool = False
+
+    def __init__(
+        self,
+        path: PathLike[str] | str,
+        request_headers: Headers,
+        *,
+        streams: tuple[XZStream, ...],
+        stat_result: StatResult | None = None,
+        media_type: str | None = None,
+    ) -> None:
+        self.streams = streams
+        super().__init__(path, request_headers, stat_result=stat_result, media_type=media_type)
+
+    def get_size(self) -> int:
+        return sum(stream.uncompressed_size for stream in self.streams)
+
+    def get_etag(self) -> str:
+        return make_etag(self.stat_result, variant="-xz")
+
+    async def iter_range(self, start: int, end: int) -> AsyncIterator[bytes]:
+        async for chunk in iterate_in_threadpool(iter_decompressed_range(self.path, self.streams, start, end)):
+            yield chunk
@@ -0,0 +1,354 @@
+"""Finds files by name, and optionally by the text inside them, from an index instead of by walking folders.
+The index is an SQLite database of its own, with full-text (FTS5) tables for names and contents. The app's own
+changes are written to it as they happen, and a crawler goes over the upload directory now and then to catch
+up with changes made outside the app.
+"""
+
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
+from os import scandir, sep, stat_result as StatResult
+from os.path import splitext
+from pathlib import Path
+from queue import Empty, SimpleQueue
+from threading import Event, Thread, local
+from time import monotonic
+
+from .config import CONFIG
+
+SEARCH_BATCH_SIZE: int = 1000
+SEARCH_RESULT_LIMIT: int = 100
+# Plain text can be indexed as it is; other documents would each need a parser
+TEXT_EXTENSIONS: tuple[str, ...] = (".txt", ".md", ".rst")
+SEARCH_CONTENT_LIMIT: int = CONFIG.get("search_content_limit", 1024 * 1024)
+SEARCH_CRAWL_INTERVAL: float = CONFIG.get("search_crawl_interval", 3600)
+# Names are indexed as trigrams, so any part of a name of three characters or more is found from the index
+SEARCH_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    modified REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+CREATE VIRTUAL TABLE IF NOT EXISTS file_names USING fts5(name, content='files', content_rowid='id', tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS file_contents USING fts5(body);
+CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+    INSERT INTO file_names (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+    INSERT INTO file_names (file_names, rowid, name) VALUES ('delete', old.id, old.name);
+    DELETE FROM file_contents WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS files_rename AFTER UPDATE OF name ON files BEGIN
+    INSERT INTO file_names (file_names, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO file_names (rowid, name) VALUES (new.id, new.name);
+END;
+"""
+
+# (path relative to the upload directory, whether it is a folder, size, modified time, found by its contents)
+SearchHit = tuple[str, bool, int, float, bool]
+
+
+@lru_cache
+def has_fts5() -> bool:
+    """Whether the SQLite Python was built against has FTS5 with the trigram tokenizer (3.34 and later)."""
+    try:
+        with closing(sqlite3.connect(":memory:")) as connection:
+            connection.execute("CREATE VIRTUAL TABLE names USING fts5(name, tokenize='trigram')")
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def get_search_database() -> Path:
+    if search_database := CONFIG.get("search_database"):
+        return Path(search_database)
+    return Path(CONFIG["upload_directory"]) / ".search.sqlite3"
+
+
+def connect(database: Path) -> sqlite3.Connection:
+    # Several workers can share the database; WAL lets them read while one of them writes
+    connection = sqlite3.connect(database, timeout=30)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+
+def get_parent_key(key: str) -> str:
+    return key.rpartition(sep)[0]
+
+
+def subtree_condition(column: str) -> str:
+    """Everything below a path given as the parameter, written as a range so it is answered from the index."""
+    return f"({column} > ? || '{sep}' AND {column} < ? || '{chr(ord(sep) + 1)}')"
+
+
+def get_name_terms(query: str) -> tuple[str | None, list[str]]:
+    """Splits a query into an FTS5 expression for the terms long enough to have trigrams,
+    and LIKE patterns for the rest. Every term has to be in the name.
+    """
+    long_terms = []
+    patterns = []
+    for term in query.split():
+        if len(term) >= 3:
+            long_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            patterns.append(f"%{escaped}%")
+    return (" AND ".join(long_terms) or None, patterns)
+
+
+def get_content_expression(query: str) -> str | None:
+    """Every term has to start a word of the contents."""
+    return " AND ".join('"' + term.replace('"', '""') + '"*' for term in query.split()) or None
+
+
+class SearchIndex:
+    """Keeps the index of everything under root. Changes are queued and written by a single thread, in batches,
+    so recording one never waits on the database; searches read through a connection per worker thread.
+    """
+
+    def __init__(self, database: Path, root: Path, hidden_prefix: str) -> None:
+        self.database = database
+        self.root = root
+        self.hidden_prefix = hidden_prefix
+        self.index_contents = bool(CONFIG.get("search_index_contents", False))
+        self.operations: SimpleQueue[tuple | None] = SimpleQueue()
+        self.stopping = Event()
+        self.readers = local()
+        self.writer: Thread | None = None
+
+    @classmethod
+    def create(cls, database: Path, root: Path, hidden_prefix: str) -> "SearchIndex | None":
+        if not has_fts5():
+            return None
+        try:
+            with closing(connect(database)) as connection:
+                connection.executescript(SEARCH_SCHEMA)
+        except sqlite3.Error:
+            return None
+        return cls(database, root, hidden_prefix)
+
+    def start(self) -> None:
+        self.writer = Thread(target=self.run, name="search-index", daemon=True)
+        self.writer.start()
+
+    def close(self) -> None:
+        self.stopping.set()
+        self.operations.put(None)
+        if self.writer is not None:
+            self.writer.join(timeout=5)
+
+    def add(self, path: Path) -> None:
+        """Records a new or changed file, or a folder with everything in it."""
+        self.operations.put(("add", path))
+
+    def remove(self, path: Path) -> None:
+        """Forgets a file, or a folder with everything in it."""
+        self.operations.put(("remove", path))
+
+    def move(self, path: Path, new_path: Path) -> None:
+        self.operations.put(("move", path, new_path))
+
+    def get_key(self, path: Path) -> str:
+        relative_path = path.relative_to(self.root)
+        return "" if relative_path == Path(".") else str(relative_path)
+
+    def run(self) -> None:
+        connection = connect(self.database)
+        next_crawl = monotonic()
+        try:
+            while not self.stopping.is_set():
+                if monotonic() >= next_crawl:
+                    self.crawl(connection)
+                    next_crawl = monotonic() + SEARCH_CRAWL_INTERVAL
+                    continue
+                try:
+                    operation = self.operations.get(timeout=max(next_crawl - monotonic(), 0))
+                except Empty:
+                    continue
+                if operation is not None:
+                    self.apply_queued(connection, [operation])
+        finally:
+            connection.close()
+
+    def apply_queued(self, connection: sqlite3.Connection, operations: list[tuple] | None = None) -> None:
+        """Writes the given operations and whatever else is queued, up to a batch, in one transaction."""
+        operations = operations or []
+        while len(operations) < SEARCH_BATCH_SIZE:
+            try:
+                operation = self.operations.get_nowait()
+            except Empty:
+                break
+            if operation is not None:
+                operations.append(operation)
+        if not operations:
+            return
+        with connection:
+            for kind, *paths in operations:
+                try:
+                    if kind == "add":
+                        self.add_tree(connection, paths[0])
+                    elif kind == "remove":
+                        self.remove_tree(connection, self.get_key(paths[0]))
+                    elif kind == "move":
+                        self.move_tree(connection, paths[0], paths[1])
+                except (OSError, ValueError, sqlite3.Error):
+                    continue
+
+    def write_entry(
+        self,
+        connection: sqlite3.Connection,
+        path: str,
+        key: str,
+        is_dir: bool,
+        stat_result: StatResult,
+        file_id: int | None,
+    ) -> None:
+        """Takes plain strings, since making Path objects for every entry would take most of a crawl's time."""
+        parent, _, name = key.rpartition(sep)
+        size = 0 if is_dir else stat_result.st_size
+        if file_id is None:
+            cursor = connection.execute(
+                "INSERT INTO files (path, parent, name, is_dir, size, modified) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, parent, name, is_dir, size, stat_result.st_mtime),
+            )
+            file_id = cursor.lastrowid
+        else:
+            connection.execute(
+                "UPDATE files SET is_dir = ?, size = ?, modified = ? WHERE id = ?",
+                (is_dir, size, stat_result.st_mtime, file_id),
+            )
+            connection.execute("DELETE FROM file_contents WHERE rowid = ?", (file_id,))
+        if not self.index_contents or is_dir or size > SEARCH_CONTENT_LIMIT:
+            return
+        if splitext(name)[1].lower() in TEXT_EXTENSIONS:
+            with open(path, "rb") as file_:
+                body = file_.read().decode(errors="replace")
+            connection.execute("INSERT INTO file_contents (rowid, body) VALUES (?, ?)", (file_id, body))
+
+    def add_tree(self, connection: sqlite3.Connection, path: Path) -> None:
+        if path.name.startswith(self.hidden_prefix):
+            return
+        key = self.get_key(path)
+        row = connection.execute("SELECT id, size, modified FROM files WHERE path = ?", (key,)).fetchone()
+        stat_result = path.stat(follow_symlinks=False)
+        is_dir = path.is_dir()
+        if row is None or row[1:] != (0 if is_dir else stat_result.st_size, stat_result.st_mtime):
+            self.write_entry(connection, str(path), key, is_dir, stat_result, row[0] if row else None)
+        if is_dir and not path.is_symlink():
+            directories = [path]
+            while directories:
+                directories.extend(self.reconcile_directory(connection, directories.pop()))
+
+    def remove_tree(self, connection: sqlite3.Connection, key: str) -> None:
+        connection.execute(f"DELETE FROM files WHERE path = ? OR {subtree_condition('path')}", (key, key, key))
+
+    def move_tree(self, connection: sqlite3.Connection, path: Path, new_path: Path) -> None:
+        """Moving a folder rewrites the paths below it, but leaves their names (and their trigrams) alone."""
+        key = self.get_key(path)
+        new_key = self.get_key(new_path)
+        self.remove_tree(connection, new_key)
+        moved = connection.execute(
+            "UPDATE files SET path = ?, parent = ?, name = ? WHERE path = ?",
+            (new_key, get_parent_key(new_key), new_path.name, key),
+        ).rowcount
+        if not moved:
+            self.remove_tree(connection, key)
+            self.add_tree(connection, new_path)
+            return
+        connection.execute(
+            "UPDATE files SET path = ? || substr(path, ?), parent = ? || substr(parent, ?)"
+            f" WHERE {subtree_condition('path')}",
+            (new_key, len(key) + 1, new_key, len(key) + 1, key, key),
+        )
+
+    def reconcile_directory(self, connection: sqlite3.Connection, directory: Path) -> list[Path]:
+        """Brings the entries of one folder in line with what is on disk, returning its subfolders to go into."""
+        parent = self.get_key(directory)
+        prefix = f"{parent}{sep}" if parent else ""
+        # Dot entries next to the home folders are the app's own (the trash, the content store, this index)
+        hidden_prefixes = (self.hidden_prefix, ".") if directory == self.root else (self.hidden_prefix,)
+        stored = {
+            name: (file_id, size, modified)
+            for file_id, name, size, modified in connection.execute(
+                "SELECT id, name, size, modified FROM files WHERE parent = ?", (parent,)
+            )
+        }
+        subdirectories = []
+        try:
+            with scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith(hidden_prefixes):
+                        continue
+                    try:
+                        stat_result = entry.stat(follow_symlinks=False)
+                        is_dir = entry.is_dir()
+                        row = stored.pop(entry.name, None)
+                        if row is None or row[1:] != (0 if is_dir else stat_result.st_size, stat_result.st_mtime):
+                            file_id = row[0] if row else None
+                            self.write_entry(connection, entry.path, prefix + entry.name, is_dir, stat_result, file_id)
+                    except OSError:
+                        continue
+                    if is_dir and not entry.is_symlink():
+                        subdirectories.append(Path(entry.path))
+        except OSError:
+            return []
+        for name in stored:
+            self.remove_tree(connection, prefix + name)
+        return subdirectories
+
+    def crawl(self, connection: sqlite3.Connection) -> None:
+        """Goes over everything under root one folder at a time, writing the app's own changes in between
+        so they never wait for the whole crawl.
+        """
+        directories = [self.root]
+        while directories and not self.stopping.is_set():
+            self.apply_queued(connection)
+            with connection:
+                directories.extend(self.reconcile_directory(connection, directories.pop()))
+
+    def get_reader(self) -> sqlite3.Connection:
+        if (reader := getattr(self.readers, "connection", None)) is None:
+            reader = self.readers.connection = connect(self.database)
+        return reader
+
+    def search(self, directory: Path, query: str, limit: int = SEARCH_RESULT_LIMIT) -> list[SearchHit]:
+        """Finds what is below directory with every term of query in its name, then (when contents are
+        indexed) what has every term in its text. Runs in a worker thread.
+        """
+        key = self.get_key(directory)
+        connection = self.get_reader()
+        expression, patterns = get_name_terms(query)
+        conditions = [subtree_condition("files.path")] + ["files.name LIKE ? ESCAPE '\\'"] * len(patterns)
+        parameters: list = [key, key] + patterns
+        columns = "files.path, files.is_dir, files.size, files.modified"
+        if expression is not None:
+            name_query = (
+                f"SELECT {columns} FROM file_names JOIN files ON files.id = file_names.rowid"
+                f" WHERE file_names MATCH ? AND {' AND '.join(conditions)} LIMIT ?"
+            )
+            parameters = [expression] + parameters
+        elif patterns:
+            name_query = f"SELECT {columns} FROM files WHERE {' AND '.join(conditions)} LIMIT ?"
+        else:
+            return []
+        hits = [
+            (path, bool(is_dir), size, modified, False)
+            for path, is_dir, size, modified in connection.execute(name_query, parameters + [limit])
+        ]
+        if self.index_contents and len(hits) < limit and (content_expression := get_content_expression(query)):
+            found = {hit[0] for hit in hits}
+            content_query = (
+                f"SELECT {columns} FROM file_contents JOIN files ON files.id = file_contents.rowid"
+                f" WHERE file_contents MATCH ? AND {subtree_condition('files.path')} LIMIT ?"
+            )
+            content_parameters = (content_expression, key, key, limit)
+            for path, is_dir, size, modified in connection.execute(content_query, content_parameters):
+                if path not in found and len(hits) < limit:
+                    hits.append((path, bool(is_dir), size, modified, True))
+        return hits
@@ -0,0 +1,384 @@
+"""Interchangeable places to keep login sessions, so several workers or nodes can share them."""
+
+from abc import ABC, abstractmethod
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from hashlib import sha256
+from heapq import heapify, heappop, heappush
+from hmac import compare_digest, digest
+from json import dumps, loads
+from secrets import token_hex
+from threading import Lock
+from uuid import uuid1
+
+from sqlalchemy import delete, select, update
+
+from .database import SessionMaker
+from .objects import LoginSession, RevokedSession
+
+SESSION_LOCK_STRIPES: int = 16
+
+
+@dataclass(slots=True)
+class Session:
+    username: str
+    user_id: str
+    access_level: int
+    expires: datetime
+    session_id: str
+
+
+class SessionBackend(ABC):
+    """The interface auth uses for sessions, whichever backend holds them."""
+
+    @abstractmethod
+    async def create(self, username: str, user_id: str, access_level: int, expires: datetime) -> Session: ...
+
+    @abstractmethod
+    async def get(self, session_id: str) -> Session | None: ...
+
+    @abstractmethod
+    async def remove(self, session_id: str) -> None: ...
+
+    @abstractmethod
+    async def remove_user(self, user_id: str) -> None: ...
+
+    @abstractmethod
+    async def update_user(
+        self, user_id: str, *, username: str | None = None, access_level: int | None = None
+    ) -> None: ...
+
+    @abstractmethod
+    async def expire(self) -> None: ...
+
+
+class MemorySessionBackend(SessionBackend):
+    """Live sessions in this process, indexed by session ID and by user ID.
+    Looking a session up never takes a lock, since a single dict lookup is already atomic.
+    Changes only lock the stripe belonging to the session's user, and expiry is driven
+    by a heap, so nothing ever has to scan every session.
+    Removing a session leaves its entry in the heap until it would have expired, unless removed sessions come to
+    outnumber the live ones, in which case the heap is rebuilt from the live sessions.
+    """
+
+    def __init__(self, stripes: int = SESSION_LOCK_STRIPES) -> None:
+        self.sessions: dict[str, Session] = {}
+        self.user_sessions: dict[str, set[str]] = {}
+        self.locks: list[Lock] = [Lock() for _ in range(stripes)]
+        self.expiry_lock = Lock()
+        self.expiry_heap: list[tuple[datetime, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def lock_for(self, user_id: str) -> Lock:
+        return self.locks[hash(user_id) % len(self.locks)]
+
+    async def create(self, username: str, user_id: str, access_level: int, expires: datetime) -> Session:
+        session = Session(
+            username=username, user_id=user_id, access_level=access_level, expires=expires, session_id=uuid1().hex
+        )
+        self.add(session)
+        return session
+
+    def add(self, session: Session) -> None:
+        with self.lock_for(session.user_id):
+            self.sessions[session.session_id] = session
+            self.user_sessions.setdefault(session.user_id, set()).add(session.session_id)
+        with self.expiry_lock:
+            heappush(self.expiry_heap, (session.expires, session.session_id))
+
+    async def get(self, session_id: str) -> Session | None:
+        session = self.sessions.get(session_id)
+        if session and datetime.now() > session.expires:
+            await self.remove(session_id)
+            return None
+        return session
+
+    async def remove(self, session_id: str) -> None:
+        if not (session := self.sessions.get(session_id)):
+            return
+        with self.lock_for(session.user_id):
+            if self.sessions.pop(session_id, None) is None:
+                return
+            user_sessions = self.user_sessions.get(session.user_id, set())
+            user_sessions.discard(session_id)
+            if not user_sessions:
+                self.user_sessions.pop(session.user_id, None)
+        self.prune_expiry_heap()
+
+    async def remove_user(self, user_id: str) -> None:
+        with self.lock_for(user_id):
+            for session_id in self.user_sessions.pop(user_id, set()):
+                self.sessions.pop(session_id, None)
+        self.prune_expiry_heap()
+
+    def prune_expiry_heap(self) -> None:
+        """Drops the entries of removed sessions once they make up more than half of the heap. It then takes
+        at least as many removals again before the next rebuild, so on average each removal pays a constant.
+        """
+        with self.expiry_lock:
+            if len(self.expiry_heap) <= 2 * len(self.sessions):
+                return
+            self.expiry_heap = [(session.expires, session.session_id) for session in list(self.sessions.values())]
+            heapify(self.expiry_heap)
+
+    async def update_user(
+        self, user_id: str, *, username: str | None = None, access_level: int | None = None
+    ) -> None:
+        with self.lock_for(user_id):
+            for session_id in self.user_sessions.get(user_id, set()):
+                session = self.sessions[session_id]
+                if username is not None:
+                    session.username = username
+                if access_level is not None:
+                    session.access_level = access_level
+
+    async def expire(self) -> None:
+        now = datetime.now()
+        expired: list[str] = []
+        with self.expiry_lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expired.append(heappop(self.expiry_heap)[1])
+        for session_id in expired:
+            await self.remove(session_id)
+
+
+class DatabaseSessionBackend(SessionBackend):
+    """Sessions stored in the Sessions table, shared by every worker using the same database
+    and surviving restarts.
+    """
+
+    async def create(self, username: str, user_id: str, access_level: int, expires: datetime) -> Session:
+        session = Session(
+            username=username, user_id=user_id, access_level=access_level, expires=expires, session_id=uuid1().hex
+        )
+        async with SessionMaker() as engine:
+            engine.add(
+                LoginSession(
+                    session_id=session.session_id,
+                    user_id=bytes.fromhex(user_id),
+                    username=username,
+                    access_level=access_level,
+                    expires=expires,
+                )
+            )
+            await engine.commit()
+        return session
+
+    async def get(self, session_id: str) -> Session | None:
+        async with SessionMaker() as engine:
+            stored: LoginSession | None = await engine.get(LoginSession, session_id)
+            if not stored:
+                return None
+            if datetime.now() > stored.expires:
+                await engine.delete(stored)
+                await engine.commit()
+                return None
+            return Session(
+                username=stored.username,
+                user_id=stored.user_id.hex(),
+                access_level=stored.access_level,
+                expires=stored.expires,
+                session_id=stored.session_id,
+            )
+
+    async def remove(self, session_id: str) -> None:
+        async with SessionMaker() as engine:
+            await engine.execute(delete(LoginSession).where(LoginSession.session_id == session_id))
+            await engine.commit()
+
+    async def remove_user(self, user_id: str) -> None:
+        async with SessionMaker() as engine:
+            await engine.execute(delete(LoginSession).where(LoginSession.user_id == bytes.fromhex(user_id)))
+            await engine.commit()
+
+    async def update_user(
+        self, user_id: str, *, username: str | None = None, access_level: int | None = None
+    ) -> None:
+        changes: dict = {}
+        if username is not None:
+            changes["username"] = username
+        if access_level is not None:
+            changes["access_level"] = access_level
+        if not changes:
+            return
+        async with SessionMaker() as engine:
+            await engine.execute(
+                update(LoginSession).where(LoginSession.user_id == bytes.fromhex(user_id)).values(**changes)
+            )
+            await engine.commit()
+
+    async def expire(self) -> None:
+        async with SessionMaker() as engine:
+            await engine.execute(delete(LoginSession).where(LoginSession.expires < datetime.now()))
+            await engine.commit()
+
+
+class TokenSessionBackend(SessionBackend):
+    """Sessions that are not stored: the session ID is the session itself, signed with the secret key,
+    so any worker sharing the key can check it. Only revocations are stored, in the RevokedSessions table
+    every worker reads: logging out, deleting a user, and changing their name or access level, which a
+    token cannot reflect, so the user has to log in again.
+    """
+
+    def __init__(self, secret_key: bytes, lifetime: timedelta) -> None:
+        self.secret_key = secret_key
+        # How long tokens are issued for, so how long revoking all of a user's tokens has to be remembered
+        self.lifetime = lifetime
+
+    def sign(self, payload: bytes) -> bytes:
+        return digest(self.secret_key, payload, sha256)
+
+    async def create(self, username: str, user_id: str, access_level: int, expires: datetime) -> Session:
+        payload = dumps(
+            {
+                "u": username,
+                "i": user_id,
+                "l": access_level,
+                "e": expires.timestamp(),
+                "t": datetime.now().timestamp(),
+                "n": token_hex(4),
+            },
+            separators=(",", ":"),
+        ).encode()
+        session_id = b".".join(
+            urlsafe_b64encode(part).rstrip(b"=") for part in (payload, self.sign(payload))
+        ).decode()
+        return Session(
+            username=username, user_id=user_id, access_level=access_level, expires=expires, session_id=session_id
+        )
+
+    async def get(self, session_id: str) -> Session | None:
+        try:
+            encoded_payload, encoded_signature = session_id.encode().split(b".")
+            payload = urlsafe_b64decode(encoded_payload + b"=" * (-len(encoded_payload) % 4))
+            signature = urlsafe_b64decode(encoded_signature + b"=" * (-len(encoded_signature) % 4))
+        except ValueError:
+            return None
+        if not compare_digest(signature, self.sign(payload)):
+            return None
+        fields = loads(payload)
+        expires = datetime.fromtimestamp(fields["e"])
+        if datetime.now() > expires:
+            return None
+        token_key = get_token_key(session_id)
+        async with SessionMaker() as engine:
+            revocations = await engine.execute(
+                select(RevokedSession.revoked_id, RevokedSession.revoked).where(
+                    RevokedSession.revoked_id.in_((token_key, fields["i"]))
+                )
+            )
+            for revoked_id, revoked in revocations:
+                if revoked_id == token_key or datetime.fromtimestamp(fields["t"]) <= revoked:
+                    return None
+        return Session(
+            username=fields["u"],
+            user_id=fields["i"],
+            access_level=fields["l"],
+            expires=expires,
+            session_id=session_id,
+        )
+
+    async def revoke(self, revoked_id: str, expires: datetime) -> None:
+        async with SessionMaker() as engine:
+            await engine.merge(RevokedSession(revoked_id=revoked_id, revoked=datetime.now(), expires=expires))
+            await engine.commit()
+
+    async def remove(self, session_id: str) -> None:
+        if session := await self.get(session_id):
+            await self.revoke(get_token_key(session_id), session.expires)
+
+    async def remove_user(self, user_id: str) -> None:
+        await self.revoke(user_id, datetime.now() + self.lifetime)
+
+    async def update_user(
+        self, user_id: str, *, username: str | None = None, access_level: int | None = None
+    ) -> None:
+        await self.remove_user(user_id)
+
+    async def expire(self) -> None:
+        async with SessionMaker() as engine:
+            await engine.execute(delete(RevokedSession).where(RevokedSession.expires < datetime.now()))
+            await engine.commit()
+
+
+class CachedSessionBackend(SessionBackend):
+    """Keeps recently checked sessions in memory for a few seconds in front of a shared backend,
+    so most requests never leave the process. Changes made through this worker drop its cache
+    immediately; changes made by other workers show up once the cached entry runs out.
+    """
+
+    def __init__(self, backend: SessionBackend, lifetime: timedelta) -> None:
+        self.backend = backend
+        self.lifetime = lifetime
+        self.cache_lock = Lock()
+        self.cache: dict[str, tuple[Session, datetime]] = {}
+
+    async def create(self, username: str, user_id: str, access_level: int, expires: datetime) -> Session:
+        return await self.backend.create(username, user_id, access_level, expires)
+
+    async def get(self, session_id: str) -> Session | None:
+        now = datetime.now()
+        if (cached := self.cache.get(session_id)) and now < cached[1]:
+            return cached[0] if now <= cached[0].expires else None
+        if session := await self.backend.get(session_id):
+            with self.cache_lock:
+                self.cache[session_id] = (session, now + self.lifetime)
+        else:
+            with self.cache_lock:
+                self.cache.pop(session_id, None)
+        return session
+
+    def forget_user(self, user_id: str) -> None:
+        with self.cache_lock:
+            for session_id in [session_id for session_id, cached in self.cache.items() if cached[0].user_id == user_id]:
+                del self.cache[session_id]
+
+    async def remove(self, session_id: str) -> None:
+        with self.cache_lock:
+            self.cache.pop(session_id, None)
+        await self.backend.remove(session_id)
+
+    async def remove_user(self, user_id: str) -> None:
+        self.forget_user(user_id)
+        await self.backend.remove_user(user_id)
+
+    async def update_user(
+        self, user_id: str, *, username: str | None = None, access_level: int | None = None
+    ) -> None:
+        self.forget_user(user_id)
+        await self.backend.update_user(user_id, username=username, access_level=access_level)
+
+    async def expire(self) -> None:
+        now = datetime.now()
+        with self.cache_lock:
+            for session_id in [session_id for session_id, cached in self.cache.items() if now >= cached[1]]:
+                del self.cache[session_id]
+        await self.backend.expire()
+
+
+def get_token_key(session_id: str) -> str:
+    return sha256(session_id.encode()).hexdigest()
+
+
+def create_session_backend(
+    name: str, *, secret_key: str | None, lifetime: timedelta, cache_seconds: float = 5
+) -> SessionBackend:
+    backend: SessionBackend
+    match name:
+        case "memory":
+            return MemorySessionBackend()
+        case "database":
+            backend = DatabaseSessionBackend()
+        case "token":
+            # A key made up by each worker would make every worker turn away the others' tokens
+            if not secret_key:
+                raise KeyError("session_backend token needs the VAPOROUS_SECRET_KEY environment variable")
+            backend = TokenSessionBackend(secret_key.encode(), lifetime)
+        case _:
+            raise KeyError(f"Unknown session_backend {name!r}")
+    if cache_seconds > 0:
+        return CachedSessionBackend(backend, timedelta(seconds=cache_seconds))
+    return backend
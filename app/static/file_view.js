@@ -1,6 +1,13 @@
 var loading_dialog = document.getElementById("loading_dialog");
 var saved_y = 0;
 
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const PARALLEL_CHUNK_UPLOADS = 4;
+const CHUNK_RETRIES = 3;
+// Files up to this size are hashed before uploading, so ones the server already has are not sent again.
+// The browser can only hash a file it has read into memory whole.
+const HASH_SIZE_LIMIT = 256 * 1024 * 1024;
+
 function refresh() {
 	// Let the file system sync for slower systems
 	// TODO - re-compose instead of reload?
@@ -31,7 +38,9 @@ function dragleave(self, event) {
 function dragstart(self, event) {
 	// event.preventDefault();
 	event.stopPropagation();
-	event.dataTransfer.setData("vaporous_data", self.getAttribute("path"));
+	// Dragging one of the selected files drags all of them
+	let paths = self.classList.contains("selected") ? selected_paths() : [self.getAttribute("path")];
+	event.dataTransfer.setData("vaporous_data", JSON.stringify(paths));
 	saved_y = window.scrollY;
 	window.scroll({
 		top: 0,
@@ -49,36 +58,85 @@ function drop(self, event) {
 	event.stopPropagation();
 	self.classList.remove("dragging");
 
-	let subject_path = event.dataTransfer.getData("vaporous_data");
+	let subject_data = event.dataTransfer.getData("vaporous_data");
 	let target_path = self.getAttribute("path");
-	if (!subject_path) {
+	if (!subject_data) {
 		return;
 	}
-	if (subject_path == target_path) {
+	let subject_paths = JSON.parse(subject_data).filter(path => path != target_path);
+	if (subject_paths.length < 1) {
 		return;
-	} else {
-		loading_dialog.show();
-		fetch(MOVE_URL, {
-			method: "POST",
-			headers: {"Content-Type": "application/json"},
-			body: JSON.stringify({
-				file_path: subject_path,
-				to: target_path,
-				to_public: PUBLIC,
-			})
-		}).then(response => {
-			response.json().then(json => {
-				success = json[0];
-				message = json[1];
-				if (success) {
-					refresh();
-				} else {
-					loading_dialog.close();
-					alert(message);
-				}
-			});
-		});
 	}
+	run_batch(subject_paths.map(path => ({action: "move", path: path, to: target_path})));
+}
+
+// Files are selected with ctrl (or cmd) click, to be moved or deleted together
+document.addEventListener("click", event => {
+	if (!(event.ctrlKey || event.metaKey)) {
+		return;
+	}
+	let row = event.target.closest(".file_select[draggable='true']");
+	if (!row || event.target.closest(".file_properties")) {
+		return;
+	}
+	event.preventDefault();
+	row.classList.toggle("selected");
+	update_selection_bar();
+});
+
+function selected_paths() {
+	return Array.from(document.querySelectorAll(".file_select.selected"), row => row.getAttribute("path"));
+}
+
+function update_selection_bar() {
+	let count = document.querySelectorAll(".file_select.selected").length;
+	document.getElementById("selection_count").innerText = count + " selected";
+	document.getElementById("selection_bar").hidden = count < 1;
+}
+
+function clear_selection() {
+	document.querySelectorAll(".file_select.selected").forEach(row => row.classList.remove("selected"));
+	update_selection_bar();
+}
+
+function delete_selected() {
+	let paths = selected_paths();
+	if (paths.length < 1 || !confirm(`Delete ${paths.length} selected files and folders?`)) {
+		return;
+	}
+	run_batch(paths.map(path => ({action: "delete", path: path})));
+}
+
+function run_batch(operations) {
+	// One request for the lot, answered with [success, message] for each operation in order
+	loading_dialog.show();
+	fetch(BATCH_URL, {
+		method: "POST",
+		headers: {"Content-Type": "application/json"},
+		body: JSON.stringify({
+			operations: operations,
+			to_public: PUBLIC,
+		})
+	}).then(response => {
+		response.json().then(json => {
+			if (!response.ok) {
+				loading_dialog.close();
+				alert(json.detail);
+				return;
+			}
+			let failures = operations
+				.map((operation, i) => json[i][0] ? null : `${operation.path}: ${json[i][1]}`)
+				.filter(failure => failure);
+			if (failures.length > 0) {
+				alert(failures.join("\n"));
+			}
+			if (failures.length < json.length) {
+				refresh();
+			} else {
+				loading_dialog.close();
+			}
+		});
+	});
 }
 function drop_files(self, event) {
 	event.preventDefault();
@@ -90,21 +148,9 @@ function drop_files(self, event) {
 		return;
 	}
 	loading_dialog.show();
-	let upload_form = new FormData();
-	upload_form.append("file_path", CURRENT_DIRECTORY);
-	upload_form.append("to_public", PUBLIC);
-	upload_form.append("compression_level", 0);
-	for (var i = 0; i < files.length; i++) {
-		upload_form.append("files", files[i]);
-	}
-	fetch(UPLOAD_URL, {
-		method: "POST",
-		body: upload_form
-	}).then(response => {
-		response.json().then(json => {
-			console.log(json);
-			refresh();
-		});
+	upload_in_chunks(files, 0).then(results => {
+		console.log(results);
+		refresh();
 	});
 }
 
@@ -165,22 +211,107 @@ function rename(filename, new_name="") {
 	}
 }
 
+async function hash_file(file) {
+	if (!window.crypto || !crypto.subtle || file.size > HASH_SIZE_LIMIT) {
+		return null;
+	}
+	try {
+		let digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+		return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, "0")).join("");
+	} catch (error) {
+		console.log(error);
+		return null;
+	}
+}
+
+async function upload_file_in_chunks(file, compression_level) {
+	// Resumable upload: the file is sent as byte ranges (several at once),
+	// and a failed range is retried on its own instead of starting over.
+	let response = await fetch(UPLOAD_SESSION_URL, {
+		method: "POST",
+		headers: {"Content-Type": "application/json"},
+		body: JSON.stringify({
+			file_path: CURRENT_DIRECTORY,
+			to_public: PUBLIC,
+			filename: file.name,
+			size: file.size,
+			compression_level: compression_level,
+			sha256: await hash_file(file),
+		})
+	});
+	let [success, upload_id] = await response.json();
+	if (!success) {
+		return [false, upload_id];
+	}
+	let session_url = UPLOAD_SESSION_URL + "/" + upload_id;
+	// When the server already has the contents, sending the range it asks for is enough to prove we have them too
+	let session_response = await fetch(session_url, {method: "HEAD"});
+	let challenge = session_response.headers.get("Upload-Challenge");
+	if (challenge) {
+		let [start, end] = challenge.split("-").map(value => parseInt(value));
+		await fetch(session_url, {
+			method: "PATCH",
+			headers: {
+				"Content-Type": "application/offset+octet-stream",
+				"Upload-Offset": start,
+			},
+			body: file.slice(start, end)
+		});
+		session_response = await fetch(session_url, {method: "HEAD"});
+	}
+	let received = parseInt(session_response.headers.get("Upload-Offset")) || 0;
+	let offsets = [];
+	for (let offset = 0; offset < file.size && received < file.size; offset += UPLOAD_CHUNK_SIZE) {
+		offsets.push(offset);
+	}
+	async function send_chunks() {
+		while (offsets.length > 0) {
+			let offset = offsets.shift();
+			for (let attempt = 0; attempt < CHUNK_RETRIES; attempt++) {
+				try {
+					let chunk_response = await fetch(session_url, {
+						method: "PATCH",
+						headers: {
+							"Content-Type": "application/offset+octet-stream",
+							"Upload-Offset": offset,
+						},
+						body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE)
+					});
+					if (chunk_response.ok && (await chunk_response.json())[0]) {
+						break;
+					}
+				} catch (error) {
+					console.log(error);
+				}
+			}
+		}
+	}
+	let senders = [];
+	for (let i = 0; i < PARALLEL_CHUNK_UPLOADS; i++) {
+		senders.push(send_chunks());
+	}
+	await Promise.all(senders);
+	response = await fetch(session_url + "/finish", {method: "POST"});
+	return await response.json();
+}
+
+async function upload_in_chunks(files, compression_level) {
+	let results = [];
+	for (let i = 0; i < files.length; i++) {
+		results.push(await upload_file_in_chunks(files[i], compression_level));
+	}
+	return results;
+}
+
 function upload_files() {
 	loading_dialog.show();
 	let upload_form_element = document.getElementById("upload_form");
-	let upload_form = new FormData(upload_form_element);
-	upload_form.append("file_path", CURRENT_DIRECTORY);
-	upload_form.append("to_public", PUBLIC);
-	//TODO
-	fetch(UPLOAD_URL, {
-		method: "POST",
-		body: upload_form
-	}).then(response => {
+	let files = Array.from(upload_form_element.elements["files"].files);
+	let compression_level = parseInt(upload_form_element.elements["compression_level"].value) || 0;
+	upload_in_chunks(files, compression_level).then(results => {
 		upload_form_element.reset();
-		response.json().then(json => {
-			console.log(json);
-			refresh();
-		});
+		console.log(results);
+		refresh();
 	});
 }
 
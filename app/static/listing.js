@@ -0,0 +1,40 @@
+// Loads the next page of a long directory listing when its end scrolls into view
+var loading_next_page = false;
+
+function watch_next_page() {
+	let sentinel = document.querySelector("#file_list .next_page");
+	if (!sentinel) {
+		return;
+	}
+	let observer = new IntersectionObserver((entries) => {
+		if (!entries.some((entry) => entry.isIntersecting) || loading_next_page) {
+			return;
+		}
+		observer.disconnect();
+		load_next_page(sentinel);
+	}, {rootMargin: "400px"});
+	observer.observe(sentinel);
+}
+
+function load_next_page(sentinel) {
+	loading_next_page = true;
+	fetch(sentinel.dataset.url, {credentials: "same-origin"})
+		.then((response) => {
+			if (!response.ok) {
+				throw new Error(response.statusText);
+			}
+			return response.text();
+		})
+		.then((text) => {
+			sentinel.insertAdjacentHTML("beforebegin", text);
+			sentinel.remove();
+			loading_next_page = false;
+			watch_next_page();
+		})
+		.catch((error) => {
+			console.error(error);
+			loading_next_page = false;
+		});
+}
+
+watch_next_page();
@@ -0,0 +1,165 @@
+"""Transcodes videos into HLS renditions in the background, so they can be streamed at a bitrate the viewer's
+connection keeps up with, and in a format every browser plays.
+"""
+
+from asyncio import Semaphore, Task, create_task
+from asyncio.subprocess import DEVNULL, create_subprocess_exec
+from dataclasses import dataclass
+from hashlib import sha256
+from logging import getLogger
+from os import stat_result as StatResult
+from pathlib import Path
+from re import compile as regex_compile
+from shutil import rmtree, which
+
+from starlette.concurrency import run_in_threadpool
+
+from .config import CONFIG
+from .failure_cache import FailureCache
+
+logger = getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class HLSRendition:
+    name: str
+    height: int
+    video_kilobits: int
+    audio_kilobits: int
+
+
+HLS_RENDITIONS: tuple[HLSRendition, ...] = (
+    HLSRendition("360p", 360, 800, 96),
+    HLSRendition("720p", 720, 2800, 128),
+    HLSRendition("1080p", 1080, 5000, 160),
+)
+HLS_SEGMENT_SECONDS: int = 6
+HLS_MEDIA_TYPES: dict[str, str] = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+RENDITION_NAMES: str = "|".join(rendition.name for rendition in HLS_RENDITIONS)
+# The only files a stream directory has, so a request can never name anything else in it
+STREAM_FILE_REGEX = regex_compile(rf"master\.m3u8|(?:{RENDITION_NAMES})/(?:index\.m3u8|segment_\d{{5}}\.ts)")
+# Streams waiting for a transcoding slot beyond this are not started for now, and the video is played directly
+STREAM_QUEUE_LIMIT: int = CONFIG.get("streaming_queue_limit", 16)
+# Like failed thumbnails, failed streams are tried again after a while, and only the most recent are remembered
+FAILED_STREAM_RETRY_SECONDS: float = 3600
+FAILED_STREAM_LIMIT: int = 1024
+
+stream_slots = Semaphore(CONFIG.get("streaming_workers", 1))
+# Streams being made right now, by the directory they will end up in
+pending_streams: dict[Path, Task] = {}
+# Videos ffmpeg could not transcode, by path and modification time, with when it failed
+failed_streams = FailureCache(FAILED_STREAM_RETRY_SECONDS, FAILED_STREAM_LIMIT)
+
+
+def is_streaming_enabled() -> bool:
+    return bool(CONFIG.get("video_streaming", False)) and which("ffmpeg") is not None
+
+
+def get_streaming_directory() -> Path:
+    """Kept in a hidden folder of the upload directory like the thumbnails, since the app can always write there,
+    unlike the folder around it. streaming_directory puts it anywhere else, such as next to the upload directory.
+    """
+    if streaming_directory := CONFIG.get("streaming_directory"):
+        return Path(streaming_directory)
+    return Path(CONFIG["upload_directory"]) / ".streams"
+
+
+def get_stream_directory(source: Path, stat_result: StatResult) -> Path:
+    """Like thumbnails, streams are named after the path, modification time and size of the video."""
+    key = sha256(f"{source}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}".encode()).hexdigest()
+    return get_streaming_directory() / key[:2] / key
+
+
+def split_stream_path(stream_path: str) -> tuple[str, str] | None:
+    """Splits <video path>/master.m3u8 or <video path>/<rendition>/<file> into the video and the stream file."""
+    parts = stream_path.split("/")
+    size = 1 if parts[-1] == "master.m3u8" else 2
+    if len(parts) <= size:
+        return None
+    return ("/".join(parts[:-size]), "/".join(parts[-size:]))
+
+
+def get_stream_file(source: Path, stat_result: StatResult, stream_file: str) -> Path | None:
+    """Gets a playlist or segment of a finished stream, or None if there is no such file (yet)."""
+    if not STREAM_FILE_REGEX.fullmatch(stream_file):
+        return None
+    stream_directory = get_stream_directory(source, stat_result)
+    if not (stream_directory / "master.m3u8").exists():
+        return None
+    return stream_directory / stream_file
+
+
+def prepare_stream(source: Path, stat_result: StatResult) -> bool:
+    """Whether a finished stream of a video exists, starting to make one in the background if it does not."""
+    stream_directory = get_stream_directory(source, stat_result)
+    if (stream_directory / "master.m3u8").exists():
+        return True
+    failure_key = (source, stat_result.st_mtime_ns)
+    if (
+        not is_streaming_enabled()
+        or failed_streams.has_failed(failure_key)
+        or stream_directory in pending_streams
+        or len(pending_streams) >= STREAM_QUEUE_LIMIT
+    ):
+        return False
+    task = create_task(make_stream(source, stream_directory, failure_key))
+    pending_streams[stream_directory] = task
+    task.add_done_callback(lambda _: pending_streams.pop(stream_directory, None))
+    return False
+
+
+def get_rendition_command(source: Path, directory: Path, rendition: HLSRendition) -> list[str]:
+    command = ["ffmpeg", "-nostdin", "-v", "error", "-y", "-i", str(source), "-map", "0:v:0", "-map", "0:a:0?"]
+    command += ["-vf", f"scale=-2:'min({rendition.height},ih)'", "-c:v", "libx264", "-preset", "veryfast"]
+    command += ["-profile:v", "main", "-pix_fmt", "yuv420p", "-b:v", f"{rendition.video_kilobits}k"]
+    command += ["-maxrate", f"{rendition.video_kilobits * 107 // 100}k"]
+    command += ["-bufsize", f"{rendition.video_kilobits * 3 // 2}k"]
+    # Keyframes at the same times in every rendition keep their segments aligned, so players can switch between them
+    command += ["-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})", "-sc_threshold", "0"]
+    command += ["-c:a", "aac", "-ac", "2", "-b:a", f"{rendition.audio_kilobits}k"]
+    command += ["-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod"]
+    command += ["-hls_segment_filename", str(directory / "segment_%05d.ts"), str(directory / "index.m3u8")]
+    return command
+
+
+def get_master_playlist() -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for rendition in HLS_RENDITIONS:
+        bandwidth = (rendition.video_kilobits + rendition.audio_kilobits) * 1000
+        lines += [f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},NAME=\"{rendition.name}\"", f"{rendition.name}/index.m3u8"]
+    return "\n".join(lines) + "\n"
+
+
+async def make_stream(source: Path, stream_directory: Path, failure_key: tuple[Path, int]) -> None:
+    """Transcodes every rendition into a .part directory, one ffmpeg at a time per slot, and only moves it into
+    place with its master playlist once all of them are done, so a stream is either complete or not there at all.
+    Nothing waits for this task, so whatever goes wrong (ffmpeg gone missing, a cache that cannot be written to)
+    is logged and remembered as a failure here.
+    """
+    async with stream_slots:
+        partial_directory = stream_directory.with_name(f"{stream_directory.name}.part")
+        try:
+            # A leftover from an interrupted run can be a lot of segments, which is too many unlinks for the loop
+            await run_in_threadpool(rmtree, partial_directory, ignore_errors=True)
+            for rendition in HLS_RENDITIONS:
+                rendition_directory = partial_directory / rendition.name
+                rendition_directory.mkdir(parents=True)
+                command = get_rendition_command(source, rendition_directory, rendition)
+                process = await create_subprocess_exec(*command, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+                try:
+                    await process.wait()
+                finally:
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                if process.returncode != 0:
+                    logger.warning("ffmpeg could not transcode %s into %s", source, rendition.name)
+                    failed_streams.remember(failure_key)
+                    return
+            (partial_directory / "master.m3u8").write_text(get_master_playlist())
+            partial_directory.replace(stream_directory)
+        except Exception:
+            logger.exception("Making the stream of %s failed", source)
+            failed_streams.remember(failure_key)
+        finally:
+            await run_in_threadpool(rmtree, partial_directory, ignore_errors=True)
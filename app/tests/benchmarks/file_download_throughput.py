@@ -0,0 +1,117 @@
+"""Compares download throughput and server CPU per GB for file responses read through Python and sent zero-copy.
+
+Run from the repository root with the usual config.toml in place:
+    python -m app.tests.benchmarks.file_download_throughput [--server hypercorn] [--size 1024] [--requests 4]
+
+Each mode gets its own server process serving only a RangedFileResponse. Its CPU time is taken from the
+resource usage of the exited child, minus that of a server that was started and stopped without serving anything.
+"chunked" hides the server's pathsend / zerocopysend extensions from the response. "zero_copy" leaves them as the
+server offers them, so it only differs from "chunked" on servers that offer one.
+"""
+
+from argparse import ArgumentParser
+from os import environ, getpid
+from pathlib import Path
+from resource import RUSAGE_CHILDREN, getrusage
+from socket import create_connection
+from subprocess import Popen
+from sys import executable
+from tempfile import NamedTemporaryFile
+from time import perf_counter, sleep
+
+from httpx import Client
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+from app.responses import PATHSEND_EXTENSION, ZEROCOPYSEND_EXTENSION, RangedFileResponse
+
+MODULE: str = "app.tests.benchmarks.file_download_throughput"
+MODES: tuple[str, ...] = ("chunked", "zero_copy")
+HOST: str = "127.0.0.1"
+SERVER_START_TIMEOUT: float = 30.0
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    """Serves the benchmark file at every path, in the mode given by the environment."""
+    if scope["type"] == "lifespan":
+        while (await receive())["type"] != "lifespan.shutdown":
+            await send({"type": "lifespan.startup.complete"})
+        await send({"type": "lifespan.shutdown.complete"})
+        return
+    if environ["BENCHMARK_MODE"] == "chunked":
+        scope = scope | {"extensions": {}}
+    await RangedFileResponse(environ["BENCHMARK_FILE"], Headers(scope=scope))(scope, receive, send)
+
+
+def get_server_command(server: str, port: int) -> list[str]:
+    if server == "uvicorn":
+        return [executable, "-m", "uvicorn", f"{MODULE}:app", "--host", HOST, "--port", str(port)]
+    if server == "granian":
+        command = [executable, "-m", "granian", "--interface", "asgi", "--host", HOST, "--port", str(port)]
+        return command + [f"{MODULE}:app"]
+    return [executable, "-m", "hypercorn", f"{MODULE}:app", "--bind", f"{HOST}:{port}"]
+
+
+def run_server(server: str, port: int, mode: str, file_path: Path, requests: int, ranged: bool) -> tuple[float, float]:
+    """Returns (seconds spent downloading, server CPU seconds) for one server process."""
+    usage_before = getrusage(RUSAGE_CHILDREN)
+    process = Popen(
+        get_server_command(server, port), env=environ | {"BENCHMARK_MODE": mode, "BENCHMARK_FILE": str(file_path)}
+    )
+    seconds = 0.0
+    try:
+        deadline = perf_counter() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                create_connection((HOST, port)).close()
+                break
+            except OSError:
+                if perf_counter() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"{server} did not start") from None
+                sleep(0.1)
+        size = file_path.stat().st_size
+        headers = {"Range": f"bytes=1-{size - 2}"} if ranged else {}
+        with Client(base_url=f"http://{HOST}:{port}", timeout=None) as client:
+            start = perf_counter()
+            for _ in range(requests):
+                with client.stream("GET", "/", headers=headers) as response:
+                    received = sum(len(chunk) for chunk in response.iter_raw())
+                if received != (size - 2 if ranged else size):
+                    raise RuntimeError(f"Received {received} bytes instead of {size}")
+            seconds = perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    usage_after = getrusage(RUSAGE_CHILDREN)
+    cpu = (usage_after.ru_utime + usage_after.ru_stime) - (usage_before.ru_utime + usage_before.ru_stime)
+    return (seconds, cpu)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=("hypercorn", "uvicorn", "granian"), default="hypercorn")
+    parser.add_argument("--size", type=int, default=1024, help="size of the file served, in MB")
+    parser.add_argument("--requests", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8000 + getpid() % 1000)
+    arguments = parser.parse_args()
+
+    print(f"extensions looked for: {PATHSEND_EXTENSION}, {ZEROCOPYSEND_EXTENSION}")
+    with NamedTemporaryFile(prefix="benchmark-", suffix=".bin") as file_:
+        # Sparse, so every run reads it from the page cache and only the copying is measured
+        file_.truncate(arguments.size * 1024 * 1024)
+        file_.flush()
+        file_path = Path(file_.name)
+        _, idle_cpu = run_server(arguments.server, arguments.port, "chunked", file_path, 0, False)
+        gigabytes = arguments.size * arguments.requests / 1024
+        print(f"{'mode':<12}{'request':<10}{'MB/s':>10}{'CPU s/GB':>12}")
+        for mode in MODES:
+            for ranged in (False, True):
+                seconds, cpu = run_server(arguments.server, arguments.port, mode, file_path, arguments.requests, ranged)
+                print(
+                    f"{mode:<12}{'range' if ranged else 'full':<10}"
+                    f"{arguments.size * arguments.requests / seconds:>10.0f}{max(cpu - idle_cpu, 0) / gigabytes:>12.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
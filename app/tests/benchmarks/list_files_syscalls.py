@@ -0,0 +1,125 @@
+"""Counts the system calls list_files makes per directory entry, before and after it moved to scandir.
+
+Run from the repository root with the usual config.toml in place:
+    python -m app.tests.benchmarks.list_files_syscalls [--entries 100000]
+
+Each listing runs in its own interpreter under `strace -f -c`, and the calls made by an interpreter that
+only imports the app are subtracted, so what is left is the listing itself. Without strace only wall time is shown.
+"""
+
+from argparse import ArgumentParser
+from asyncio import run
+from pathlib import Path
+from shutil import rmtree, which
+from subprocess import run as run_process
+from sys import executable
+from tempfile import NamedTemporaryFile, mkdtemp
+from time import perf_counter
+
+from app import file_handler
+
+MODULE: str = "app.tests.benchmarks.list_files_syscalls"
+STAT_SYSCALLS: frozenset[str] = frozenset(("stat", "lstat", "fstat", "newfstatat", "statx", "fstatat64"))
+LISTINGS: tuple[str, ...] = ("before", "first_page", "sorted_by_size")
+
+
+def list_files_before(directory: Path, base: Path) -> list[dict]:
+    """The listing loop as it was before scandir: a Path per child, is_dir() on it, then get_file_size()
+    (is_dir() and stat() again), after checking the parent with exists() and is_dir().
+    """
+    public_directory = file_handler.get_upload_directory() / str(file_handler.CONFIG.get("public_directory"))
+    files: list[dict] = []
+    if not directory.exists() or not directory.is_dir():
+        return files
+    for child in directory.iterdir():
+        is_protected = False
+        type_ = "dir" if child.is_dir() else file_handler.get_file_type(child.suffix)
+        for protected_path in file_handler.CONFIG.get("protected_public_directories", []):
+            if child.is_relative_to(public_directory / protected_path):
+                is_protected = True
+                break
+        files.append(
+            {
+                "name": child.name,
+                "path": str(child.relative_to(base)),
+                "type": type_,
+                "protected": is_protected,
+                "size": file_handler.get_file_size(child),
+            }
+        )
+    files.sort(key=lambda f: f.get("name", ""))
+    return files
+
+
+def run_listing(listing: str, base: str) -> None:
+    directory = file_handler.get_upload_directory() / base
+    start = perf_counter()
+    match listing:
+        case "before":
+            list_files_before(directory, directory)
+        case "first_page":
+            run(file_handler.list_files(base, limit=file_handler.LISTING_PAGE_SIZE))
+        case "sorted_by_size":
+            run(file_handler.list_files(base, sort="size"))
+    print(perf_counter() - start)
+
+
+def count_syscalls(listing: str, base: str) -> tuple[int, int, float]:
+    """Returns (all calls, stat-family calls, seconds) for one listing in a fresh interpreter."""
+    command = [executable, "-m", MODULE, "--run", listing, base]
+    if not which("strace"):
+        return (0, 0, float(run_process(command, capture_output=True, text=True, check=True).stdout))
+    with NamedTemporaryFile("r", suffix=".strace") as summary:
+        result = run_process(
+            ["strace", "-f", "-c", "-o", summary.name, *command], capture_output=True, text=True, check=True
+        )
+        total = stats = 0
+        for line in summary.read().splitlines():
+            parts = line.split()
+            if len(parts) < 5 or not parts[3].isdigit():
+                continue
+            if parts[-1] == "total":
+                total = int(parts[3])
+            elif parts[-1] in STAT_SYSCALLS:
+                stats += int(parts[3])
+    return (total, stats, float(result.stdout))
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--run", nargs=2, metavar=("LISTING", "BASE"), help="internal: run one listing and exit")
+    arguments = parser.parse_args()
+    if arguments.run:
+        listing, base = arguments.run
+        if listing != "none":
+            run_listing(listing, base)
+        else:
+            print(0)
+        return
+
+    upload_directory = file_handler.get_upload_directory()
+    directory = Path(mkdtemp(prefix="benchmark-", dir=upload_directory))
+    try:
+        for index in range(arguments.entries):
+            (directory / f"{index:07d}.txt").write_bytes(b"")
+        base = directory.name
+        idle_total, idle_stats, _ = count_syscalls("none", base)
+        if not which("strace"):
+            print("strace not found, showing wall time only")
+        print(f"{'listing':<16}{'calls/entry':>14}{'stats/entry':>14}{'seconds':>10}")
+        for listing in LISTINGS:
+            total, stats, seconds = count_syscalls(listing, base)
+            if not which("strace"):
+                print(f"{listing:<16}{'-':>14}{'-':>14}{seconds:>10.3f}")
+                continue
+            print(
+                f"{listing:<16}{(total - idle_total) / arguments.entries:>14.3f}"
+                f"{(stats - idle_stats) / arguments.entries:>14.3f}{seconds:>10.3f}"
+            )
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Tests the api module."""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from app import file_handler
+from app.api import Location, api_v0, home_location
+
+NAMES: tuple[str, ...] = ("a.txt", "b.txt", "c.txt", "d.txt", "e.txt")
+
+
+class TestListing(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        self.home = self.root / "home"
+        self.home.mkdir()
+        for name in NAMES:
+            (self.home / name).write_text(name)
+        patcher = patch.dict(file_handler.CONFIG, {"upload_directory": str(self.root), "public_directory": None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        api_v0.dependency_overrides[home_location] = lambda: Location(base="home", access_level=0, owner="home")
+        self.addCleanup(api_v0.dependency_overrides.clear)
+        self.client = TestClient(api_v0)
+
+    def test_etag(self):
+        response = self.client.get("/files")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "no-cache")
+        etag = response.headers["ETag"]
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            with self.subTest(msg=f"If-None-Match: {if_none_match}"):
+                cached = self.client.get("/files", headers={"If-None-Match": if_none_match})
+                self.assertEqual(cached.status_code, 304)
+                self.assertEqual(cached.content, b"")
+                self.assertEqual(cached.headers["ETag"], etag)
+        self.assertEqual(self.client.get("/files", headers={"If-None-Match": '"other"'}).status_code, 200)
+        # Every page has its own ETag
+        self.assertNotEqual(self.client.get("/files", params={"limit": 2}).headers["ETag"], etag)
+
+    def test_etag_changes_with_the_folder(self):
+        etag = self.client.get("/files").headers["ETag"]
+        (self.home / "f.txt").write_text("f.txt")
+        response = self.client.get("/files", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertIn("f.txt", [file["name"] for file in response.json()["files"]])
+
+    def test_pages(self):
+        names: list[str] = []
+        params: dict[str, str | int] = {"limit": 2, "fields": "name"}
+        while True:
+            page = self.client.get("/files", params=params).json()
+            self.assertLessEqual(len(page["files"]), 2)
+            names.extend(file["name"] for file in page["files"])
+            if page["next_cursor"] is None:
+                break
+            params["cursor"] = page["next_cursor"]
+        self.assertEqual(names, list(NAMES))
+
+    def test_cursor_errors(self):
+        cursor = self.client.get("/files", params={"limit": 2}).json()["next_cursor"]
+        for params, detail in (
+            ({"cursor": "not a cursor"}, "Invalid cursor"),
+            # "not json"
+            ({"cursor": "bm90IGpzb24"}, "Invalid cursor"),
+            # A name sort cursor with a number where the name should be
+            ({"cursor": "WyJuYW1lIixmYWxzZSwyLDVd"}, "Invalid cursor"),
+            ({"cursor": cursor, "sort": "size"}, "Cursor belongs to a different sort order"),
+            ({"cursor": cursor, "descending": True}, "Cursor belongs to a different sort order"),
+        ):
+            with self.subTest(msg=str(params)):
+                response = self.client.get("/files", params=params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {"detail": detail})
+
+    def test_query_errors(self):
+        self.assertEqual(self.client.get("/files", params={"fields": "name,secret"}).status_code, 400)
+        self.assertEqual(self.client.get("/files", params={"limit": 0}).status_code, 422)
+        self.assertEqual(self.client.get("/files/a.txt").status_code, 404)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Tests the archives module."""
+
+import lzma
+from io import BytesIO
+from pathlib import Path
+from random import Random
+from struct import unpack_from
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from app import archives
+from app.archives import ZipMember, iter_zip
+
+MODIFIED: float = 1_700_000_000.0
+ZIP64_EXTRA_ID: int = 0x0001
+
+
+def get_extra_ids(data: bytes, header_offset: int) -> list[int]:
+    """Lists the extra field IDs in the local file header at header_offset."""
+    signature, name_length, extra_length = unpack_from("<4s22xHH", data, header_offset)
+    assert signature == b"PK\x03\x04"
+    position = header_offset + 30 + name_length
+    ids: list[int] = []
+    while position < header_offset + 30 + name_length + extra_length:
+        extra_id, size = unpack_from("<HH", data, position)
+        ids.append(extra_id)
+        position += 4 + size
+    return ids
+
+
+class TestIterZip(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        random = Random(0)
+        self.contents = {
+            "text.txt": b"hello, world\n" * 1000,
+            "folder/image.png": random.randbytes(5000),
+            "folder/empty.txt": b"",
+            # Bigger than one chunk, so it is sent in several pieces
+            "large.bin": random.randbytes(archives.ZIP_CHUNK_SIZE * 2 + 7),
+        }
+        for name, contents in self.contents.items():
+            path = self.root / name
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(contents)
+        self.compressed = b"compressed upload " * 100
+        (self.root / "upload.txt.xz").write_bytes(lzma.compress(self.compressed))
+
+    def make_members(self) -> list[ZipMember]:
+        members = [ZipMember(name="folder/", modified=MODIFIED)]
+        for name, contents in self.contents.items():
+            members.append(
+                ZipMember(
+                    name=name, modified=MODIFIED, path=self.root / name, size=len(contents), store=name.endswith(".png")
+                )
+            )
+        members.append(
+            ZipMember(
+                name="upload.txt",
+                modified=MODIFIED,
+                path=self.root / "upload.txt.xz",
+                size=len(self.compressed),
+                decompress=True,
+            )
+        )
+        return members
+
+    def test_valid_archive(self):
+        chunks = list(iter_zip(self.make_members()))
+        self.assertGreater(len(chunks), 2)
+        with ZipFile(BytesIO(b"".join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ["folder/", *self.contents, "upload.txt"])
+            self.assertTrue(archive.getinfo("folder/").is_dir())
+            for name, contents in self.contents.items():
+                with self.subTest(msg=name):
+                    self.assertEqual(archive.read(name), contents)
+                    self.assertEqual(archive.getinfo(name).file_size, len(contents))
+                    self.assertEqual(archive.getinfo(name).date_time, archives.get_zip_time(MODIFIED))
+            self.assertEqual(archive.read("upload.txt"), self.compressed)
+            self.assertEqual(archive.getinfo("folder/image.png").compress_type, ZIP_STORED)
+            self.assertEqual(archive.getinfo("text.txt").compress_type, ZIP_DEFLATED)
+
+    def test_missing_files_are_left_out(self):
+        members = self.make_members()
+        members.insert(2, ZipMember(name="gone.txt", modified=MODIFIED, path=self.root / "gone.txt", size=3))
+        with ZipFile(BytesIO(b"".join(iter_zip(members)))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertNotIn("gone.txt", archive.namelist())
+            self.assertEqual(len(archive.namelist()), len(members) - 1)
+
+    def test_zip64_entries(self):
+        # Files of at least ZIP64_LIMIT bytes need ZIP64 sizes in their local header from the start,
+        # since the stream cannot go back and rewrite it
+        with patch.object(archives, "ZIP64_LIMIT", len(self.contents["text.txt"])):
+            data = b"".join(iter_zip(self.make_members()))
+        with ZipFile(BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            for name, contents in self.contents.items():
+                with self.subTest(msg=name):
+                    self.assertEqual(archive.read(name), contents)
+                    extra_ids = get_extra_ids(data, archive.getinfo(name).header_offset)
+                    self.assertEqual(ZIP64_EXTRA_ID in extra_ids, len(contents) >= len(self.contents["text.txt"]))
+
+    def test_old_timestamps(self):
+        self.assertEqual(archives.get_zip_time(0), archives.ZIP_EARLIEST_TIME)
+
+    def test_empty_archive(self):
+        with ZipFile(BytesIO(b"".join(iter_zip([])))) as archive:
+            self.assertEqual(archive.namelist(), [])
+
+
+if __name__ == "__main__":
+    main()
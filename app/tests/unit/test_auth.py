@@ -1,6 +1,6 @@
 """Tests the auth module."""
 
-from unittest import TestCase, main
+from unittest import IsolatedAsyncioTestCase, TestCase, main
 
 import config
 
@@ -53,41 +53,43 @@ class TestUsernameValidity(TestCase):
             self.assertFalse(auth.checkpw(CLEARTEXT, hash_))
 
 
-class TestUserOperations(TestCase):
-    def setUp(self) -> None:
-        self.assertEqual(str(database.engine.url), IN_MEMORY_URI)
-        database.Base.metadata.create_all(bind=database.engine)
+class TestUserOperations(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.assertTrue(database.in_memory)
+        async with database.engine.begin() as connection:
+            await connection.run_sync(database.Base.metadata.create_all)
 
-    def test_bad_add_user(self):
-        success, _ = auth.add_user("test2")
+    async def test_bad_add_user(self):
+        success, _ = await auth.add_user("test2")
         self.assertFalse(success)
-        success, _ = auth.remove_user("test_does_not_exist")
+        success, _ = await auth.remove_user("test_does_not_exist")
         self.assertFalse(success)
 
-    def test_add_user(self, _username="test"):
-        success, _ = auth.add_user(_username, password=CLEARTEXT)
+    async def test_add_user(self, _username="test"):
+        success, _ = await auth.add_user(_username, password=CLEARTEXT)
         self.assertTrue(success)
-        success, _ = auth.add_user(_username, password=CLEARTEXT)
+        success, _ = await auth.add_user(_username, password=CLEARTEXT)
         self.assertFalse(success)
 
-    def test_add_remove_user(self):
-        self.test_add_user("rem_test")
-        success, _ = auth.remove_user("rem_test")
+    async def test_add_remove_user(self):
+        await self.test_add_user("rem_test")
+        success, _ = await auth.remove_user("rem_test")
         self.assertTrue(success)
-        success, _ = auth.remove_user("rem_test")
+        success, _ = await auth.remove_user("rem_test")
         self.assertFalse(success)
 
-    def test_password_changing(self):
-        self.test_add_user("pw_test")
-        success, _ = auth.change_password("pw_test", new_password=CLEARTEXT + "1", old_password=CLEARTEXT)
+    async def test_password_changing(self):
+        await self.test_add_user("pw_test")
+        success, _ = await auth.change_password("pw_test", new_password=CLEARTEXT + "1", old_password=CLEARTEXT)
         self.assertTrue(success)
-        success, _ = auth.change_password("pw_test", new_password=CLEARTEXT + "1")
+        success, _ = await auth.change_password("pw_test", new_password=CLEARTEXT + "1")
         self.assertTrue(success)
-        success, _ = auth.change_password("pw_test", new_password=CLEARTEXT + "2", old_password=CLEARTEXT + "bad")
+        success, _ = await auth.change_password("pw_test", new_password=CLEARTEXT + "2", old_password=CLEARTEXT + "bad")
         self.assertFalse(success)
 
-    def tearDown(self) -> None:
-        database.Base.metadata.drop_all(bind=database.engine)
+    async def asyncTearDown(self) -> None:
+        async with database.engine.begin() as connection:
+            await connection.run_sync(database.Base.metadata.drop_all)
 
 
 if __name__ == "__main__":
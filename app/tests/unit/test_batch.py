@@ -0,0 +1,141 @@
+"""Tests running batches of moves, renames and deletes in the file_handler module."""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, main
+from unittest.mock import patch
+from uuid import uuid4
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app import file_handler
+from app.file_handler import BatchOperation, apply_share_changes, run_batch
+from app.objects import Base, Share
+
+OWNER: bytes = uuid4().bytes
+
+
+class TestRunBatch(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        self.home = self.root / "home"
+        for folder in ("folder", "other"):
+            (self.home / folder).mkdir(parents=True)
+        for name in ("a.txt", "b.txt", "folder/c.txt"):
+            (self.home / name).write_text(name)
+        self.database = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.database.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        self.session_maker = async_sessionmaker(self.database, autoflush=False, expire_on_commit=False)
+        self.share_ids: dict[str, bytes] = {}
+        async with self.session_maker() as engine:
+            for path in ("home/a.txt", "home/b.txt", "home/folder", "home/folder/c.txt"):
+                share = Share(owner=OWNER, expires=None, path=path, anonymous_access=False)
+                engine.add(share)
+                self.share_ids[path] = share.share_id
+            await engine.commit()
+        for patcher in (
+            patch.object(file_handler, "SessionMaker", self.session_maker),
+            patch.dict(file_handler.CONFIG, {"upload_directory": str(self.root), "background_deletes": False}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.database.dispose()
+
+    async def get_share_paths(self) -> dict[str, str | None]:
+        async with self.session_maker() as engine:
+            paths = dict((await engine.execute(select(Share.share_id, Share.path))).all())
+        return {path: paths.get(share_id) for path, share_id in self.share_ids.items()}
+
+    def list_tree(self) -> list[str]:
+        return sorted(str(path.relative_to(self.home)) for path in self.home.rglob("*"))
+
+    async def test_partial_failure(self):
+        operations = [
+            BatchOperation("rename", "a.txt", name="renamed.txt"),
+            BatchOperation("delete", "missing.txt"),
+            BatchOperation("move", "b.txt", to="other"),
+            BatchOperation("rename", "nothing.txt", name=""),
+            BatchOperation("move", "folder", to=None),
+            BatchOperation("rename", "nowhere/d.txt", name="e.txt"),
+        ]
+        self.assertEqual(
+            await run_batch("home", operations),
+            [
+                (True, "Renamed!"),
+                (False, "Cannot delete nonexistent file"),
+                (True, "Renamed!"),
+                (False, "No new name!"),
+                (False, "No folder to move to!"),
+                (False, "Cannot rename nonexistent file / folder!"),
+            ],
+        )
+        self.assertEqual(self.list_tree(), ["folder", "folder/c.txt", "other", "other/b.txt", "renamed.txt"])
+
+    async def test_shares_fixed_up_once(self):
+        operations = [
+            BatchOperation("rename", "a.txt", name="renamed.txt"),
+            BatchOperation("move", "folder", to="other"),
+            BatchOperation("delete", "b.txt"),
+            BatchOperation("delete", "missing.txt"),
+        ]
+        with patch.object(file_handler, "apply_share_changes", wraps=apply_share_changes) as apply:
+            results = await run_batch("home", operations)
+        self.assertEqual([success for success, _ in results], [True, True, True, False])
+        apply.assert_called_once()
+        self.assertCountEqual(
+            apply.call_args.args[0],
+            [
+                (Path("home/a.txt"), Path("home/renamed.txt")),
+                (Path("home/folder"), Path("home/other/folder")),
+                (Path("home/b.txt"), None),
+            ],
+        )
+        self.assertEqual(
+            await self.get_share_paths(),
+            {
+                "home/a.txt": "home/renamed.txt",
+                "home/b.txt": None,
+                "home/folder": "home/other/folder",
+                "home/folder/c.txt": "home/other/folder/c.txt",
+            },
+        )
+
+    async def test_overlapping_entries(self):
+        for operations in (
+            # A file moved into a folder that is renamed
+            [BatchOperation("move", "a.txt", to="folder"), BatchOperation("rename", "folder", name="renamed")],
+            # A file inside a folder that is deleted
+            [BatchOperation("delete", "folder"), BatchOperation("rename", "folder/c.txt", name="d.txt")],
+            # The same file twice
+            [BatchOperation("delete", "a.txt"), BatchOperation("move", "a.txt", to="other")],
+            # One entry's destination is another's source
+            [BatchOperation("rename", "a.txt", name="c.txt"), BatchOperation("move", "folder/c.txt", to="")],
+            # Two entries ending up at the same path
+            [BatchOperation("rename", "b.txt", name="x.txt"), BatchOperation("rename", "a.txt", name="x.txt")],
+        ):
+            with self.subTest(msg=str(operations)), self.assertRaises(ValueError):
+                await run_batch("home", operations, roots={"": "home"})
+        self.assertEqual(self.list_tree(), ["a.txt", "b.txt", "folder", "folder/c.txt", "other"])
+
+    async def test_separate_entries(self):
+        # Names that only start the same way are different paths
+        (self.home / "folder2").mkdir()
+        operations = [
+            BatchOperation("delete", "folder"),
+            BatchOperation("rename", "folder2", name="folder3"),
+            BatchOperation("move", "a.txt", to="other"),
+            BatchOperation("move", "b.txt", to="other"),
+        ]
+        self.assertEqual([success for success, _ in await run_batch("home", operations)], [True] * 4)
+        self.assertEqual(self.list_tree(), ["folder3", "other", "other/a.txt", "other/b.txt"])
+
+
+if __name__ == "__main__":
+    main()
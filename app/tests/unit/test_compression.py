@@ -0,0 +1,114 @@
+"""Tests the compression module."""
+
+import lzma
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from app import compression
+from app.compression import compress_file, iter_decompressed_range, read_xz_index
+
+BLOCK_SIZE: int = 1000
+
+
+def read_range(path: Path, start: int, end: int) -> bytes:
+    stat_result = path.stat()
+    streams = read_xz_index(path, stat_result.st_mtime_ns, stat_result.st_size)
+    return b"".join(iter_decompressed_range(path, streams, start, end))
+
+
+class TestSeekableCompression(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        # Random bytes barely compress, so every block and chunk boundary is really crossed
+        self.contents = Random(0).randbytes(BLOCK_SIZE * 5 + 123)
+        self.source = self.root / "source.bin"
+        self.source.write_bytes(self.contents)
+        read_xz_index.cache_clear()
+
+    def compress(self, contents: bytes | None = None) -> Path:
+        if contents is not None:
+            self.source.write_bytes(contents)
+        destination = self.root / "source.bin.xz"
+        with (
+            patch.object(compression, "SEEKABLE_BLOCK_SIZE", BLOCK_SIZE),
+            patch.object(compression, "COMPRESSION_CHUNK_SIZE", BLOCK_SIZE // 4),
+        ):
+            compress_file(self.source, destination, 0)
+        return destination
+
+    def test_index(self):
+        destination = self.compress()
+        self.assertEqual(lzma.decompress(destination.read_bytes()), self.contents)
+        stat_result = destination.stat()
+        streams = read_xz_index(destination, stat_result.st_mtime_ns, stat_result.st_size)
+        self.assertEqual(len(streams), 6)
+        self.assertEqual(streams[0].compressed_offset, 0)
+        self.assertEqual(sum(stream.uncompressed_size for stream in streams), len(self.contents))
+        for previous, stream in zip(streams, streams[1:], strict=False):
+            self.assertEqual(stream.uncompressed_offset, previous.uncompressed_offset + previous.uncompressed_size)
+            self.assertGreater(stream.compressed_offset, previous.compressed_offset)
+
+    def test_ranges(self):
+        destination = self.compress()
+        last = len(self.contents) - 1
+        with patch.object(compression, "DECOMPRESSION_CHUNK_SIZE", 256):
+            for start, end in (
+                (0, last),
+                (0, 0),
+                (BLOCK_SIZE - 1, BLOCK_SIZE),
+                (BLOCK_SIZE, BLOCK_SIZE * 2 - 1),
+                (BLOCK_SIZE - 10, BLOCK_SIZE * 3 + 10),
+                (1234, 1234),
+                (last - 5, last),
+                (last, last),
+                (last - 5, last + 100),
+            ):
+                with self.subTest(msg=f"Range: {start}-{end}"):
+                    self.assertEqual(read_range(destination, start, end), self.contents[start : end + 1])
+
+    def test_empty_file(self):
+        destination = self.compress(b"")
+        self.assertEqual(lzma.decompress(destination.read_bytes()), b"")
+        stat_result = destination.stat()
+        streams = read_xz_index(destination, stat_result.st_mtime_ns, stat_result.st_size)
+        self.assertEqual(sum(stream.uncompressed_size for stream in streams), 0)
+
+    def test_single_stream_legacy_file(self):
+        legacy = self.root / "legacy.bin.xz"
+        legacy.write_bytes(lzma.compress(self.contents))
+        stat_result = legacy.stat()
+        streams = read_xz_index(legacy, stat_result.st_mtime_ns, stat_result.st_size)
+        self.assertEqual(len(streams), 1)
+        self.assertEqual(streams[0].uncompressed_size, len(self.contents))
+        last = len(self.contents) - 1
+        for start, end in ((0, 99), (BLOCK_SIZE * 4, BLOCK_SIZE * 4 + 500), (last, last + 1)):
+            with self.subTest(msg=f"Range: {start}-{end}"):
+                self.assertEqual(read_range(legacy, start, end), self.contents[start : end + 1])
+
+    def test_stream_padding(self):
+        padded = self.root / "padded.bin.xz"
+        half = len(self.contents) // 2
+        padded.write_bytes(
+            lzma.compress(self.contents[:half]) + bytes(8) + lzma.compress(self.contents[half:]) + bytes(4)
+        )
+        stat_result = padded.stat()
+        streams = read_xz_index(padded, stat_result.st_mtime_ns, stat_result.st_size)
+        self.assertEqual([stream.uncompressed_size for stream in streams], [half, len(self.contents) - half])
+        self.assertEqual(read_range(padded, half - 10, half + 10), self.contents[half - 10 : half + 11])
+
+    def test_invalid_files(self):
+        for name, contents in (("plain.xz", b"not compressed at all"), ("truncated.xz", lzma.compress(b"x")[:-1])):
+            path = self.root / name
+            path.write_bytes(contents)
+            stat_result = path.stat()
+            with self.subTest(msg=name), self.assertRaises(ValueError):
+                read_xz_index(path, stat_result.st_mtime_ns, stat_result.st_size)
+
+
+if __name__ == "__main__":
+    main()
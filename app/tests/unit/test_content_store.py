@@ -0,0 +1,97 @@
+"""Tests the content_store module."""
+
+from hashlib import sha256
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from app import content_store
+from app.compression import compress_file
+from app.content_store import (
+    add_content,
+    get_content_key,
+    get_content_path,
+    has_content,
+    link_content,
+    matches_content,
+    read_content,
+    sweep_content,
+)
+
+CONTENTS: bytes = b"the same bytes, uploaded twice " * 100
+DIGEST: str = sha256(CONTENTS).hexdigest()
+
+
+class TestContentStore(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        patcher = patch.dict(content_store.CONFIG, {"upload_directory": str(self.root)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, name: str, contents: bytes = CONTENTS, key: str = DIGEST) -> Path:
+        path = self.root / name
+        path.write_bytes(contents)
+        add_content(path, key)
+        return path
+
+    def test_duplicates_share_their_contents(self):
+        first, second = self.upload("first.txt"), self.upload("second.txt")
+        self.assertTrue(first.samefile(second))
+        self.assertTrue(first.samefile(get_content_path(DIGEST)))
+        self.assertEqual(first.stat().st_nlink, 3)
+        self.assertEqual(second.read_bytes(), CONTENTS)
+        self.assertTrue(has_content(DIGEST))
+        self.assertTrue(has_content(DIGEST, len(CONTENTS)))
+        self.assertFalse(has_content(DIGEST, len(CONTENTS) + 1))
+        self.assertFalse(has_content(sha256(b"other").hexdigest()))
+
+    def test_link_reuses_stored_contents(self):
+        first = self.upload("first.txt")
+        destination = self.root / "linked.txt"
+        destination.write_bytes(b"whatever was there before")
+        self.assertTrue(link_content(DIGEST, destination))
+        self.assertTrue(destination.samefile(first))
+        # Linking again is a no-op, and leaves nothing behind
+        self.assertTrue(link_content(DIGEST, destination))
+        self.assertEqual(sorted(path.name for path in self.root.iterdir()), [".content", "first.txt", "linked.txt"])
+        self.assertFalse(link_content(sha256(b"other").hexdigest(), self.root / "missing.txt"))
+        self.assertFalse((self.root / "missing.txt").exists())
+
+    def test_sweep_removes_the_last_link(self):
+        first, second = self.upload("first.txt"), self.upload("second.txt")
+        other = self.upload("other.txt", b"other", sha256(b"other").hexdigest())
+        first.unlink()
+        self.assertEqual(sweep_content(), 0)
+        self.assertTrue(has_content(DIGEST))
+        second.unlink()
+        other.unlink()
+        self.assertEqual(sweep_content(), 2)
+        self.assertFalse(has_content(DIGEST))
+        self.assertEqual(sweep_content(), 0)
+
+    def test_matches_content(self):
+        self.upload("first.txt")
+        proof = self.root / "proof.bin"
+        proof.write_bytes(bytes(100) + CONTENTS[100:200] + bytes(len(CONTENTS) - 200))
+        self.assertTrue(matches_content(DIGEST, proof, 100, 200))
+        self.assertFalse(matches_content(DIGEST, proof, 50, 150))
+        self.assertFalse(matches_content(DIGEST, proof, len(CONTENTS) - 10, len(CONTENTS) + 10))
+        self.assertFalse(matches_content(sha256(b"other").hexdigest(), proof, 100, 200))
+
+    def test_read_compressed_content(self):
+        key = get_content_key(DIGEST, 1)
+        source = self.root / "source.txt"
+        source.write_bytes(CONTENTS)
+        compress_file(source, self.root / "compressed.txt.xz", 1)
+        add_content(self.root / "compressed.txt.xz", key)
+        self.assertEqual(read_content(key, 10, 500), CONTENTS[10:500])
+        self.assertTrue(matches_content(key, source, 10, 500))
+        self.assertIsNone(read_content(DIGEST, 0, 10))
+
+
+if __name__ == "__main__":
+    main()
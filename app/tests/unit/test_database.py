@@ -0,0 +1,55 @@
+"""Tests the database module."""
+
+from unittest import TestCase, main
+from uuid import uuid4
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app.database import migrate_share_whitelists
+from app.objects import Base, Share, ShareAllowedUser
+
+OWNER: bytes = uuid4().bytes
+
+
+class TestMigrateShareWhitelists(TestCase):
+    def setUp(self):
+        self.database = create_engine("sqlite://", poolclass=StaticPool)
+        self.addCleanup(self.database.dispose)
+        Base.metadata.create_all(self.database)
+        self.first, self.second = uuid4().bytes, uuid4().bytes
+        # "$"-joined, with the empty pieces and repeats the old format could end up with
+        legacy = Share(owner=OWNER, expires=None, path="a", anonymous_access=False)
+        legacy.user_whitelist = f"${self.first.hex()}${self.second.hex()}$${self.first.hex()}"
+        empty = Share(owner=OWNER, expires=None, path="b", anonymous_access=True)
+        empty.user_whitelist = ""
+        migrated = Share(owner=OWNER, expires=None, path="c", anonymous_access=False)
+        migrated.allowed_users.append(ShareAllowedUser(share_id=migrated.share_id, user_id=self.second))
+        self.share_ids = {"legacy": legacy.share_id, "empty": empty.share_id, "migrated": migrated.share_id}
+        with Session(self.database) as session:
+            session.add_all([legacy, empty, migrated])
+            session.commit()
+
+    def get_allowed_users(self) -> dict[str, set[bytes]]:
+        with Session(self.database) as session:
+            allowed = session.execute(select(ShareAllowedUser.share_id, ShareAllowedUser.user_id)).all()
+            self.assertEqual(session.scalars(select(Share).where(Share.user_whitelist.is_not(None))).all(), [])
+        return {
+            name: {user_id for allowed_share_id, user_id in allowed if allowed_share_id == share_id}
+            for name, share_id in self.share_ids.items()
+        }
+
+    def test_migration(self):
+        with Session(self.database) as session:
+            migrate_share_whitelists(session)
+        expected = {"legacy": {self.first, self.second}, "empty": set(), "migrated": {self.second}}
+        self.assertEqual(self.get_allowed_users(), expected)
+        # Runs on every startup, so running again changes nothing
+        with Session(self.database) as session:
+            migrate_share_whitelists(session)
+        self.assertEqual(self.get_allowed_users(), expected)
+
+
+if __name__ == "__main__":
+    main()
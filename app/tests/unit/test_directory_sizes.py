@@ -0,0 +1,83 @@
+"""Tests the folder size index in the file_handler module."""
+
+from asyncio import sleep
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, main
+from unittest.mock import patch
+
+from app import file_handler
+from app.file_handler import (
+    delete_file,
+    directory_sizes,
+    get_directory_size,
+    new_folder,
+    new_temporary_file,
+    place_upload,
+    rename,
+    start_size_watcher,
+    stop_size_watcher,
+)
+
+# Long enough for the watcher to have read the events of a change
+EVENT_DELAY: float = 0.2
+
+
+class TestDirectorySizes(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        self.home = self.root / "home"
+        (self.home / "folder").mkdir(parents=True)
+        (self.home / "folder" / "old.txt").write_bytes(bytes(10))
+        patcher = patch.dict(file_handler.CONFIG, {"upload_directory": str(self.root), "background_deletes": False})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        start_size_watcher()
+        self.addCleanup(stop_size_watcher)
+        if file_handler.size_watcher is None:
+            self.skipTest("inotify is not available")
+        self.assertEqual(get_directory_size(self.home), 10)
+
+    def upload(self, path: Path, contents: bytes) -> None:
+        with new_temporary_file(path.parent) as temporary_file:
+            temporary_file.write(contents)
+        self.assertEqual(place_upload(Path(temporary_file.name), path), (True, "Success!"))
+
+    def assertSizes(self, home: int, folder: int):
+        self.assertEqual((directory_sizes.get(self.home), directory_sizes.get(self.home / "folder")), (home, folder))
+
+    async def test_upload_keeps_sizes(self):
+        self.upload(self.home / "folder" / "new.txt", bytes(5))
+        await sleep(EVENT_DELAY)
+        self.assertSizes(15, 15)
+        self.assertEqual(get_directory_size(self.home), 15)
+
+    async def test_own_changes_keep_sizes(self):
+        self.assertEqual(await new_folder("home", "folder", "empty"), (True, "Folder created!"))
+        self.assertEqual(await rename("home", "folder/old.txt", "renamed.txt"), (True, "Renamed!"))
+        await sleep(EVENT_DELAY)
+        self.assertSizes(10, 10)
+        self.assertEqual(await delete_file("home", "folder/renamed.txt"), (True, "File deleted"))
+        await sleep(EVENT_DELAY)
+        self.assertSizes(0, 0)
+
+    async def test_outside_changes_forget_sizes(self):
+        (self.home / "folder" / "outside.txt").write_bytes(bytes(3))
+        await sleep(EVENT_DELAY)
+        self.assertSizes(None, None)
+        self.assertEqual(get_directory_size(self.home), 13)
+
+    async def test_change_after_own_change(self):
+        # Each change the app makes only excuses its own event, not the next one at the same path
+        self.upload(self.home / "folder" / "new.txt", bytes(5))
+        await sleep(EVENT_DELAY)
+        (self.home / "folder" / "new.txt").unlink()
+        await sleep(EVENT_DELAY)
+        self.assertSizes(None, None)
+        self.assertEqual(get_directory_size(self.home), 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Tests the failure_cache module."""
+
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from app import failure_cache
+from app.failure_cache import FailureCache
+
+
+class TestFailureCache(TestCase):
+    def test_retry_after_a_while(self):
+        failures = FailureCache(retry_seconds=10, limit=5)
+        with patch.object(failure_cache, "monotonic", return_value=100.0):
+            failures.remember("video.mp4")
+            self.assertTrue(failures.has_failed("video.mp4"))
+            self.assertFalse(failures.has_failed("other.mp4"))
+        with patch.object(failure_cache, "monotonic", return_value=110.0):
+            self.assertFalse(failures.has_failed("video.mp4"))
+        self.assertEqual(len(failures), 0)
+
+    def test_oldest_are_forgotten(self):
+        failures = FailureCache(retry_seconds=10, limit=2)
+        for key in ("a", "b", "c"):
+            failures.remember(key)
+        # Failing again makes a failure the most recent one
+        failures.remember("b")
+        failures.remember("d")
+        self.assertEqual([key for key in "abcd" if failures.has_failed(key)], ["b", "d"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Tests paging through directory listings in the file_handler module."""
+
+from asyncio import sleep
+from base64 import urlsafe_b64encode
+from json import dumps
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, TestCase, main
+from unittest.mock import patch
+
+from app import file_handler
+from app.file_handler import (
+    decode_listing_cursor,
+    delete_file,
+    encode_listing_cursor,
+    get_directory_listing,
+    get_listing_cache_stats,
+    new_folder,
+    on_listing_event,
+    read_listing_page,
+    rename,
+    select_listing_page,
+    start_listing_watcher,
+    stop_listing_watcher,
+)
+from app.inotify import IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_ISDIR, IN_MOVED_FROM, IN_Q_OVERFLOW
+
+# Long enough for the watcher to have read the events of a change
+EVENT_DELAY: float = 0.2
+
+
+def make_file(name: str, file_type: str = "text", size_bytes: int = 0, modified: float = 0.0) -> dict:
+    return {"name": name, "type": file_type, "size_bytes": size_bytes, "modified": modified}
+
+
+def make_cursor(cursor: object) -> str:
+    return urlsafe_b64encode(dumps(cursor).encode()).decode()
+
+
+def page_names(files: list[dict], sort: str, descending: bool = False, limit: int = 2) -> list[list[str]]:
+    """Pages through files like read_listing_page does, round-tripping every cursor through its string form."""
+    listing = [(file, None) for file in files]
+    pages: list[list[str]] = []
+    after = None
+    while True:
+        page = select_listing_page(listing, sort, descending, after, limit + 1)  # type: ignore
+        pages.append([file["name"] for file, _ in page[:limit]])
+        if len(page) <= limit:
+            return pages
+        after = decode_listing_cursor(encode_listing_cursor(page[limit - 1][0], sort, descending), sort, descending)
+
+
+class TestListingCursor(TestCase):
+    def test_round_trip(self):
+        for sort, expected in (
+            ("name", (2, ("b.txt",))),
+            ("type", (2, ("text", "b.txt"))),
+            ("size", (2, (10, "b.txt"))),
+            ("mtime", (2, (1.5, "b.txt"))),
+        ):
+            with self.subTest(msg=f"Sort: {sort}"):
+                cursor = encode_listing_cursor(make_file("b.txt", size_bytes=10, modified=1.5), sort, True)
+                self.assertEqual(decode_listing_cursor(cursor, sort, True), expected)
+
+    def test_stale_cursor(self):
+        cursor = encode_listing_cursor(make_file("b.txt"), "name", False)
+        for sort, descending in (("name", True), ("size", False)):
+            with self.subTest(msg=f"Sort: {sort}, descending: {descending}"), self.assertRaises(ValueError):
+                decode_listing_cursor(cursor, sort, descending)
+
+    def test_tampered_cursor(self):
+        for sort, cursor in (
+            ("name", "not a cursor!"),
+            ("name", urlsafe_b64encode(b"\xff\xfe").decode()),
+            ("name", make_cursor(5)),
+            ("name", make_cursor(["name"])),
+            ("name", make_cursor(["name", False, "2", "b.txt"])),
+            ("name", make_cursor(["name", False, 2, 5])),
+            ("name", make_cursor(["name", False, 2])),
+            ("name", make_cursor(["name", False, 2, "b.txt", "c.txt"])),
+            ("name", make_cursor({"name": 1, "b": 2, "c": 3})),
+            ("size", make_cursor(["size", False, 2, "10", "b.txt"])),
+            ("mtime", make_cursor(["mtime", False, 2, None, "b.txt"])),
+        ):
+            with self.subTest(msg=f"Sort: {sort}, cursor: {cursor}"), self.assertRaises(ValueError):
+                decode_listing_cursor(cursor, sort, False)
+
+
+class TestSelectListingPage(TestCase):
+    def setUp(self):
+        self.files = [
+            make_file("c.txt", size_bytes=5, modified=3.0),
+            make_file("folder", "dir", size_bytes=5),
+            make_file("a.txt", size_bytes=5, modified=3.0),
+            make_file("public", "public_directory"),
+            make_file("b.txt", size_bytes=1, modified=2.0),
+            make_file("d.txt", size_bytes=5, modified=1.0),
+        ]
+
+    def test_groups_come_first(self):
+        self.assertEqual(
+            page_names(self.files, "name", limit=10), [["public", "folder", "a.txt", "b.txt", "c.txt", "d.txt"]]
+        )
+        self.assertEqual(
+            page_names(self.files, "name", descending=True, limit=10),
+            [["public", "folder", "d.txt", "c.txt", "b.txt", "a.txt"]],
+        )
+
+    def test_equal_sort_keys(self):
+        # Entries with the same size or modification time are told apart by name, so none is skipped or repeated
+        self.assertEqual(
+            page_names(self.files, "size"), [["public", "folder"], ["b.txt", "a.txt"], ["c.txt", "d.txt"]]
+        )
+        self.assertEqual(
+            page_names(self.files, "mtime", descending=True),
+            [["public", "folder"], ["c.txt", "a.txt"], ["b.txt", "d.txt"]],
+        )
+        self.assertEqual(
+            page_names(self.files, "size", limit=1),
+            [["public"], ["folder"], ["b.txt"], ["a.txt"], ["c.txt"], ["d.txt"]],
+        )
+
+    def test_changes_between_pages(self):
+        after = decode_listing_cursor(encode_listing_cursor(self.files[2], "name", False), "name", False)
+        # a.txt, the last entry sent, is gone by the time the next page is asked for
+        files = [(file, None) for file in self.files if file["name"] != "a.txt"] + [(make_file("0.txt"), None)]
+        page = select_listing_page(files, "name", False, after, None)  # type: ignore
+        self.assertEqual([file["name"] for file, _ in page], ["b.txt", "c.txt", "d.txt"])
+
+
+class TestReadListingPage(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+
+    def read_all(self, limit: int) -> list[list[str]]:
+        pages: list[list[str]] = []
+        after = None
+        while True:
+            listed = read_listing_page(self.root, self.root, None, "name", False, after, limit)
+            assert listed is not None
+            files, next_cursor = listed
+            pages.append([file["name"] for file in files])
+            if next_cursor is None:
+                return pages
+            after = decode_listing_cursor(next_cursor, "name", False)
+
+    def test_last_page(self):
+        for name in ("a", "b", "c", "d"):
+            (self.root / name).write_text(name)
+        # A page that ends exactly on the last entry has no cursor, so there is never an empty page after it
+        self.assertEqual(self.read_all(4), [["a", "b", "c", "d"]])
+        self.assertEqual(self.read_all(2), [["a", "b"], ["c", "d"]])
+        self.assertEqual(self.read_all(3), [["a", "b", "c"], ["d"]])
+        self.assertEqual(self.read_all(5), [["a", "b", "c", "d"]])
+
+    def test_empty_directory(self):
+        self.assertEqual(self.read_all(2), [[]])
+
+    def test_missing_directory(self):
+        self.assertIsNone(read_listing_page(self.root / "missing", self.root, None, "name", False, None, 2))
+
+
+
+class TestListingCache(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        self.home = self.root / "home"
+        (self.home / "folder").mkdir(parents=True)
+        (self.home / "a.txt").write_text("a")
+        (self.home / "folder" / "b.txt").write_text("b")
+        patcher = patch.dict(file_handler.CONFIG, {"upload_directory": str(self.root)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        start_listing_watcher()
+        self.addCleanup(stop_listing_watcher)
+        if file_handler.listing_watcher is None:
+            self.skipTest("inotify is not available")
+
+    def list_names(self, directory: Path) -> list[str]:
+        listing = get_directory_listing(directory, None)
+        assert listing is not None
+        return sorted(file["name"] for file, _ in listing)
+
+    def get_hits(self) -> tuple[int, int]:
+        stats = get_listing_cache_stats()
+        return (stats["hits"], stats["misses"])
+
+    def assertCached(self, directory: Path, names: list[str]):
+        """Lists a directory twice, the second time from the cache."""
+        hits, misses = self.get_hits()
+        self.assertEqual(self.list_names(directory), names)
+        self.assertEqual(self.list_names(directory), names)
+        self.assertEqual(self.get_hits(), (hits + 1, misses + 1))
+
+    async def test_cached_listing_is_served(self):
+        self.assertCached(self.home, ["a.txt", "folder"])
+        # Until the watcher gets to the event, the listing from before the change is what is served
+        (self.home / "c.txt").write_text("c")
+        hits, _ = self.get_hits()
+        self.assertEqual(self.list_names(self.home), ["a.txt", "folder"])
+        self.assertEqual(self.get_hits()[0], hits + 1)
+        await sleep(EVENT_DELAY)
+        self.assertCached(self.home, ["a.txt", "c.txt", "folder"])
+
+    async def test_events_invalidate(self):
+        home, folder = str(self.home), str(self.home / "folder")
+        self.assertCached(self.home, ["a.txt", "folder"])
+        self.assertCached(self.home / "folder", ["b.txt"])
+        # The watcher would hand these events over itself a moment later, handing them over here makes it now
+        (self.home / "c.txt").write_text("c")
+        on_listing_event(home, "c.txt", IN_CREATE)
+        self.assertCached(self.home, ["a.txt", "c.txt", "folder"])
+        (self.home / "a.txt").unlink()
+        on_listing_event(home, "a.txt", IN_DELETE)
+        self.assertCached(self.home, ["c.txt", "folder"])
+        (self.home / "c.txt").rename(self.home / "d.txt")
+        on_listing_event(home, "c.txt", IN_MOVED_FROM)
+        self.assertCached(self.home, ["d.txt", "folder"])
+        (self.home / "folder" / "b.txt").unlink()
+        on_listing_event(folder, "", IN_DELETE_SELF)
+        self.assertCached(self.home / "folder", [])
+        (self.home / "e.txt").write_text("e")
+        on_listing_event("", "", IN_Q_OVERFLOW)
+        self.assertCached(self.home, ["d.txt", "e.txt", "folder"])
+
+    async def test_subtree_invalidation(self):
+        self.assertCached(self.home / "folder", ["b.txt"])
+        (self.home / "folder" / "b.txt").write_text("changed")
+        (self.home / "folder").rename(self.home / "moved")
+        (self.home / "folder").mkdir()
+        on_listing_event(str(self.home), "folder", IN_MOVED_FROM | IN_ISDIR)
+        self.assertCached(self.home / "folder", [])
+
+    async def test_own_changes_invalidate(self):
+        self.assertCached(self.home, ["a.txt", "folder"])
+        self.assertCached(self.home / "folder", ["b.txt"])
+        # The app's own changes drop the listings straight away, without waiting for the watcher
+        self.assertEqual(await new_folder("home", "", "new"), (True, "Folder created!"))
+        self.assertCached(self.home, ["a.txt", "folder", "new"])
+        self.assertEqual(await rename("home", "a.txt", "renamed.txt", share_changes=[]), (True, "Renamed!"))
+        self.assertCached(self.home, ["folder", "new", "renamed.txt"])
+        self.assertEqual(await delete_file("home", "folder/b.txt", share_changes=[]), (True, "File deleted"))
+        self.assertCached(self.home / "folder", [])
+        self.assertEqual(await rename("home", "folder", "renamed", share_changes=[]), (True, "Renamed!"))
+        self.assertCached(self.home, ["new", "renamed", "renamed.txt"])
+        self.assertIsNone(get_directory_listing(self.home / "folder", None))
+
+
+if __name__ == "__main__":
+    main()
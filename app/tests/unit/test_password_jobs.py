@@ -0,0 +1,68 @@
+"""Tests limiting the password jobs of the auth module."""
+
+from asyncio import CancelledError, create_task, sleep
+from threading import Event
+from unittest import IsolatedAsyncioTestCase, TestCase, main
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from app import auth, main as app_main
+from app.auth import PASSWORD_QUEUE_LIMIT, PASSWORD_WORKERS, PasswordHashingBusy, run_password_job
+
+FULL: int = PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT
+
+
+class TestRunPasswordJob(IsolatedAsyncioTestCase):
+    async def wait_for_jobs(self, count: int) -> None:
+        for _ in range(200):
+            if auth.password_jobs == count:
+                return
+            await sleep(0.01)
+        self.fail(f"{auth.password_jobs} password jobs, not {count}")
+
+    async def test_jobs_are_counted(self):
+        self.assertEqual(await run_password_job(sum, (1, 2)), 3)
+        await self.wait_for_jobs(0)
+
+    async def test_busy(self):
+        with patch.object(auth, "password_jobs", FULL), self.assertRaises(PasswordHashingBusy):
+            await run_password_job(sum, (1, 2))
+
+    async def test_cancelled_job_keeps_its_worker(self):
+        started, release = Event(), Event()
+
+        def hash_slowly() -> None:
+            started.set()
+            release.wait(5)
+
+        task = create_task(run_password_job(hash_slowly))
+        while not started.is_set():
+            await sleep(0.01)
+        task.cancel()
+        with self.assertRaises(CancelledError):
+            await task
+        # The thread still hashes, so the job still counts
+        await sleep(0.05)
+        self.assertEqual(auth.password_jobs, 1)
+        release.set()
+        await self.wait_for_jobs(0)
+
+
+class TestPasswordHashingBusy(TestCase):
+    def test_login_is_turned_away(self):
+        async def login_with_password(_username: str, password: str) -> bool:
+            return await run_password_job(auth.checkpw, password)
+
+        client = TestClient(app_main.app)
+        with (
+            patch.object(auth, "password_jobs", FULL),
+            patch.object(auth, "login_with_password", side_effect=login_with_password),
+        ):
+            response = client.post("/login", data={"username": "someone", "password": "password"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], str(auth.PASSWORD_RETRY_AFTER))
+
+
+if __name__ == "__main__":
+    main()
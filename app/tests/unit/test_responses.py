@@ -0,0 +1,147 @@
+"""Tests the responses module."""
+
+from email.utils import formatdate
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from app.responses import MAX_RANGES, RangedFileResponse, etag_matches, make_etag, parse_range_header
+
+CONTENTS: bytes = bytes(range(256)) * 4
+SIZE: int = len(CONTENTS)
+
+
+class TestParseRangeHeader(TestCase):
+    def test_single_ranges(self):
+        cases = (
+            ("bytes=0-9", [(0, 9)]),
+            ("bytes=10-", [(10, SIZE - 1)]),
+            ("bytes=1000-5000", [(1000, SIZE - 1)]),
+            ("bytes=-100", [(SIZE - 100, SIZE - 1)]),
+            ("bytes=-5000", [(0, SIZE - 1)]),
+            ("BYTES = 0-0", [(0, 0)]),
+        )
+        for header, expected in cases:
+            with self.subTest(msg=f"Range: {header}"):
+                self.assertEqual(parse_range_header(header, SIZE), expected)
+
+    def test_overlapping_ranges_are_merged(self):
+        self.assertEqual(parse_range_header("bytes=50-99,0-9,5-20,21-30", SIZE), [(0, 30), (50, 99)])
+        self.assertEqual(parse_range_header("bytes=0-9,-10", SIZE), [(0, 9), (SIZE - 10, SIZE - 1)])
+
+    def test_unsatisfiable_ranges(self):
+        for header in ("bytes=5000-6000", "bytes=-0", f"bytes={SIZE}-"):
+            with self.subTest(msg=f"Range: {header}"):
+                self.assertEqual(parse_range_header(header, SIZE), [])
+        self.assertEqual(parse_range_header("bytes=-10", 0), [])
+
+    def test_ignored_headers(self):
+        too_many = "bytes=" + ",".join(f"{start * 2}-{start * 2}" for start in range(MAX_RANGES + 1))
+        for header in ("items=0-9", "bytes=9-0", "bytes=a-b", "bytes=0-9,10", too_many):
+            with self.subTest(msg=f"Range: {header}"):
+                self.assertIsNone(parse_range_header(header, SIZE))
+
+
+class TestETags(TestCase):
+    def test_etag_matching(self):
+        etag = '"abc"'
+        self.assertTrue(etag_matches('"abc"', etag))
+        self.assertTrue(etag_matches('"x", "abc"', etag))
+        self.assertTrue(etag_matches("*", etag))
+        self.assertFalse(etag_matches('"abcd"', etag))
+
+    def test_weak_comparison(self):
+        etag = '"abc"'
+        self.assertTrue(etag_matches('W/"abc"', etag))
+        self.assertFalse(etag_matches('W/"abc"', etag, weak=False))
+        self.assertTrue(etag_matches('W/"x", "abc"', etag, weak=False))
+
+
+class TestRangedFileResponse(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = TemporaryDirectory()
+        cls.path = Path(cls.directory.name) / "file.bin"
+        cls.path.write_bytes(CONTENTS)
+        cls.etag = make_etag(cls.path.stat())
+        test_app = FastAPI()
+
+        @test_app.api_route("/file", methods=["GET", "HEAD"])
+        async def get_file(request: Request):
+            return RangedFileResponse(cls.path, request.headers, media_type="application/octet-stream")
+
+        cls.client = TestClient(test_app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_whole_file(self):
+        response = self.client.get("/file")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, CONTENTS)
+        self.assertEqual(response.headers["etag"], self.etag)
+        self.assertEqual(response.headers["accept-ranges"], "bytes")
+
+    def test_single_range(self):
+        response = self.client.get("/file", headers={"Range": "bytes=-10"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, CONTENTS[-10:])
+        self.assertEqual(response.headers["content-range"], f"bytes {SIZE - 10}-{SIZE - 1}/{SIZE}")
+
+    def test_multiple_ranges(self):
+        response = self.client.get("/file", headers={"Range": "bytes=0-3,100-103"})
+        self.assertEqual(response.status_code, 206)
+        content_type = response.headers["content-type"]
+        self.assertTrue(content_type.startswith("multipart/byteranges; boundary="))
+        boundary = content_type.partition("boundary=")[2]
+        self.assertEqual(int(response.headers["content-length"]), len(response.content))
+        parts = response.content.split(f"--{boundary}".encode())
+        self.assertEqual(parts[0], b"")
+        self.assertEqual(parts[-1], b"--\r\n")
+        bodies = [part.partition(b"\r\n\r\n")[2][:-2] for part in parts[1:-1]]
+        self.assertEqual(bodies, [CONTENTS[0:4], CONTENTS[100:104]])
+        self.assertIn(f"Content-Range: bytes 100-103/{SIZE}".encode(), parts[2])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get("/file", headers={"Range": "bytes=5000-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["content-range"], f"bytes */{SIZE}")
+
+    def test_not_modified(self):
+        for headers in (
+            {"If-None-Match": self.etag},
+            {"If-None-Match": f"W/{self.etag}"},
+            {"If-Modified-Since": formatdate(self.path.stat().st_mtime + 1, usegmt=True)},
+        ):
+            with self.subTest(msg=f"Headers: {headers}"):
+                response = self.client.get("/file", headers=headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b"")
+        self.assertEqual(self.client.get("/file", headers={"If-None-Match": '"stale"'}).status_code, 200)
+
+    def test_if_range(self):
+        matching = self.client.get("/file", headers={"Range": "bytes=0-9", "If-Range": self.etag})
+        self.assertEqual(matching.status_code, 206)
+        # If-Range only takes strong validators, so a weak one means the whole file
+        weak = self.client.get("/file", headers={"Range": "bytes=0-9", "If-Range": f"W/{self.etag}"})
+        self.assertEqual(weak.status_code, 200)
+        stale = self.client.get("/file", headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale.content, CONTENTS)
+        last_modified = formatdate(int(self.path.stat().st_mtime), usegmt=True)
+        dated = self.client.get("/file", headers={"Range": "bytes=0-9", "If-Range": last_modified})
+        self.assertEqual(dated.status_code, 206)
+
+    def test_head(self):
+        response = self.client.head("/file", headers={"Range": "bytes=0-9"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response.headers["content-length"], "10")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Tests the search module."""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main, skipUnless
+
+from app.search import SearchIndex, connect, get_content_expression, get_name_terms, has_fts5
+
+HIDDEN_PREFIX: str = ".upload-"
+
+
+@skipUnless(has_fts5(), "SQLite was built without FTS5 or the trigram tokenizer")
+class TestSearchIndex(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name) / "uploads"
+        self.home = self.root / "home"
+        (self.home / "notes").mkdir(parents=True)
+        (self.home / "notes" / "shopping list.txt").write_text("apples and pears")
+        (self.home / "notes" / "todo.md").write_text("water the plants")
+        (self.home / "photo.jpg").write_bytes(b"\xff\xd8")
+        index = SearchIndex.create(Path(self.directory.name) / "search.sqlite3", self.root, HIDDEN_PREFIX)
+        assert index is not None
+        self.index = index
+        self.index.index_contents = True
+        self.connection = connect(self.index.database)
+        self.addCleanup(self.connection.close)
+        self.addCleanup(self.close_reader)
+        self.index.add(self.home)
+        self.index.apply_queued(self.connection)
+
+    def close_reader(self):
+        if (reader := getattr(self.index.readers, "connection", None)) is not None:
+            reader.close()
+
+    def search(self, query: str, directory: Path | None = None) -> list[str]:
+        return sorted(hit[0] for hit in self.index.search(directory or self.home, query))
+
+    def test_add(self):
+        self.assertEqual(self.search("shop"), ["home/notes/shopping list.txt"])
+        self.assertEqual(self.search("NOTES"), ["home/notes"])
+        self.assertEqual(self.search("pears"), ["home/notes/shopping list.txt"])
+        self.assertEqual(self.search("plan"), ["home/notes/todo.md"])
+        self.assertEqual(self.search("list shop"), ["home/notes/shopping list.txt"])
+        self.assertEqual(self.search("list todo"), [])
+        self.assertEqual(self.search("shop", self.home / "notes"), ["home/notes/shopping list.txt"])
+
+    def test_incremental_changes(self):
+        (self.home / "new.txt").write_text("bananas")
+        (self.home / f"{HIDDEN_PREFIX}partial").write_text("bananas")
+        self.index.add(self.home / "new.txt")
+        self.index.add(self.home / f"{HIDDEN_PREFIX}partial")
+        self.index.apply_queued(self.connection)
+        self.assertEqual(self.search("new"), ["home/new.txt"])
+        self.assertEqual(self.search("bananas"), ["home/new.txt"])
+        self.assertEqual(self.search("partial"), [])
+        (self.home / "new.txt").write_text("cherries, no longer the fruit from before")
+        self.index.add(self.home / "new.txt")
+        self.index.apply_queued(self.connection)
+        self.assertEqual(self.search("bananas"), [])
+        self.assertEqual(self.search("cherries"), ["home/new.txt"])
+
+    def test_remove(self):
+        (self.home / "photo.jpg").unlink()
+        self.index.remove(self.home / "photo.jpg")
+        self.index.remove(self.home / "notes")
+        self.index.apply_queued(self.connection)
+        for query in ("photo", "notes", "shop", "pears"):
+            with self.subTest(msg=f"Query: {query}"):
+                self.assertEqual(self.search(query), [])
+
+    def test_move(self):
+        (self.home / "notes").rename(self.home / "archive")
+        self.index.move(self.home / "notes", self.home / "archive")
+        (self.home / "photo.jpg").rename(self.home / "archive" / "picture.jpg")
+        self.index.move(self.home / "photo.jpg", self.home / "archive" / "picture.jpg")
+        self.index.apply_queued(self.connection)
+        self.assertEqual(self.search("shop"), ["home/archive/shopping list.txt"])
+        self.assertEqual(self.search("pears"), ["home/archive/shopping list.txt"])
+        self.assertEqual(self.search("notes"), [])
+        self.assertEqual(self.search("photo"), [])
+        self.assertEqual(self.search("picture"), ["home/archive/picture.jpg"])
+        self.assertEqual(
+            self.search("i", self.home / "archive"), ["home/archive/picture.jpg", "home/archive/shopping list.txt"]
+        )
+
+    def test_crawl_catches_up(self):
+        (self.home / "photo.jpg").unlink()
+        (self.home / "notes" / "made elsewhere.txt").write_text("outside")
+        self.index.crawl(self.connection)
+        self.assertEqual(self.search("photo"), [])
+        self.assertEqual(self.search("elsewhere"), ["home/notes/made elsewhere.txt"])
+
+    def test_sibling_folders(self):
+        (self.root / "home2").mkdir()
+        (self.root / "home2" / "shopping.txt").write_text("apples")
+        self.index.add(self.root / "home2")
+        self.index.apply_queued(self.connection)
+        self.assertEqual(self.search("shop"), ["home/notes/shopping list.txt"])
+        self.assertEqual(self.search("apples"), ["home/notes/shopping list.txt"])
+
+    def test_query_escaping(self):
+        for name in ('say "hi".txt', "100%.txt", "1000.txt", "a_b.txt", "aab.txt", "x AND y.txt", "NEAR(x).txt"):
+            (self.home / name).write_text("")
+            self.index.add(self.home / name)
+        self.index.apply_queued(self.connection)
+        for query, expected in (
+            ('"hi"', ['home/say "hi".txt']),
+            ('"', ['home/say "hi".txt']),
+            ("0%", ["home/100%.txt"]),
+            ("%", ["home/100%.txt"]),
+            ("_", ["home/a_b.txt"]),
+            ("a_b", ["home/a_b.txt"]),
+            # Operators are searched for as words, which "and" in the shopping list is
+            ("AND", ["home/x AND y.txt", "home/notes/shopping list.txt"]),
+            ("NEAR(", ["home/NEAR(x).txt"]),
+            ("-:*", []),
+            ("OR", []),
+            ("NOT", ["home/notes"]),
+        ):
+            with self.subTest(msg=f"Query: {query}"):
+                self.assertEqual(self.search(query), sorted(expected))
+
+
+class TestQueryTerms(TestCase):
+    def test_name_terms(self):
+        self.assertEqual(get_name_terms('ab say"hi %_'), ('"say""hi"', ["%ab%", "%\\%\\_%"]))
+        self.assertEqual(get_name_terms("   "), (None, []))
+
+    def test_content_expression(self):
+        self.assertEqual(get_content_expression('apple "pie" OR'), '"apple"* AND """pie"""* AND "OR"*')
+        self.assertIsNone(get_content_expression(""))
+
+
+if __name__ == "__main__":
+    main()
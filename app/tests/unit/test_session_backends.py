@@ -0,0 +1,211 @@
+"""Tests the session_backends module."""
+
+from asyncio import sleep
+from datetime import datetime, timedelta
+from unittest import IsolatedAsyncioTestCase, TestCase, main
+from unittest.mock import patch
+from uuid import uuid4
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app import session_backends
+from app.objects import Base
+from app.session_backends import (
+    CachedSessionBackend,
+    DatabaseSessionBackend,
+    MemorySessionBackend,
+    SessionBackend,
+    TokenSessionBackend,
+    create_session_backend,
+)
+
+LIFETIME: timedelta = timedelta(hours=1)
+
+
+class SessionBackendTests:
+    """What every backend has to do. Mixed into a TestCase per backend below."""
+
+    backend: SessionBackend
+
+    async def asyncSetUp(self):
+        self.database = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.database.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        session_maker = async_sessionmaker(self.database, autoflush=False, expire_on_commit=False)
+        patcher = patch.object(session_backends, "SessionMaker", session_maker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = self.make_backend()
+
+    async def asyncTearDown(self):
+        await self.database.dispose()
+
+    def make_backend(self) -> SessionBackend:
+        raise NotImplementedError
+
+    async def create(self, user_id: str, expires: datetime | None = None):
+        return await self.backend.create("user", user_id, 1, expires or datetime.now() + LIFETIME)
+
+    async def test_create_and_get(self):
+        user_id = uuid4().hex
+        session = await self.create(user_id)
+        found = await self.backend.get(session.session_id)
+        self.assertIsNotNone(found)
+        self.assertEqual((found.username, found.user_id, found.access_level), ("user", user_id, 1))
+        self.assertIsNone(await self.backend.get("unknown"))
+
+    async def test_expired_session(self):
+        session = await self.create(uuid4().hex, datetime.now() - timedelta(seconds=1))
+        self.assertIsNone(await self.backend.get(session.session_id))
+        await self.backend.expire()
+        self.assertIsNone(await self.backend.get(session.session_id))
+
+    async def test_remove(self):
+        user_id = uuid4().hex
+        removed, kept = await self.create(user_id), await self.create(user_id)
+        await self.backend.remove(removed.session_id)
+        self.assertIsNone(await self.backend.get(removed.session_id))
+        self.assertIsNotNone(await self.backend.get(kept.session_id))
+
+    async def test_remove_user(self):
+        user_id = uuid4().hex
+        sessions = [await self.create(user_id) for _ in range(3)]
+        other = await self.create(uuid4().hex)
+        await self.backend.remove_user(user_id)
+        for session in sessions:
+            self.assertIsNone(await self.backend.get(session.session_id))
+        self.assertIsNotNone(await self.backend.get(other.session_id))
+
+    async def test_update_user(self):
+        user_id = uuid4().hex
+        sessions = [await self.create(user_id) for _ in range(2)]
+        other = await self.create(uuid4().hex)
+        await self.backend.update_user(user_id, username="renamed", access_level=5)
+        for session in sessions:
+            found = await self.backend.get(session.session_id)
+            self.assertEqual((found.username, found.access_level), ("renamed", 5))
+        found = await self.backend.get(other.session_id)
+        self.assertEqual((found.username, found.access_level), ("user", 1))
+
+
+class TestMemorySessionBackend(SessionBackendTests, IsolatedAsyncioTestCase):
+    def make_backend(self) -> SessionBackend:
+        return MemorySessionBackend(stripes=2)
+
+    async def test_expire(self):
+        expired = await self.create(uuid4().hex, datetime.now() - timedelta(seconds=1))
+        live = await self.create(uuid4().hex)
+        self.assertEqual(len(self.backend), 2)
+        await self.backend.expire()
+        self.assertEqual(len(self.backend), 1)
+        self.assertEqual(self.backend.user_sessions, {live.user_id: {live.session_id}})
+        self.assertNotIn(expired.session_id, self.backend.sessions)
+
+    async def test_removed_sessions_leave_the_heap(self):
+        user_id = uuid4().hex
+        kept = [await self.create(uuid4().hex) for _ in range(2)]
+        removed = [await self.create(user_id) for _ in range(5)]
+        for session in removed[:3]:
+            await self.backend.remove(session.session_id)
+        await self.backend.remove_user(user_id)
+        self.assertLessEqual(len(self.backend.expiry_heap), 2 * len(self.backend))
+        self.assertEqual(
+            {session_id for _, session_id in self.backend.expiry_heap}, {session.session_id for session in kept}
+        )
+
+
+class TestSessionBackend(TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            SessionBackend()  # type: ignore
+
+
+class TestDatabaseSessionBackend(SessionBackendTests, IsolatedAsyncioTestCase):
+    def make_backend(self) -> SessionBackend:
+        return DatabaseSessionBackend()
+
+    async def test_shared_between_workers(self):
+        session = await self.create(uuid4().hex)
+        other_worker = DatabaseSessionBackend()
+        self.assertEqual(await other_worker.get(session.session_id), session)
+        await other_worker.remove(session.session_id)
+        self.assertIsNone(await self.backend.get(session.session_id))
+
+
+class TestTokenSessionBackend(SessionBackendTests, IsolatedAsyncioTestCase):
+    def make_backend(self) -> SessionBackend:
+        return TokenSessionBackend(b"secret", LIFETIME)
+
+    async def test_update_user(self):
+        # A token cannot be changed after it is issued, so the user has to log in again
+        user_id = uuid4().hex
+        session = await self.create(user_id)
+        await self.backend.update_user(user_id, access_level=5)
+        self.assertIsNone(await self.backend.get(session.session_id))
+        # Tokens issued after the revocation are fine again
+        await sleep(0.001)
+        self.assertIsNotNone(await self.backend.get((await self.create(user_id)).session_id))
+
+    async def test_tampered_token(self):
+        session = await self.create(uuid4().hex)
+        payload, signature = session.session_id.split(".")
+        self.assertIsNone(await self.backend.get(f"{payload}x.{signature}"))
+        self.assertIsNone(await TokenSessionBackend(b"other", LIFETIME).get(session.session_id))
+
+
+class TestCachedSessionBackend(SessionBackendTests, IsolatedAsyncioTestCase):
+    def make_backend(self) -> SessionBackend:
+        self.shared = DatabaseSessionBackend()
+        return CachedSessionBackend(self.shared, timedelta(seconds=60))
+
+    async def test_changes_from_other_workers(self):
+        user_id = uuid4().hex
+        session = await self.create(user_id)
+        self.assertIsNotNone(await self.backend.get(session.session_id))
+        # Another worker logging the session out is only seen once the cached entry runs out
+        await self.shared.update_user(user_id, username="renamed")
+        await self.shared.remove(session.session_id)
+        self.assertEqual((await self.backend.get(session.session_id)).username, "user")
+        self.backend.lifetime = timedelta(milliseconds=50)
+        self.backend.cache.clear()
+        session = await self.create(user_id)
+        self.assertIsNotNone(await self.backend.get(session.session_id))
+        await self.shared.remove(session.session_id)
+        await sleep(0.1)
+        self.assertIsNone(await self.backend.get(session.session_id))
+        self.assertNotIn(session.session_id, self.backend.cache)
+
+    async def test_cached_session_expires(self):
+        session = await self.create(uuid4().hex, datetime.now() + timedelta(milliseconds=50))
+        self.assertIsNotNone(await self.backend.get(session.session_id))
+        await sleep(0.1)
+        self.assertIsNone(await self.backend.get(session.session_id))
+
+    async def test_expire_drops_old_entries(self):
+        self.backend.lifetime = timedelta(0)
+        session = await self.create(uuid4().hex)
+        await self.backend.get(session.session_id)
+        await self.backend.expire()
+        self.assertEqual(self.backend.cache, {})
+
+
+class TestCreateSessionBackend(TestCase):
+    def test_backends(self):
+        memory = create_session_backend("memory", secret_key=None, lifetime=LIFETIME)
+        self.assertIsInstance(memory, MemorySessionBackend)
+        cached = create_session_backend("database", secret_key=None, lifetime=LIFETIME)
+        self.assertIsInstance(cached, CachedSessionBackend)
+        self.assertIsInstance(cached.backend, DatabaseSessionBackend)
+        uncached = create_session_backend("token", secret_key="secret", lifetime=LIFETIME, cache_seconds=0)
+        self.assertIsInstance(uncached, TokenSessionBackend)
+
+    def test_invalid_backends(self):
+        with self.assertRaises(KeyError):
+            create_session_backend("token", secret_key=None, lifetime=LIFETIME)
+        with self.assertRaises(KeyError):
+            create_session_backend("redis", secret_key="secret", lifetime=LIFETIME)
+
+
+if __name__ == "__main__":
+    main()
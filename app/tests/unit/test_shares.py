@@ -0,0 +1,198 @@
+"""Tests how the file_handler module looks up and lists shares, and keeps them in step with moved and deleted paths."""
+
+from datetime import datetime
+from pathlib import Path
+from unittest import IsolatedAsyncioTestCase, main
+from unittest.mock import Mock, patch
+from uuid import uuid4
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app import file_handler
+from app.file_handler import (
+    apply_share_changes,
+    delete_share,
+    delete_shares,
+    forget_share_records,
+    get_share_record,
+    list_shares,
+    move_shares,
+    share_subtree,
+    update_share,
+)
+from app.objects import Base, Share, ShareAllowedUser, User
+
+OWNER: bytes = uuid4().bytes
+# a/b and everything below it, followed by the siblings that only start with the same characters
+SUBTREE: tuple[str, ...] = ("a/b", "a/b/c", "a/b/c/d")
+SIBLINGS: tuple[str, ...] = ("a", "a/bc", "a/b-c", "a/b.txt", "a/b0", "b")
+
+
+class TestShareSubtree(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.database = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.database.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        self.session_maker = async_sessionmaker(self.database, autoflush=False, expire_on_commit=False)
+        self.share_ids: dict[str, bytes] = {}
+        async with self.session_maker() as engine:
+            for path in SUBTREE + SIBLINGS:
+                share = Share(owner=OWNER, expires=None, path=str(Path(path)), anonymous_access=False)
+                share.allowed_users.append(ShareAllowedUser(share_id=share.share_id, user_id=uuid4().bytes))
+                engine.add(share)
+                self.share_ids[path] = share.share_id
+            await engine.commit()
+
+    async def asyncTearDown(self):
+        await self.database.dispose()
+
+    async def get_paths(self) -> dict[bytes, str]:
+        async with self.session_maker() as engine:
+            return dict((await engine.execute(select(Share.share_id, Share.path))).all())
+
+    async def test_share_subtree(self):
+        async with self.session_maker() as engine:
+            matched = set((await engine.scalars(select(Share.path).where(share_subtree("a/b")))).all())
+        self.assertEqual(matched, set(SUBTREE))
+
+    async def test_share_subtree_of_a_leaf(self):
+        async with self.session_maker() as engine:
+            matched = (await engine.scalars(select(Share.path).where(share_subtree("a/bc")))).all()
+        self.assertEqual(matched, ["a/bc"])
+
+    async def test_move_shares(self):
+        async with self.session_maker() as engine:
+            await move_shares(engine, Path("a/b"), Path("x/yz"))
+            await engine.commit()
+        paths = await self.get_paths()
+        self.assertEqual(
+            [paths[self.share_ids[path]] for path in SUBTREE],
+            ["x/yz", "x/yz/c", "x/yz/c/d"],
+        )
+        self.assertEqual([paths[self.share_ids[path]] for path in SIBLINGS], list(SIBLINGS))
+
+    async def test_delete_shares(self):
+        async with self.session_maker() as engine:
+            await delete_shares(engine, Path("a/b"))
+            await engine.commit()
+            allowed = set((await engine.scalars(select(ShareAllowedUser.share_id))).all())
+        paths = await self.get_paths()
+        self.assertEqual(sorted(paths.values()), sorted(SIBLINGS))
+        self.assertEqual(allowed, set(paths))
+
+    async def test_apply_share_changes(self):
+        with patch.object(file_handler, "SessionMaker", self.session_maker):
+            # Later changes see the paths left behind by earlier ones
+            await apply_share_changes([(Path("a/b"), Path("x")), (Path("x/c"), None), (Path("a/bc"), Path("a/b"))])
+        paths = await self.get_paths()
+        self.assertEqual(paths[self.share_ids["a/b"]], "x")
+        self.assertNotIn(self.share_ids["a/b/c"], paths)
+        self.assertNotIn(self.share_ids["a/b/c/d"], paths)
+        self.assertEqual(paths[self.share_ids["a/bc"]], "a/b")
+        self.assertEqual(paths[self.share_ids["a/b-c"]], "a/b-c")
+
+
+class TestListShares(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.database = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.database.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        self.session_maker = async_sessionmaker(self.database, autoflush=False, expire_on_commit=False)
+        users = [User(username="bob"), User(username="alice")]
+        async with self.session_maker() as engine:
+            engine.add_all(users)
+            for path in SUBTREE + SIBLINGS:
+                share = Share(owner=OWNER, expires=None, path=str(Path(OWNER.hex(), path)), anonymous_access=False)
+                if path == "a/b":
+                    share.allowed_users.extend(
+                        ShareAllowedUser(share_id=share.share_id, user_id=user.user_id) for user in users
+                    )
+                engine.add(share)
+            # Someone else's share of a folder with the same name
+            engine.add(
+                Share(owner=uuid4().bytes, expires=None, path=str(Path(OWNER.hex(), "a/b")), anonymous_access=True)
+            )
+            await engine.commit()
+        patcher = patch.object(file_handler, "SessionMaker", self.session_maker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.database.dispose()
+
+    async def test_all_shares(self):
+        shares = await list_shares(OWNER.hex())
+        self.assertEqual([share["shared_file"] for share in shares], sorted(SUBTREE + SIBLINGS))
+        self.assertEqual(
+            {share["shared_file"]: share["allowed_users"] for share in shares if share["allowed_users"]},
+            {"a/b": ["alice", "bob"]},
+        )
+
+    async def test_filter(self):
+        # Only the share of that path, not those below it or next to it
+        for filter, expected in (("a/b", ["a/b"]), ("a/b/c", ["a/b/c"]), ("a/b.txt", ["a/b.txt"]), ("a/x", [])):
+            with self.subTest(msg=f"Filter: {filter}"):
+                shares = await list_shares(OWNER.hex(), filter)
+                self.assertEqual([share["shared_file"] for share in shares], expected)
+        (share,) = await list_shares(OWNER.hex(), "a/b")
+        self.assertEqual(share["shared_filename"], "b")
+        self.assertEqual(share["allowed_users"], ["alice", "bob"])
+
+
+class TestShareRecords(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.database = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.database.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        self.session_maker = async_sessionmaker(self.database, autoflush=False, expire_on_commit=False)
+        share = Share(owner=OWNER, expires=None, path=str(Path("a/b")), anonymous_access=True)
+        self.share_id = share.share_id.hex()
+        async with self.session_maker() as engine:
+            engine.add(share)
+            await engine.commit()
+        forget_share_records()
+        self.addCleanup(forget_share_records)
+        patcher = patch.object(file_handler, "SessionMaker", self.session_maker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.database.dispose()
+
+    async def get_cached_record(self):
+        """Looks the share up twice, so the second answer comes from the cache."""
+        await get_share_record(self.share_id)
+        hits = file_handler.share_record_stats["hits"]
+        record = await get_share_record(self.share_id)
+        self.assertEqual(file_handler.share_record_stats["hits"], hits + 1)
+        return record
+
+    async def test_changes_apply_straight_away(self):
+        self.assertTrue((await self.get_cached_record()).anonymous_access)
+        self.assertEqual(
+            await update_share(self.share_id, OWNER.hex(), anonymous_access=False), (True, "Share updated")
+        )
+        self.assertFalse((await get_share_record(self.share_id)).anonymous_access)
+
+    async def test_revoking_applies_straight_away(self):
+        self.assertIsNotNone(await self.get_cached_record())
+        self.assertEqual(await delete_share(self.share_id, OWNER.hex()), (True, "Share deleted"))
+        self.assertIsNone(await get_share_record(self.share_id))
+
+    async def test_records_expire(self):
+        await self.get_cached_record()
+        # Stands in for another worker changing the share behind this one's back
+        async with self.session_maker() as engine:
+            share = await engine.scalar(select(Share).filter_by(share_id=bytes.fromhex(self.share_id)))
+            await engine.delete(share)
+            await engine.commit()
+        self.assertIsNotNone(await get_share_record(self.share_id))
+        later = datetime.now() + file_handler.SHARE_CACHE_TTL
+        with patch.object(file_handler, "datetime", Mock(now=Mock(return_value=later))):
+            self.assertIsNone(await get_share_record(self.share_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Tests the streaming module."""
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, main
+from unittest.mock import patch
+
+from app import streaming
+from app.failure_cache import FailureCache
+from app.streaming import HLS_RENDITIONS, make_stream
+
+
+class FakeProcess:
+    def __init__(self, returncode: int) -> None:
+        self.exit_code = returncode
+        self.returncode: int | None = None
+
+    async def wait(self) -> int:
+        self.returncode = self.exit_code
+        return self.returncode
+
+    def kill(self) -> None:
+        pass
+
+
+class TestMakeStream(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        self.source = self.root / "video.mkv"
+        self.source.write_bytes(b"not really a video")
+        self.stream_directory = self.root / "streams" / "key"
+        self.failure_key = (self.source, 1)
+        patcher = patch.object(streaming, "failed_streams", FailureCache(3600, 10))
+        self.failed_streams = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def make_stream(self, **kwargs):
+        with patch.object(streaming, "create_subprocess_exec", **kwargs):
+            await make_stream(self.source, self.stream_directory, self.failure_key)
+
+    def assertNothingLeft(self):
+        self.assertEqual(list((self.root / "streams").iterdir()), [])
+
+    async def test_stream(self):
+        async def run(*_, **__):
+            return FakeProcess(0)
+
+        await self.make_stream(side_effect=run)
+        self.assertTrue((self.stream_directory / "master.m3u8").exists())
+        self.assertEqual(
+            sorted(path.name for path in self.stream_directory.iterdir()),
+            sorted(["master.m3u8", *(rendition.name for rendition in HLS_RENDITIONS)]),
+        )
+        self.assertFalse(self.failed_streams.has_failed(self.failure_key))
+
+    async def test_ffmpeg_fails(self):
+        async def run(*_, **__):
+            return FakeProcess(1)
+
+        with self.assertLogs(streaming.logger, "WARNING"):
+            await self.make_stream(side_effect=run)
+        self.assertTrue(self.failed_streams.has_failed(self.failure_key))
+        self.assertNothingLeft()
+
+    async def test_errors_are_remembered(self):
+        # Nothing awaits the task, so an exception would only ever show up as "Task exception was never retrieved"
+        with self.assertLogs(streaming.logger, "ERROR"):
+            await self.make_stream(side_effect=FileNotFoundError("ffmpeg"))
+        self.assertTrue(self.failed_streams.has_failed(self.failure_key))
+        self.assertNothingLeft()
+
+    async def test_unwritable_cache(self):
+        (self.root / "streams").write_text("a file where the cache should be")
+        with self.assertLogs(streaming.logger, "ERROR"):
+            await make_stream(self.source, self.stream_directory, self.failure_key)
+        self.assertTrue(self.failed_streams.has_failed(self.failure_key))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Tests resumable upload sessions in the file_handler module."""
+
+from asyncio import gather
+from collections.abc import AsyncIterator
+from hashlib import sha256
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import IsolatedAsyncioTestCase, main
+from unittest.mock import patch
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app import file_handler
+from app.content_store import add_content, get_content_path
+from app.file_handler import (
+    TEMPORARY_UPLOAD_PREFIX,
+    cancel_upload_session,
+    create_upload_session,
+    finish_upload_session,
+    get_upload_session,
+    write_upload_chunk,
+)
+from app.objects import Base
+
+OWNER: str = "owner"
+CONTENTS: bytes = bytes(range(256)) * 4
+DIGEST: str = sha256(CONTENTS).hexdigest()
+
+
+async def iter_chunks(data: bytes, chunk_size: int = 100) -> AsyncIterator[bytes]:
+    for start in range(0, len(data), chunk_size):
+        yield data[start : start + chunk_size]
+
+
+class TestUploadSessions(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = Path(self.directory.name)
+        (self.root / "home").mkdir()
+        self.database = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with self.database.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        session_maker = async_sessionmaker(self.database, autoflush=False, expire_on_commit=False)
+        for patcher in (
+            patch.object(file_handler, "SessionMaker", session_maker),
+            patch.dict(file_handler.CONFIG, {"upload_directory": str(self.root), "deduplicate_uploads": False}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.database.dispose()
+
+    async def create(self, size: int = len(CONTENTS), filename: str = "upload.bin") -> str:
+        success, upload_id = await create_upload_session("home", "", filename, size, OWNER)
+        self.assertTrue(success, upload_id)
+        return upload_id
+
+    async def write(self, upload_id: str, start: int, end: int, owner: str = OWNER) -> tuple[bool, str | int]:
+        return await write_upload_chunk(upload_id, owner, start, iter_chunks(CONTENTS[start:end]))
+
+    def temporary_files(self) -> list[Path]:
+        return list((self.root / "home").glob(f"{TEMPORARY_UPLOAD_PREFIX}*"))
+
+    async def test_chunks_in_order(self):
+        upload_id = await self.create()
+        self.assertEqual(await self.write(upload_id, 0, 500), (True, 500))
+        self.assertEqual(await self.write(upload_id, 500, len(CONTENTS)), (True, len(CONTENTS)))
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        self.assertEqual((self.root / "home" / "upload.bin").read_bytes(), CONTENTS)
+        self.assertEqual(self.temporary_files(), [])
+
+    async def test_out_of_order_and_overlapping_chunks(self):
+        upload_id = await self.create()
+        # Nothing from the start has arrived yet, so the offset the client resumes from stays at 0
+        self.assertEqual(await self.write(upload_id, 700, len(CONTENTS)), (True, 0))
+        self.assertEqual(await self.write(upload_id, 300, 800), (True, 0))
+        self.assertEqual(await self.write(upload_id, 0, 400), (True, len(CONTENTS)))
+        upload = await get_upload_session(upload_id, OWNER)
+        self.assertEqual(upload.received, [(0, len(CONTENTS))])
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        self.assertEqual((self.root / "home" / "upload.bin").read_bytes(), CONTENTS)
+
+    async def test_finish_with_gap(self):
+        upload_id = await self.create()
+        self.assertEqual(await self.write(upload_id, 0, 200), (True, 200))
+        self.assertEqual(await self.write(upload_id, 300, len(CONTENTS)), (True, 200))
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (False, "Upload is not complete yet!"))
+        self.assertFalse((self.root / "home" / "upload.bin").exists())
+        # The session is kept, so the gap can still be filled in
+        self.assertEqual(await self.write(upload_id, 200, 300), (True, len(CONTENTS)))
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        self.assertEqual((self.root / "home" / "upload.bin").read_bytes(), CONTENTS)
+
+    async def test_size_mismatch(self):
+        upload_id = await self.create(size=500)
+        self.assertEqual(await self.write(upload_id, 400, 600), (False, "Chunk goes past the end of the file!"))
+        self.assertEqual(await self.write(upload_id, 501, 600), (False, "Offset is outside of the file!"))
+        self.assertEqual(await self.write(upload_id, -1, 10), (False, "Offset is outside of the file!"))
+        upload = await get_upload_session(upload_id, OWNER)
+        self.assertEqual(upload.received, [])
+        self.assertEqual(upload.temporary_file.stat().st_size, 500)
+        self.assertEqual(
+            await create_upload_session("home", "", "negative.bin", -1, OWNER), (False, "Invalid file size!")
+        )
+
+    async def test_other_owner(self):
+        upload_id = await self.create()
+        self.assertEqual(await self.write(upload_id, 0, 100, owner="other"), (False, "Upload does not exist!"))
+        self.assertIsNone(await get_upload_session(upload_id, "other"))
+        self.assertEqual(await finish_upload_session(upload_id, "other"), (False, "Upload does not exist!"))
+        self.assertEqual(await cancel_upload_session(upload_id, "other"), (False, "Upload does not exist!"))
+        # None of that touched the owner's upload
+        upload = await get_upload_session(upload_id, OWNER)
+        self.assertEqual(upload.received, [])
+        self.assertTrue(upload.temporary_file.exists())
+
+    async def test_racing_finishes(self):
+        upload_id = await self.create()
+        await self.write(upload_id, 0, len(CONTENTS))
+        results = await gather(*(finish_upload_session(upload_id, OWNER) for _ in range(3)))
+        self.assertEqual(sorted(results), [(False, "Upload does not exist!")] * 2 + [(True, "Success!")])
+        self.assertEqual([path.name for path in (self.root / "home").iterdir()], ["upload.bin"])
+        self.assertEqual((self.root / "home" / "upload.bin").read_bytes(), CONTENTS)
+
+    async def test_cancel(self):
+        upload_id = await self.create()
+        await self.write(upload_id, 0, 100)
+        self.assertEqual(await cancel_upload_session(upload_id, OWNER), (True, "Upload cancelled"))
+        self.assertEqual(self.temporary_files(), [])
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (False, "Upload does not exist!"))
+
+    async def test_empty_upload(self):
+        upload_id = await self.create(size=0)
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        self.assertEqual((self.root / "home" / "upload.bin").read_bytes(), b"")
+
+
+class TestDeclaredHash(TestUploadSessions):
+    """Runs every test above with deduplication on too, and checks what a declared hash gets a client."""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        patcher = patch.dict(file_handler.CONFIG, {"deduplicate_uploads": True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(file_handler, "UPLOAD_CHALLENGE_SIZE", 100)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        stored = self.root / "stored.bin"
+        stored.write_bytes(CONTENTS)
+        add_content(stored, DIGEST)
+
+    async def create_declared(self, digest: str = DIGEST) -> tuple[str, tuple[int, int]]:
+        success, upload_id = await create_upload_session(
+            "home", "", "upload.bin", len(CONTENTS), OWNER, content_sha256=digest
+        )
+        self.assertTrue(success, upload_id)
+        upload = await get_upload_session(upload_id, OWNER)
+        self.assertEqual(upload.received, [])
+        return upload_id, upload.challenge
+
+    async def test_hash_alone_is_not_enough(self):
+        upload_id, challenge = await self.create_declared()
+        self.assertEqual(challenge[1] - challenge[0], 100)
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (False, "Upload is not complete yet!"))
+        self.assertFalse((self.root / "home" / "upload.bin").exists())
+
+    async def test_challenge_gets_stored_contents(self):
+        upload_id, (start, end) = await self.create_declared()
+        self.assertEqual(await self.write(upload_id, start, end), (True, len(CONTENTS)))
+        # Nothing more is written once the contents are known to be stored
+        self.assertEqual(await write_upload_chunk(upload_id, OWNER, 0, iter_chunks(bytes(10))), (True, len(CONTENTS)))
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        self.assertEqual((self.root / "home" / "upload.bin").read_bytes(), CONTENTS)
+        self.assertTrue((self.root / "home" / "upload.bin").samefile(get_content_path(DIGEST)))
+
+    async def test_wrong_challenge(self):
+        upload_id, (start, end) = await self.create_declared()
+        success, offset = await write_upload_chunk(upload_id, OWNER, start, iter_chunks(bytes(end - start)))
+        self.assertTrue(success)
+        self.assertLess(offset, len(CONTENTS))
+        upload = await get_upload_session(upload_id, OWNER)
+        self.assertIsNone(upload.digest)
+        self.assertEqual(upload.received, [(start, end)])
+        # The rest has to be sent like for any other upload, and the stored contents are never handed out
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (False, "Upload is not complete yet!"))
+        self.assertEqual(await self.write(upload_id, 0, start), (True, end))
+        self.assertEqual(await self.write(upload_id, end, len(CONTENTS)), (True, len(CONTENTS)))
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        uploaded = (self.root / "home" / "upload.bin").read_bytes()
+        self.assertEqual(uploaded, CONTENTS[:start] + bytes(end - start) + CONTENTS[end:])
+
+    async def test_unknown_hash(self):
+        upload_id, challenge = await self.create_declared(sha256(b"other").hexdigest())
+        self.assertIsNone(challenge)
+        self.assertEqual(await self.write(upload_id, 0, len(CONTENTS)), (True, len(CONTENTS)))
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (True, "Success!"))
+        # Stored as another name of the same contents all the same
+        self.assertTrue((self.root / "home" / "upload.bin").samefile(get_content_path(DIGEST)))
+
+    async def test_contents_swept_after_challenge(self):
+        upload_id, (start, end) = await self.create_declared()
+        await self.write(upload_id, start, end)
+        get_content_path(DIGEST).unlink()
+        self.assertEqual(await finish_upload_session(upload_id, OWNER), (False, "Upload is not complete yet!"))
+        upload = await get_upload_session(upload_id, OWNER)
+        self.assertEqual((upload.digest, upload.received), (None, []))
+
+
+if __name__ == "__main__":
+    main()
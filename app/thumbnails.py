@@ -0,0 +1,131 @@
+"""Makes small previews of images and videos in worker processes, cached on disk so each is only made once."""
+
+import lzma
+from asyncio import Future, get_running_loop, shield
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from os import cpu_count, stat_result as StatResult
+from pathlib import Path
+from shutil import which
+from subprocess import DEVNULL, TimeoutExpired, run
+from tempfile import NamedTemporaryFile
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .config import CONFIG
+from .failure_cache import FailureCache
+
+THUMBNAIL_TYPES: tuple[str, ...] = ("image", "video")
+THUMBNAIL_SIZE: tuple[int, int] = (320, 320)
+THUMBNAIL_QUALITY: int = 80
+# How far into a video the poster frame is taken from, falling back to the first frame for shorter ones
+POSTER_FRAME_SECONDS: float = 1.0
+POSTER_FRAME_TIMEOUT: int = 60
+# Thumbnails waiting for a worker beyond this are not made for now, and the file icon is shown instead
+THUMBNAIL_QUEUE_LIMIT: int = CONFIG.get("thumbnail_queue_limit", 64)
+# Failures are tried again after this long (ffmpeg may have been installed, a timeout may not happen again),
+# and only this many are remembered, the oldest being forgotten first
+FAILED_THUMBNAIL_RETRY_SECONDS: float = 3600
+FAILED_THUMBNAIL_LIMIT: int = 4096
+
+thumbnail_pool: ProcessPoolExecutor | None = None
+# Thumbnails being made right now, so requests for the same one share the work
+pending_thumbnails: dict[Path, Future] = {}
+# Files no thumbnail could be made of (corrupt, or a video without ffmpeg), by path and modification time,
+# with when it failed
+failed_thumbnails = FailureCache(FAILED_THUMBNAIL_RETRY_SECONDS, FAILED_THUMBNAIL_LIMIT)
+
+
+def get_thumbnail_pool() -> ProcessPoolExecutor:
+    global thumbnail_pool
+    if thumbnail_pool is None:
+        thumbnail_pool = ProcessPoolExecutor(max_workers=CONFIG.get("thumbnail_workers") or min(cpu_count() or 1, 2))
+    return thumbnail_pool
+
+
+def get_thumbnail_directory() -> Path:
+    if thumbnail_directory := CONFIG.get("thumbnail_directory"):
+        return Path(thumbnail_directory)
+    return Path(CONFIG["upload_directory"]) / ".thumbnails"
+
+
+def get_thumbnail_path(source: Path, stat_result: StatResult) -> Path:
+    """Thumbnails are named after the path, modification time and size of what they show,
+    so a changed file gets a new thumbnail and an unchanged one is found without opening it.
+    """
+    key = sha256(f"{source}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}".encode()).hexdigest()
+    return get_thumbnail_directory() / key[:2] / f"{key}.jpg"
+
+
+def make_image_thumbnail(source: Path, destination: Path, compressed: bool) -> None:
+    with lzma.open(source) if compressed else open(source, "rb") as source_file, Image.open(source_file) as image:
+        # Lets JPEGs be decoded straight at a fraction of their size
+        image.draft("RGB", THUMBNAIL_SIZE)
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail(THUMBNAIL_SIZE)
+        thumbnail.convert("RGB").save(destination, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+
+
+def make_poster_frame(source: Path, destination: Path) -> None:
+    width, height = THUMBNAIL_SIZE
+    scale = f"scale={width}:{height}:force_original_aspect_ratio=decrease"
+    for seconds in (POSTER_FRAME_SECONDS, 0):
+        command = ["ffmpeg", "-nostdin", "-v", "error", "-y", "-ss", str(seconds), "-i", str(source)]
+        command += ["-frames:v", "1", "-vf", scale, "-f", "mjpeg", str(destination)]
+        # A failed run is noticed by the frame it did not write
+        run(command, stdin=DEVNULL, capture_output=True, timeout=POSTER_FRAME_TIMEOUT, check=False)
+        if destination.stat().st_size:
+            return
+    raise ValueError("No frame could be read")
+
+
+def make_thumbnail(source: Path, destination: Path, kind: str, compressed: bool) -> bool:
+    """Runs inside a worker process. The thumbnail is written next to where it goes and moved into place,
+    so a half-written one is never served.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile(dir=destination.parent, suffix=".part", delete=False) as temporary_file:
+        temporary_path = Path(temporary_file.name)
+    try:
+        if kind == "video":
+            make_poster_frame(source, temporary_path)
+        else:
+            make_image_thumbnail(source, temporary_path, compressed)
+        temporary_path.replace(destination)
+        return True
+    except (OSError, ValueError, UnidentifiedImageError, Image.DecompressionBombError, TimeoutExpired, lzma.LZMAError):
+        return False
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def can_make_thumbnail(kind: str, compressed: bool) -> bool:
+    if kind == "video":
+        # ffmpeg needs to seek, which a compressed upload cannot do cheaply
+        return not compressed and which("ffmpeg") is not None
+    return kind == "image"
+
+
+async def get_thumbnail(source: Path, stat_result: StatResult, kind: str, compressed: bool = False) -> Path | None:
+    """Gets the thumbnail of a file, making it in the worker pool first if there is none yet.
+    Returns None if none can be made, or if too many are already waiting to be.
+    """
+    destination = get_thumbnail_path(source, stat_result)
+    if destination.exists():
+        return destination
+    failure_key = (source, stat_result.st_mtime_ns)
+    if failed_thumbnails.has_failed(failure_key) or not can_make_thumbnail(kind, compressed):
+        return None
+    if (pending := pending_thumbnails.get(destination)) is None:
+        if len(pending_thumbnails) >= THUMBNAIL_QUEUE_LIMIT:
+            return None
+        pending = get_running_loop().run_in_executor(
+            get_thumbnail_pool(), make_thumbnail, source, destination, kind, compressed
+        )
+        pending_thumbnails[destination] = pending
+        pending.add_done_callback(lambda _: pending_thumbnails.pop(destination, None))
+    # A client going away must not cancel a thumbnail others may be waiting for too
+    if not await shield(pending):
+        failed_thumbnails.remember(failure_key)
+        return None
+    return destination
@@ -0,0 +1,213 @@
+"""Deletes and copies whole directory trees off the event loop, with the many small system calls they take
+spread over a pool of threads, and keeps track of moves that have to copy because they cross filesystems.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from functools import partial
+from hashlib import sha256
+from os import cpu_count, fsync, scandir
+from pathlib import Path
+from secrets import token_hex
+from shutil import copystat
+from threading import Lock
+from typing import Literal
+
+from .config import CONFIG
+
+TREE_CHUNK_SIZE: int = 1024 * 1024
+# Finished jobs are still reported for this long, so their outcome can be seen
+TREE_JOB_EXPIRY: timedelta = timedelta(hours=1)
+
+tree_pool: ThreadPoolExecutor | None = None
+
+
+@dataclass(slots=True)
+class TreeJob:
+    """Something slow done to a file in the background: a move that copies, verifies and then deletes,
+    because it crosses filesystems, or an upload being compressed.
+    """
+
+    job_id: str
+    owner: str
+    source: Path
+    destination: Path
+    total_bytes: int
+    action: Literal["move", "compress"] = "move"
+    done_bytes: int = 0
+    state: Literal["running", "done", "failed"] = "running"
+    message: str = ""
+    finished: datetime | None = None
+    lock: Lock = field(default_factory=Lock, repr=False)
+
+    def add_progress(self, size: int) -> None:
+        with self.lock:
+            self.done_bytes += size
+
+    def finish(self, success: bool, message: str) -> None:
+        self.state = "done" if success else "failed"
+        self.message = message
+        self.finished = datetime.now()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.job_id,
+            "action": self.action,
+            "source": self.source.name,
+            "destination": self.destination.name,
+            "total_bytes": self.total_bytes,
+            "done_bytes": self.done_bytes,
+            "state": self.state,
+            "message": self.message,
+        }
+
+
+tree_jobs: dict[str, TreeJob] = {}
+
+
+def get_tree_pool() -> ThreadPoolExecutor:
+    global tree_pool
+    if tree_pool is None:
+        # The threads mostly wait on the filesystem, so there can be more of them than cores
+        tree_pool = ThreadPoolExecutor(max_workers=CONFIG.get("tree_workers") or min((cpu_count() or 1) * 4, 32))
+    return tree_pool
+
+
+def get_trash_directory() -> Path:
+    """Has to be on the same filesystem as the uploads, so moving something into it is a rename."""
+    if trash_directory := CONFIG.get("trash_directory"):
+        return Path(trash_directory)
+    return Path(CONFIG["upload_directory"]) / ".trash"
+
+
+def move_to_trash(path: Path) -> Path | None:
+    """Renames a file or folder into the trash, where nobody can see it any more, to be removed later.
+    Returns where it went, or None if it could not be moved there (most likely another filesystem).
+    """
+    trash_directory = get_trash_directory()
+    trashed_path = trash_directory / token_hex(16)
+    try:
+        trash_directory.mkdir(parents=True, exist_ok=True)
+        path.rename(trashed_path)
+    except OSError:
+        return None
+    return trashed_path
+
+
+def get_trashed_paths() -> list[Path]:
+    try:
+        with scandir(get_trash_directory()) as entries:
+            return [Path(entry.path) for entry in entries]
+    except OSError:
+        return []
+
+
+def remove_path(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def remove_tree(path: Path) -> None:
+    """Removes a file, or a folder and everything in it, unlinking the files of each folder in parallel.
+    Symlinks are removed, never followed.
+    """
+    if path.is_symlink() or not path.is_dir():
+        remove_path(path)
+        return
+    pool = get_tree_pool()
+    for root, directories, files in path.walk(top_down=False):
+        list(pool.map(remove_path, [root / file_ for file_ in files]))
+        for directory in directories:
+            if (root / directory).is_symlink():
+                remove_path(root / directory)
+            else:
+                (root / directory).rmdir()
+    path.rmdir()
+
+
+def copy_file(source: Path, destination: Path, job: TreeJob) -> None:
+    """Copies a file, then reads the copy back to check it has exactly the bytes that were read from the source."""
+    source_hash = sha256()
+    with open(source, "rb") as source_file, open(destination, "xb") as destination_file:
+        while chunk := source_file.read(TREE_CHUNK_SIZE):
+            source_hash.update(chunk)
+            destination_file.write(chunk)
+            job.add_progress(len(chunk))
+        destination_file.flush()
+        fsync(destination_file.fileno())
+    copy_hash = sha256()
+    with open(destination, "rb") as destination_file:
+        while chunk := destination_file.read(TREE_CHUNK_SIZE):
+            copy_hash.update(chunk)
+    if copy_hash.digest() != source_hash.digest():
+        raise ValueError(f"Copy of {source.name} does not match the original")
+    copystat(source, destination)
+
+
+def get_tree_size(path: Path) -> int:
+    """Adds up the files copy_tree would copy, for the progress of a job that did not know its size up front."""
+    if path.is_symlink():
+        return 0
+    if not path.is_dir():
+        return path.stat().st_size
+    size = 0
+    for root, directories, files in path.walk():
+        directories[:] = [directory for directory in directories if not (root / directory).is_symlink()]
+        size += sum((root / file_).stat().st_size for file_ in files if not (root / file_).is_symlink())
+    return size
+
+
+def copy_tree(source: Path, destination: Path, job: TreeJob) -> None:
+    """Copies a file or folder for a move across filesystems, with the files of each folder copied in
+    parallel. Symlinks are left out, since one pointing into the old filesystem would not mean the same there.
+    """
+    if source.is_symlink():
+        return
+    if not source.is_dir():
+        copy_file(source, destination, job)
+        return
+    pool = get_tree_pool()
+    for root, directories, files in source.walk():
+        target = destination / root.relative_to(source)
+        target.mkdir()
+        directories[:] = [directory for directory in directories if not (root / directory).is_symlink()]
+        names = [file_ for file_ in files if not (root / file_).is_symlink()]
+        # Paths are built up front instead of in a closure over root and target, which change every iteration
+        list(pool.map(partial(copy_file, job=job), [root / name for name in names], [target / name for name in names]))
+    # Folder times last, since filling a folder changes them
+    for root, directories, _ in source.walk():
+        for directory in directories:
+            if not (root / directory).is_symlink():
+                copystat(root / directory, destination / (root / directory).relative_to(source))
+    copystat(source, destination)
+
+
+def new_tree_job(
+    owner: str, source: Path, destination: Path, total_bytes: int, action: Literal["move", "compress"] = "move"
+) -> TreeJob:
+    expire_tree_jobs()
+    job = TreeJob(
+        job_id=token_hex(16),
+        owner=owner,
+        source=source,
+        destination=destination,
+        total_bytes=total_bytes,
+        action=action,
+    )
+    tree_jobs[job.job_id] = job
+    return job
+
+
+def expire_tree_jobs() -> None:
+    now = datetime.now()
+    for job_id, job in list(tree_jobs.items()):
+        if job.finished and now > job.finished + TREE_JOB_EXPIRY:
+            del tree_jobs[job_id]
+
+
+def get_tree_jobs(owner: str) -> list[dict]:
+    expire_tree_jobs()
+    return [job.to_dict() for job in tree_jobs.values() if job.owner == owner]